@@ -1,13 +1,30 @@
 import sqlite3
 import os
+import time
+import queue
+import asyncio
+import functools
 import logging
+import threading
 from contextlib import contextmanager
+import metrics
 try:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    import psycopg2.extensions
+    from psycopg2.extras import RealDictCursor, execute_values, execute_batch
     from psycopg2.pool import ThreadedConnectionPool
+
+    class PreparingConnection(psycopg2.extensions.connection):
+        """Remembers which registered statements have been PREPAREd in this session."""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
 except ImportError:
     psycopg2 = None
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
 
 # Configuration
 DB_PATH = os.environ.get("DB_PATH", "subway.db")
@@ -29,8 +46,97 @@ logger = logging.getLogger(__name__)
 
 # Global Connection Pool
 pg_pool = None
+# Postgres connections this process's psycopg2 pool may open (see start_prod.sh for the budget)
+POOL_MAX = int(os.environ.get("DB_POOL_MAX", "20"))
+sqlite_pool = None
+_sqlite_pool_lock = threading.Lock()
+
+# SQLite: connections are reused across threads, with these settings applied once per connection
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "8"))
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",  # Safe with WAL: only checkpoints fsync
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",  # KiB per connection
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",  # Wait for the other process's write instead of failing
+)
+
+class SQLitePool:
+    """
+    One writer connection plus up to `size` reader connections. SQLite allows a
+    single writer at a time anyway; in WAL mode readers never wait on it, so API
+    reads are not blocked while the ingestor writes.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._readers = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(size)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def _connect(self, readonly):
+        # Each connection is used by one thread at a time, but not always the same one
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    @contextmanager
+    def reader(self):
+        with self._reader_slots:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                conn = self._connect(readonly=True)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._readers.put(conn)
 
+    @contextmanager
+    def writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect(readonly=False)
+            try:
+                yield self._writer
+            finally:
+                # Same as closing a fresh connection: uncommitted work is discarded
+                if self._writer.in_transaction:
+                    self._writer.rollback()
+
+    def stats(self):
+        """{(pool, state): connections} for metrics."""
+        # Slots not available in the semaphore are readers checked out right now
+        in_use = self.size - self._reader_slots._value
+        return {
+            ("sqlite_readers", "in_use"): in_use,
+            ("sqlite_readers", "idle"): self._readers.qsize(),
+            ("sqlite_readers", "max"): self.size,
+            ("sqlite_writer", "in_use"): int(self._writer_lock.locked()),
+            ("sqlite_writer", "max"): 1,
+        }
+
+    def close(self):
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+@functools.lru_cache(maxsize=None)
 def get_db_type():
+    # Settled at import time (the URLs above are read once), so look it up only once
     if get_db_url():
         return "postgres"
     return "sqlite"
@@ -47,27 +153,12 @@ def init_db():
             
         with sqlite3.connect(DB_PATH) as conn:
             conn.execute("PRAGMA journal_mode=WAL;")
+            # Serialize schema setup/migration with any other process starting up
+            conn.execute("BEGIN IMMEDIATE")
             # SQLite Schema
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS trips (
-                    trip_id TEXT PRIMARY KEY,
-                    route_id TEXT,
-                    start_time TEXT,
-                    direction_id INTEGER
-                )
-            """)
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS positions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    trip_id TEXT,
-                    timestamp REAL,
-                    stop_id TEXT,
-                    distance REAL,
-                    FOREIGN KEY(trip_id) REFERENCES trips(trip_id)
-                )
-            """)
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_positions_timestamp ON positions(timestamp)")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_positions_trip_id ON positions(trip_id)")
+            now = time.time()
+            _init_sqlite_dimensions(conn, now)
+            _init_sqlite_positions(conn, now)
             
     elif db_type == "postgres":
         if not psycopg2:
@@ -76,7 +167,7 @@ def init_db():
         global pg_pool
         if pg_pool is None:
             try:
-                pg_pool = ThreadedConnectionPool(1, 20, get_db_url())
+                pg_pool = ThreadedConnectionPool(1, POOL_MAX, get_db_url(), connection_factory=PreparingConnection)
                 logger.info("Postgres connection pool created")
             except Exception as e:
                 logger.error(f"Failed to create connection pool: {e}")
@@ -91,49 +182,493 @@ def init_db():
                 cur.execute("SELECT pg_advisory_xact_lock(12345)")
                 
                 # Postgres Schema
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS trips (
-                        trip_id TEXT PRIMARY KEY,
-                        route_id TEXT,
-                        start_time TEXT,
-                        direction_id INTEGER
-                    )
-                """)
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS positions (
-                        id SERIAL PRIMARY KEY,
-                        trip_id TEXT,
-                        timestamp DOUBLE PRECISION,
-                        stop_id TEXT,
-                        distance DOUBLE PRECISION,
-                        FOREIGN KEY(trip_id) REFERENCES trips(trip_id)
-                    )
-                """)
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_positions_timestamp ON positions(timestamp)")
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_positions_trip_id ON positions(trip_id)")
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_trips_route_id ON trips(route_id)")
+                now = time.time()
+                _init_pg_dimensions(cur, now)
+                _init_pg_positions(cur, now)
             conn.commit()
         finally:
             pg_pool.putconn(conn)
 
+# --- Trip and stop dimensions ---
+# positions stores integer keys instead of trip_id/stop_id strings: `trips` maps
+# trip_id -> trip_key (plus the trip's route, start time and last_seen, used for
+# retention) and `stops` maps stop_id -> stop_key. Keys are never reused, so
+# caches of them (see dimensions.py) never go stale.
+
+def _table_columns(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+def _sqlite_drop_positions_view(conn):
+    # Before partitioning, positions was a plain table (migrated by _init_sqlite_positions)
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'positions'").fetchone()
+    if row and row[0] == "view":
+        conn.execute("DROP VIEW positions")
+
+def _init_sqlite_dimensions(conn, now):
+    # AUTOINCREMENT: a pruned trip's key is never handed out again
+    trips_schema = """
+        CREATE TABLE IF NOT EXISTS {name} (
+            trip_key INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id TEXT NOT NULL UNIQUE,
+            route_id TEXT,
+            start_time TEXT,
+            direction_id INTEGER,
+            last_seen REAL
+        )
+    """
+    columns = _table_columns(conn, "trips")
+    if columns and "trip_key" not in columns:
+        # trips keyed by trip_id: rebuild with integer keys (positions are re-keyed next)
+        logger.info("Adding integer keys to trips...")
+        _sqlite_drop_positions_view(conn)
+        conn.execute(trips_schema.format(name="trips_keyed"))
+        conn.execute("""
+            INSERT INTO trips_keyed (trip_id, route_id, start_time, direction_id, last_seen)
+            SELECT trip_id, route_id, start_time, direction_id, ? FROM trips
+        """, (now,))
+        conn.execute("DROP TABLE trips")
+        conn.execute("ALTER TABLE trips_keyed RENAME TO trips")
+    conn.execute(trips_schema.format(name="trips"))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trips_last_seen ON trips(last_seen)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stops (
+            stop_key INTEGER PRIMARY KEY AUTOINCREMENT,
+            stop_id TEXT NOT NULL UNIQUE
+        )
+    """)
+
+def _init_pg_dimensions(cur, now):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS trips (
+            trip_key BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            trip_id TEXT NOT NULL UNIQUE,
+            route_id TEXT,
+            start_time TEXT,
+            direction_id INTEGER,
+            last_seen DOUBLE PRECISION
+        )
+    """)
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'trips' AND column_name = 'trip_key'
+    """)
+    if cur.fetchone() is None:
+        # trips keyed by trip_id: the identity column numbers the existing rows
+        logger.info("Adding integer keys to trips...")
+        cur.execute("""
+            ALTER TABLE trips
+            ADD COLUMN trip_key BIGINT GENERATED BY DEFAULT AS IDENTITY,
+            ADD COLUMN last_seen DOUBLE PRECISION
+        """)
+        cur.execute("UPDATE trips SET last_seen = %s", (now,))
+        # CASCADE drops the old positions -> trips(trip_id) foreign key; positions are re-keyed next
+        cur.execute("ALTER TABLE trips DROP CONSTRAINT trips_pkey CASCADE")
+        cur.execute("ALTER TABLE trips ADD PRIMARY KEY (trip_key), ADD UNIQUE (trip_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trips_route_id ON trips(route_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trips_last_seen ON trips(last_seen)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stops (
+            stop_key INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            stop_id TEXT NOT NULL UNIQUE
+        )
+    """)
+
+def _fill_dimensions(execute, source, now):
+    """Add every trip_id/stop_id of a table being migrated to the dimension tables."""
+    # "WHERE true" keeps SQLite from reading ON CONFLICT as part of the SELECT
+    execute(f"""
+        INSERT INTO trips (trip_id, last_seen) SELECT DISTINCT trip_id, {float(now)} FROM {source}
+        WHERE trip_id IS NOT NULL ON CONFLICT (trip_id) DO NOTHING
+    """)
+    execute(f"""
+        INSERT INTO stops (stop_id) SELECT DISTINCT stop_id FROM {source}
+        WHERE stop_id IS NOT NULL ON CONFLICT (stop_id) DO NOTHING
+    """)
+
+def _keyed_select(source, has_route):
+    """POSITION_COLUMNS rows from a migrated table that stored trip_id/stop_id strings."""
+    route = "p.route_id, p.direction_id" if has_route else "t.route_id, t.direction_id"
+    return f"""
+        SELECT t.trip_key, p.timestamp, s.stop_key, p.distance, {route}
+        FROM {source} p
+        JOIN trips t ON t.trip_id = p.trip_id
+        JOIN stops s ON s.stop_id = p.stop_id
+    """
+
+# --- Positions storage ---
+# positions is split into fixed time periods so retention drops whole periods
+# instead of DELETEing rows. Postgres uses native range partitions of the
+# `positions` table; SQLite uses one table per period behind a `positions` view.
+# Reads just use `positions`; writes go through insert_positions/move_positions.
+PARTITION_SECONDS = int(os.environ.get("POSITIONS_PARTITION_SECONDS", 60 * 60))
+RETENTION_SECONDS = 24 * 60 * 60
+# route_id/direction_id are copied from trips so per-route reads need no join and
+# can be answered from the covering (route_id, timestamp, ...) index alone.
+# Trips and stops are stored as their integer keys (see dimensions.py).
+POSITION_COLUMNS = ("trip_key", "timestamp", "stop_key", "distance", "route_id", "direction_id")
+TIMESTAMP_INDEX = POSITION_COLUMNS.index("timestamp")
+
+_known_partitions = set()  # partition start times known to exist in this process
+
+def partition_start(ts):
+    return int(ts // PARTITION_SECONDS) * PARTITION_SECONDS
+
+def partition_name(start):
+    return f"positions_p{start}"
+
+def _partition_starts(first_ts, last_ts):
+    return range(partition_start(first_ts), partition_start(last_ts) + 1, PARTITION_SECONDS)
+
+def _sqlite_partitions(conn):
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'positions\\_p%' ESCAPE '\\'"
+    ).fetchall()
+    return sorted(int(r[0][len("positions_p"):]) for r in rows)
+
+def _sqlite_create_partition(conn, start):
+    name = partition_name(start)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY,
+            trip_key INTEGER,
+            timestamp REAL,
+            stop_key INTEGER,
+            distance REAL,
+            route_id TEXT,
+            direction_id INTEGER,
+            FOREIGN KEY(trip_key) REFERENCES trips(trip_key)
+        )
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_timestamp ON {name}(timestamp)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_trip_key ON {name}(trip_key)")
+    # SQLite has no INCLUDE: a covering index lists every column the history reads return
+    conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{name}_route_ts
+        ON {name}(route_id, timestamp, trip_key, direction_id, stop_key, distance)
+    """)
+
+def _sqlite_rekey_partition(conn, start, now):
+    """Rebuild a partition that stored trip_id/stop_id strings with integer keys."""
+    name = partition_name(start)
+    old = f"{name}_text"
+    has_route = "route_id" in _table_columns(conn, name)
+    conn.execute(f"ALTER TABLE {name} RENAME TO {old}")
+    for index in ("timestamp", "trip_id", "route_ts"):
+        # Index names stay with the renamed table
+        conn.execute(f"DROP INDEX IF EXISTS idx_{name}_{index}")
+    _fill_dimensions(conn.execute, old, now)
+    _sqlite_create_partition(conn, start)
+    conn.execute(f"INSERT INTO {name} ({', '.join(POSITION_COLUMNS)}) {_keyed_select(old, has_route)}")
+    conn.execute(f"DROP TABLE {old}")
+
+def _sqlite_rebuild_view(conn):
+    starts = _sqlite_partitions(conn)
+    if not starts:
+        # The view needs at least one table behind it
+        starts = [partition_start(time.time())]
+        _sqlite_create_partition(conn, starts[0])
+    cols = ", ".join(POSITION_COLUMNS)
+    conn.execute("DROP VIEW IF EXISTS positions")
+    conn.execute("CREATE VIEW positions AS " + " UNION ALL ".join(
+        f"SELECT id, {cols} FROM {partition_name(start)}" for start in starts
+    ))
+    _known_partitions.clear()
+    _known_partitions.update(starts)
+
+def _init_sqlite_positions(conn, now):
+    cols = ", ".join(POSITION_COLUMNS)
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'positions'").fetchone()
+    if row and row[0] == "table":
+        # Migrate the old single table: keep the retention window, split by period
+        logger.info("Migrating positions table to time partitions...")
+        conn.execute("ALTER TABLE positions RENAME TO positions_legacy")
+        _fill_dimensions(conn.execute, "positions_legacy", now)
+        cutoff = now - RETENTION_SECONDS
+        periods = conn.execute(
+            "SELECT DISTINCT CAST(timestamp / ? AS INTEGER) FROM positions_legacy WHERE timestamp >= ?",
+            (PARTITION_SECONDS, cutoff)
+        ).fetchall()
+        for (period,) in periods:
+            start = period * PARTITION_SECONDS
+            _sqlite_create_partition(conn, start)
+            conn.execute(f"""
+                INSERT INTO {partition_name(start)} ({cols})
+                {_keyed_select("positions_legacy", has_route=False)}
+                WHERE p.timestamp >= ? AND p.timestamp < ? AND p.timestamp >= ?
+            """, (start, start + PARTITION_SECONDS, cutoff))
+        conn.execute("DROP TABLE positions_legacy")
+
+    # Existing partitions are brought up to the current schema as well
+    existing = _sqlite_partitions(conn)
+    if any("trip_key" not in _table_columns(conn, partition_name(start)) for start in existing):
+        logger.info("Re-keying positions partitions with integer trip/stop keys...")
+        _sqlite_drop_positions_view(conn)
+        for start in existing:
+            if "trip_key" not in _table_columns(conn, partition_name(start)):
+                _sqlite_rekey_partition(conn, start, now)
+    for start in set(existing) | set(_partition_starts(now, now + PARTITION_SECONDS)):
+        _sqlite_create_partition(conn, start)
+    _sqlite_rebuild_view(conn)
+
+def _pg_partitions(cur):
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'positions'::regclass
+    """)
+    return sorted(int(r[0][len("positions_p"):]) for r in cur.fetchall())
+
+def _pg_create_partition(cur, start):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {partition_name(start)} PARTITION OF positions
+        FOR VALUES FROM ({start}) TO ({start + PARTITION_SECONDS})
+    """)
+
+def _init_pg_positions(cur, now):
+    cols = ", ".join(POSITION_COLUMNS)
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('positions')")
+    row = cur.fetchone()
+    relkind = row[0] if row else None
+
+    def has_column(column):
+        cur.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'positions' AND column_name = %s
+        """, (column,))
+        return cur.fetchone() is not None
+
+    # Rows to copy into the new table: (source table, has route columns)
+    source = None
+    if relkind == "r":
+        # Migrate the old single table; its index names are reused by the partitioned table
+        logger.info("Migrating positions table to time partitions...")
+        cur.execute("ALTER TABLE positions RENAME TO positions_legacy")
+        cur.execute("DROP INDEX IF EXISTS idx_positions_timestamp")
+        cur.execute("DROP INDEX IF EXISTS idx_positions_trip_id")
+        source = ("positions_legacy", False)
+    elif relkind == "p" and not has_column("trip_key"):
+        # Partitioned table storing trip_id/stop_id strings: move it (and its
+        # partitions and indexes) out of the way and copy it into a keyed one
+        logger.info("Re-keying positions with integer trip/stop keys...")
+        has_route = has_column("route_id")
+        starts = _pg_partitions(cur)
+        for index in ("timestamp", "trip_id", "route_ts"):
+            cur.execute(f"DROP INDEX IF EXISTS idx_positions_{index}")
+        cur.execute("ALTER TABLE positions RENAME TO positions_text")
+        for start in starts:
+            cur.execute(f"ALTER TABLE {partition_name(start)} RENAME TO positions_text_p{start}")
+        source = ("positions_text", has_route)
+
+    if relkind != "p" or source:
+        cur.execute("""
+            CREATE TABLE positions (
+                id BIGSERIAL,
+                trip_key BIGINT,
+                timestamp DOUBLE PRECISION,
+                stop_key INTEGER,
+                distance DOUBLE PRECISION,
+                route_id TEXT,
+                direction_id INTEGER,
+                FOREIGN KEY(trip_key) REFERENCES trips(trip_key)
+            ) PARTITION BY RANGE (timestamp)
+        """)
+    # Indexes on the parent are created on every partition
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_positions_timestamp ON positions(timestamp)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_positions_trip_key ON positions(trip_key)")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_positions_route_ts ON positions(route_id, timestamp)
+        INCLUDE (trip_key, direction_id, stop_key, distance)
+    """)
+
+    first = now
+    if source:
+        table, has_route = source
+        cutoff = now - RETENTION_SECONDS
+        cur.execute(f"SELECT MIN(timestamp) FROM {table} WHERE timestamp >= %s", (cutoff,))
+        oldest = cur.fetchone()[0]
+        if oldest is not None:
+            first = min(oldest, now)
+        for start in _partition_starts(first, now + PARTITION_SECONDS):
+            _pg_create_partition(cur, start)
+        _fill_dimensions(cur.execute, table, now)
+        cur.execute(f"""
+            INSERT INTO positions ({cols})
+            {_keyed_select(table, has_route)} WHERE p.timestamp >= %s
+        """, (cutoff,))
+        # Drops the old partitions with it
+        cur.execute(f"DROP TABLE {table}")
+
+    for start in _partition_starts(first, now + PARTITION_SECONDS):
+        _pg_create_partition(cur, start)
+    _known_partitions.clear()
+    _known_partitions.update(_pg_partitions(cur))
+
+def ensure_partitions(conn, timestamps):
+    """
+    Make sure the partitions holding these timestamps exist. Commits, so call it
+    before starting a write transaction (creating a partition is DDL).
+    Only the periods the timestamps fall in are created, never the ones between
+    them: one stray old timestamp must not create a partition per hour since.
+    """
+    missing = sorted({partition_start(ts) for ts in timestamps} - _known_partitions)
+    if not missing:
+        return
+
+    if get_db_type() == "sqlite":
+        conn.execute("BEGIN IMMEDIATE")
+        for start in missing:
+            _sqlite_create_partition(conn, start)
+        _sqlite_rebuild_view(conn)
+        conn.commit()
+
+    elif get_db_type() == "postgres":
+        with conn.cursor() as cur:
+            for start in missing:
+                _pg_create_partition(cur, start)
+        conn.commit()
+        _known_partitions.update(missing)
+
+def insert_positions(conn, rows):
+    """Bulk insert POSITION_COLUMNS rows. Partitions must exist (see ensure_partitions)."""
+    if get_db_type() == "postgres":
+        insert_many(conn, "positions", POSITION_COLUMNS, rows)
+        return
+
+    by_partition = {}
+    for row in rows:
+        by_partition.setdefault(partition_start(row[TIMESTAMP_INDEX]), []).append(row)
+    for start, partition_rows in by_partition.items():
+        insert_many(conn, partition_name(start), POSITION_COLUMNS, partition_rows)
+
+def move_positions(conn, moves):
+    """Change the timestamp of existing rows: (new_ts, trip_key, old_ts). Partitions must exist."""
+    if get_db_type() == "postgres":
+        # Postgres moves rows between partitions itself
+        run_many(conn, _MOVE_POSITION, moves)
+        return
+
+    same_partition = {}
+    cross_partition = {}
+    for move in moves:
+        src, dst = partition_start(move[2]), partition_start(move[0])
+        if src == dst:
+            same_partition.setdefault(src, []).append(move)
+        else:
+            cross_partition.setdefault((src, dst), []).append(move)
+
+    for start, partition_moves in same_partition.items():
+        execute_many(conn, f"UPDATE {partition_name(start)} SET timestamp = ? WHERE trip_key = ? AND timestamp = ?",
+                     partition_moves)
+
+    cols = ", ".join(POSITION_COLUMNS)
+    select_cols = ", ".join("?" if c == "timestamp" else c for c in POSITION_COLUMNS)
+    for (src, dst), partition_moves in cross_partition.items():
+        execute_many(conn, f"""
+            INSERT INTO {partition_name(dst)} ({cols})
+            SELECT {select_cols} FROM {partition_name(src)} WHERE trip_key = ? AND timestamp = ?
+        """, partition_moves)
+        execute_many(conn, f"DELETE FROM {partition_name(src)} WHERE trip_key = ? AND timestamp = ?",
+                     [(trip_key, old_ts) for _, trip_key, old_ts in partition_moves])
+
+def delete_positions(conn, since, until, route_ids):
+    """Delete the given routes' rows with since <= timestamp < until. Does not commit. Returns the count."""
+    route_ids = list(route_ids)
+    if not route_ids:
+        return 0
+    placeholders = ", ".join("?" for _ in route_ids)
+    where = f"timestamp >= ? AND timestamp < ? AND route_id IN ({placeholders})"
+    params = [since, until] + route_ids
+
+    if get_db_type() == "sqlite":
+        # The positions view is read-only: delete from each overlapping partition
+        deleted = 0
+        for start in _sqlite_partitions(conn):
+            if start < until and start + PARTITION_SECONDS > since:
+                deleted += conn.execute(f"DELETE FROM {partition_name(start)} WHERE {where}", params).rowcount
+        return deleted
+
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM positions WHERE {_pg_query(where)}", params)
+        return cur.rowcount
+
+def prune_positions(conn, cutoff):
+    """Drop every partition whose period ended before cutoff. Commits. Returns the number dropped."""
+    if get_db_type() == "sqlite":
+        conn.execute("BEGIN IMMEDIATE")
+        expired = [s for s in _sqlite_partitions(conn) if s + PARTITION_SECONDS <= cutoff]
+        for start in expired:
+            conn.execute(f"DROP TABLE IF EXISTS {partition_name(start)}")
+        _sqlite_rebuild_view(conn)
+        conn.commit()
+
+    elif get_db_type() == "postgres":
+        with conn.cursor() as cur:
+            expired = [s for s in _pg_partitions(cur) if s + PARTITION_SECONDS <= cutoff]
+            for start in expired:
+                cur.execute(f"DROP TABLE IF EXISTS {partition_name(start)}")
+        conn.commit()
+        _known_partitions.difference_update(expired)
+
+    return len(expired)
+
 def close_pool():
-    global pg_pool
+    global pg_pool, sqlite_pool
     if pg_pool:
         pg_pool.closeall()
         pg_pool = None
         logger.info("Postgres connection pool closed")
+    if sqlite_pool:
+        sqlite_pool.close()
+        sqlite_pool = None
+
+def _pool_stats():
+    """Connections per pool opened by this process (sync and async), by state."""
+    stats = {}
+    if sqlite_pool is not None:
+        stats.update(sqlite_pool.stats())
+    pool = pg_pool
+    if pool is not None and not pool.closed:
+        # ThreadedConnectionPool keeps checked-out connections in _used and idle ones in _pool
+        stats[("postgres", "in_use")] = len(pool._used)
+        stats[("postgres", "idle")] = len(pool._pool)
+        stats[("postgres", "max")] = pool.maxconn
+    apool = async_pool
+    if apool is not None:
+        stats[("asyncpg", "in_use")] = apool.get_size() - apool.get_idle_size()
+        stats[("asyncpg", "idle")] = apool.get_idle_size()
+        stats[("asyncpg", "max")] = apool.get_max_size()
+    return stats
+
+DB_POOL_CONNECTIONS = metrics.Gauge(
+    "stringlines_db_pool_connections", "DB connections per pool: in_use, idle and max",
+    ("pool", "state"), callback=_pool_stats,
+)
+
+def _get_sqlite_pool():
+    global sqlite_pool
+    pool = sqlite_pool
+    if pool is None or pool.path != DB_PATH:
+        # Created on first use (or when DB_PATH is changed, e.g. by scripts)
+        with _sqlite_pool_lock:
+            if sqlite_pool is None or sqlite_pool.path != DB_PATH:
+                if sqlite_pool:
+                    sqlite_pool.close()
+                sqlite_pool = SQLitePool(DB_PATH, SQLITE_POOL_SIZE)
+            pool = sqlite_pool
+    return pool
 
 @contextmanager
-def get_db():
+def get_db(readonly=False):
+    """
+    Connection for one unit of work. Pass readonly=True for reads: on SQLite they
+    use the reader connections and never queue behind the ingestor's writes.
+    """
     db_type = get_db_type()
     
     if db_type == "sqlite":
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        try:
+        pool = _get_sqlite_pool()
+        with (pool.reader() if readonly else pool.writer()) as conn:
             yield conn
-        finally:
-            conn.close()
             
     elif db_type == "postgres":
         if pg_pool:
@@ -144,13 +679,24 @@ def get_db():
                 pg_pool.putconn(conn)
         else:
             # Fallback if pool not initialized (e.g. scripts)
-            conn = psycopg2.connect(get_db_url())
+            conn = psycopg2.connect(get_db_url(), connection_factory=PreparingConnection)
             try:
                 yield conn
             finally:
                 conn.close()
 
-# Helper to execute query with correct placeholder
+@functools.lru_cache(maxsize=256)
+def _pg_query(query):
+    return query.replace("?", "%s")
+
+@functools.lru_cache(maxsize=256)
+def _numbered_query(query):
+    """Rewrite ? placeholders to $1, $2, ... (PREPARE and asyncpg)."""
+    parts = query.split("?")
+    return parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+
+# Helper to execute query with correct placeholder (ad-hoc queries; rows support row["column"]).
+# Hot paths use registered statements with fetch/run_many instead.
 def execute_query(conn, query, params=()):
     db_type = get_db_type()
     
@@ -162,7 +708,159 @@ def execute_query(conn, query, params=()):
     elif db_type == "postgres":
         # Postgres uses %s
         # We need to convert ? to %s in the query string for compatibility
-        pg_query = query.replace("?", "%s")
         cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(pg_query, params)
+        cursor.execute(_pg_query(query), params)
         return cursor
+
+# --- Statement registry ---
+class Statement:
+    """
+    A named query written with ? placeholders. Its Postgres forms are built once,
+    and on Postgres it is PREPAREd once per connection, then run with EXECUTE.
+    """
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.numbered_sql = _numbered_query(sql)
+        self.pg_sql = _pg_query(sql)
+        self.prepare_sql = f"PREPARE {name} AS {self.numbered_sql}"
+        count = sql.count("?")
+        self.execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * count)})" if count else f"EXECUTE {name}"
+
+_statements = {}  # name -> Statement
+
+def statement(name, sql):
+    """Register a query under a name (module level, once) and return its Statement."""
+    stmt = _statements.get(name)
+    if stmt is None:
+        stmt = _statements[name] = Statement(name, sql)
+    elif stmt.sql != sql:
+        raise ValueError(f"Statement {name} is already registered with different SQL")
+    return stmt
+
+def _pg_statement_sql(conn, cur, stmt):
+    prepared = getattr(conn, "prepared", None)
+    if prepared is None:
+        # Connection not made by PreparingConnection: run the statement as plain SQL
+        return stmt.pg_sql
+    if stmt.name not in prepared:
+        # Prepared statements belong to the session and survive rollbacks
+        cur.execute(stmt.prepare_sql)
+        prepared.add(stmt.name)
+    return stmt.execute_sql
+
+def fetch(conn, stmt, params=()):
+    """Run a registered statement and return its rows as plain tuples, in SELECT order."""
+    if get_db_type() == "sqlite":
+        # Skip sqlite3.Row; SQLite's own statement cache makes re-preparing free
+        cur = conn.cursor()
+        cur.row_factory = None
+        return cur.execute(stmt.sql, params).fetchall()
+
+    with conn.cursor() as cur:
+        cur.execute(_pg_statement_sql(conn, cur, stmt), params)
+        return cur.fetchall()
+
+_MOVE_POSITION = statement("move_position", "UPDATE positions SET timestamp = ? WHERE trip_key = ? AND timestamp = ?")
+
+def run_many(conn, stmt, rows):
+    """Run a registered statement for many parameter rows (e.g. batched UPDATEs). Does not commit."""
+    if not rows:
+        return
+
+    if get_db_type() == "sqlite":
+        conn.executemany(stmt.sql, rows)
+
+    elif get_db_type() == "postgres":
+        with conn.cursor() as cur:
+            execute_batch(cur, _pg_statement_sql(conn, cur, stmt), rows, page_size=1000)
+
+# Multi-row insert: one execute_values statement on Postgres, executemany on SQLite.
+# Does not commit; callers decide the transaction boundary.
+def insert_many(conn, table, columns, rows, on_conflict=None):
+    if not rows:
+        return
+
+    cols = ", ".join(columns)
+    suffix = f" ON CONFLICT({on_conflict}) DO NOTHING" if on_conflict else ""
+
+    if get_db_type() == "sqlite":
+        placeholders = ", ".join("?" for _ in columns)
+        conn.executemany(f"INSERT INTO {table} ({cols}) VALUES ({placeholders}){suffix}", rows)
+
+    elif get_db_type() == "postgres":
+        with conn.cursor() as cur:
+            execute_values(cur, f"INSERT INTO {table} ({cols}) VALUES %s{suffix}", rows, page_size=1000)
+
+def insert_returning(conn, table, columns, rows, conflict, update, returning):
+    """
+    Upsert rows and return `returning` for each of them, new or existing (the
+    conflicting row's `update` column is set to the new value so it is returned).
+    Does not commit.
+    """
+    if not rows:
+        return []
+
+    cols = ", ".join(columns)
+    suffix = f" ON CONFLICT({conflict}) DO UPDATE SET {update} = excluded.{update} RETURNING {returning}"
+
+    if get_db_type() == "sqlite":
+        # RETURNING needs one execute per row; cheap in-process
+        placeholders = ", ".join("?" for _ in columns)
+        sql = f"INSERT INTO {table} ({cols}) VALUES ({placeholders}){suffix}"
+        return [tuple(conn.execute(sql, row).fetchone()) for row in rows]
+
+    with conn.cursor() as cur:
+        return execute_values(cur, f"INSERT INTO {table} ({cols}) VALUES %s{suffix}", rows,
+                              page_size=1000, fetch=True)
+
+# Run one statement for many parameter rows (e.g. batched UPDATEs). Does not commit.
+def execute_many(conn, query, rows):
+    if not rows:
+        return
+
+    if get_db_type() == "sqlite":
+        conn.executemany(query, rows)
+
+    elif get_db_type() == "postgres":
+        with conn.cursor() as cur:
+            execute_batch(cur, query.replace("?", "%s"), rows, page_size=1000)
+
+# --- Async access ---
+# Async endpoints and the web process's history sync read through fetch_all. On
+# Postgres it uses an asyncpg pool, so waiting on the DB holds no worker thread;
+# on SQLite (or without asyncpg) the sync path runs in a thread instead.
+# Counted per process, like POOL_MAX: see start_prod.sh for the connection budget
+ASYNC_POOL_MIN = int(os.environ.get("DB_ASYNC_POOL_MIN", "2"))
+ASYNC_POOL_MAX = int(os.environ.get("DB_ASYNC_POOL_MAX", "20"))
+async_pool = None
+
+async def init_async_pool():
+    global async_pool
+    if get_db_type() != "postgres" or async_pool is not None:
+        return
+    if not asyncpg:
+        logger.warning("asyncpg is not installed; async reads will use the psycopg2 pool in a thread")
+        return
+    async_pool = await asyncpg.create_pool(get_db_url(), min_size=min(ASYNC_POOL_MIN, ASYNC_POOL_MAX),
+                                            max_size=ASYNC_POOL_MAX)
+    logger.info("Postgres async pool created")
+
+async def close_async_pool():
+    global async_pool
+    if async_pool:
+        await async_pool.close()
+        async_pool = None
+        logger.info("Postgres async pool closed")
+
+def _fetch_all(stmt, params):
+    with get_db(readonly=True) as conn:
+        return fetch(conn, stmt, params)
+
+async def fetch_all(stmt, params=()):
+    """fetch() for a registered statement without blocking the event loop. Rows index like tuples."""
+    if async_pool is not None:
+        # asyncpg prepares and caches statements per connection itself
+        async with async_pool.acquire() as conn:
+            return await conn.fetch(stmt.numbered_sql, *params)
+    return await asyncio.to_thread(_fetch_all, stmt, params)
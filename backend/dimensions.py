@@ -0,0 +1,186 @@
+"""
+Integer keys for trip and stop ids (the `trips` and `stops` tables, see db.py).
+
+positions stores trip_key/stop_key instead of the id strings. The ingestor
+interns ids through a forward cache (id -> key), so a steady-state feed costs no
+lookups; readers turn keys back into ids through reverse caches filled from the
+dimension tables on a miss. Keys are never reused, so cached entries never go
+stale: at worst they point at a pruned trip nobody asks for any more.
+"""
+import threading
+import logging
+from db import (statement, fetch, fetch_all, run_many, insert_returning, insert_positions,
+                move_positions, RETENTION_SECONDS, PARTITION_SECONDS)
+
+logger = logging.getLogger(__name__)
+
+# trips.last_seen is rewritten at most this often per trip (seconds)
+TRIP_TOUCH_SECONDS = 60 * 60
+# Trips unseen for this long and without positions left are deleted; past the
+# positions retention, plus the partitions that outlive it
+TRIP_RETENTION = RETENTION_SECONDS + 2 * PARTITION_SECONDS
+# Reverse caches are dropped and refilled past this many entries
+REVERSE_CACHE_LIMIT = 100_000
+
+# Writer side (the ingest process): trip_id -> [trip_key, last_seen written], stop_id -> stop_key
+_trip_keys = {}
+_stop_keys = {}
+# Reader side: trip_key -> trip_id, stop_key -> stop_id
+_trip_ids = {}
+_stop_ids = {}
+_lock = threading.Lock()
+
+_TRIPS_FROM = statement("trip_ids_from", "SELECT trip_key, trip_id FROM trips WHERE trip_key >= ?")
+_STOPS_FROM = statement("stop_ids_from", "SELECT stop_key, stop_id FROM stops WHERE stop_key >= ?")
+_TOUCH_TRIP = statement("touch_trip", "UPDATE trips SET last_seen = ? WHERE trip_key = ?")
+_PRUNE_TRIPS = statement("prune_trips", """
+    DELETE FROM trips
+    WHERE last_seen < ?
+    AND NOT EXISTS (SELECT 1 FROM positions p WHERE p.trip_key = trips.trip_key)
+    RETURNING trip_key
+""")
+
+class Interned:
+    """Keys handed out by write(); remember() them once the transaction has committed."""
+
+    def __init__(self, trip_keys, stop_keys):
+        self.trip_keys = trip_keys
+        self.stop_keys = stop_keys
+
+    def remember(self):
+        # Not before commit: a rolled-back insert's key can be handed out again
+        with _lock:
+            for trip_id, (key, touched) in self.trip_keys.items():
+                _trip_keys[trip_id] = [key, touched]
+            for stop_id, key in self.stop_keys.items():
+                _stop_keys[stop_id] = key
+        # Readers in this process (the history store) find them without a query
+        _fill([(key, trip_id) for trip_id, (key, _) in self.trip_keys.items()],
+              [(key, stop_id) for stop_id, key in self.stop_keys.items()])
+
+def _intern_trips(conn, trip_rows, now):
+    """trip_id -> [trip_key, last_seen written] for every trip row."""
+    keys = {}
+    missing = []
+    touch = []
+    with _lock:
+        for row in trip_rows:
+            cached = _trip_keys.get(row[0])
+            if cached is None:
+                missing.append(row + (now,))
+            elif cached[1] < now - TRIP_TOUCH_SECONDS:
+                keys[row[0]] = [cached[0], now]
+                touch.append((now, cached[0]))
+            else:
+                keys[row[0]] = cached
+    # Known trips keep their first route/start time, as before; only last_seen moves
+    for trip_id, key in insert_returning(conn, "trips", ("trip_id", "route_id", "start_time", "direction_id", "last_seen"),
+                                         missing, conflict="trip_id", update="last_seen",
+                                         returning="trip_id, trip_key"):
+        keys[trip_id] = [key, now]
+    run_many(conn, _TOUCH_TRIP, touch)
+    return keys
+
+def _intern_stops(conn, stop_ids):
+    keys = {}
+    missing = []
+    with _lock:
+        for stop_id in stop_ids:
+            key = _stop_keys.get(stop_id)
+            if key is None:
+                missing.append((stop_id,))
+            else:
+                keys[stop_id] = key
+    for stop_id, key in insert_returning(conn, "stops", ("stop_id",), missing, conflict="stop_id",
+                                         update="stop_id", returning="stop_id, stop_key"):
+        keys[stop_id] = key
+    return keys
+
+def write(conn, trip_rows, insert_rows, moves, now):
+    """
+    Store trips and position changes by key: trip_rows are (trip_id, route_id,
+    start_time, direction_id), insert_rows POSITION_COLUMNS rows with trip_id and
+    stop_id strings, moves (new_ts, trip_id, old_ts). Every trip referenced must be
+    in trip_rows. Does not commit; returns an Interned to remember() after commit.
+    """
+    trip_keys = _intern_trips(conn, trip_rows, now)
+    stop_keys = _intern_stops(conn, {row[2] for row in insert_rows})
+    insert_positions(conn, [(trip_keys[row[0]][0], row[1], stop_keys[row[2]]) + tuple(row[3:])
+                            for row in insert_rows])
+    move_positions(conn, [(new_ts, trip_keys[trip_id][0], old_ts) for new_ts, trip_id, old_ts in moves])
+    return Interned(trip_keys, stop_keys)
+
+# --- Reading ---
+
+def _missing(rows, col, known):
+    return {row[col] for row in rows if row[col] not in known}
+
+def _merged(cache, found):
+    if len(cache) + len(found) > REVERSE_CACHE_LIMIT:
+        # A new dict: decodes already holding the old one still finish (see _resolved)
+        cache = {}
+    cache.update(found)
+    return cache
+
+def _fill(trips, stops):
+    """Add (key, id) rows to the reverse caches, starting over when one is full."""
+    global _trip_ids, _stop_ids
+    with _lock:
+        _trip_ids = _merged(_trip_ids, trips)
+        _stop_ids = _merged(_stop_ids, stops)
+
+def _resolved(known, found):
+    """
+    A reverse cache read before a decode's misses were looked up, plus what the
+    lookup found. Caches are only ever added to, so it still holds every key the
+    decode counted on, even if a fill started a new one in between.
+    """
+    known.update(found)
+    return known
+
+def _decoded(rows, trip_col, stop_col, trip_ids, stop_ids):
+    out = []
+    for row in rows:
+        row = list(row)
+        row[trip_col] = trip_ids[row[trip_col]]
+        row[stop_col] = stop_ids[row[stop_col]]
+        out.append(tuple(row))
+    return out
+
+def decode(conn, rows, trip_col, stop_col):
+    """Rows with trip_key/stop_key at the given columns, as tuples with trip_id/stop_id instead."""
+    trip_ids, stop_ids = _trip_ids, _stop_ids
+    trips = _missing(rows, trip_col, trip_ids)
+    stops = _missing(rows, stop_col, stop_ids)
+    # Keys come from sequences, so one range query from the lowest unknown key covers the rest
+    found_trips = fetch(conn, _TRIPS_FROM, (min(trips),)) if trips else []
+    found_stops = fetch(conn, _STOPS_FROM, (min(stops),)) if stops else []
+    _fill(found_trips, found_stops)
+    return _decoded(rows, trip_col, stop_col, _resolved(trip_ids, found_trips), _resolved(stop_ids, found_stops))
+
+async def decode_async(rows, trip_col, stop_col):
+    """decode() through db.fetch_all."""
+    trip_ids, stop_ids = _trip_ids, _stop_ids
+    trips = _missing(rows, trip_col, trip_ids)
+    stops = _missing(rows, stop_col, stop_ids)
+    found_trips = await fetch_all(_TRIPS_FROM, (min(trips),)) if trips else []
+    found_stops = await fetch_all(_STOPS_FROM, (min(stops),)) if stops else []
+    _fill(found_trips, found_stops)
+    return _decoded(rows, trip_col, stop_col, _resolved(trip_ids, found_trips), _resolved(stop_ids, found_stops))
+
+# --- Retention ---
+
+def prune_trips(conn, now):
+    """Delete trips unseen for TRIP_RETENTION that no position references. Commits. Returns the count."""
+    cutoff = now - TRIP_RETENTION
+    with _lock:
+        # Cached keys must stay valid: forget the trips that are about to go
+        for trip_id in [t for t, (_, touched) in _trip_keys.items() if touched < cutoff]:
+            del _trip_keys[trip_id]
+    try:
+        deleted = fetch(conn, _PRUNE_TRIPS, (cutoff,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(deleted)
@@ -0,0 +1,227 @@
+"""
+Append-only archive of the raw GTFS-realtime snapshots the poller fetches, so
+changes to distance mapping or dwell logic can be re-applied to old data
+(see reprocess.py).
+
+Layout, one segment per feed per hour (by fetch time):
+
+    <FEED_ARCHIVE_DIR>/<feed>/<hour start>.zst        snapshots, one zstd frame each
+    <FEED_ARCHIVE_DIR>/<feed>/<hour start>.zst.idx    one INDEX_RECORD per snapshot
+
+Without zstandard installed, segments are .gz files of one gzip member per
+snapshot instead. Frames are independent, so any snapshot can be read from its
+index entry alone. The index entry is written after the frame, so a crash
+leaves at most an unindexed tail that readers never see.
+
+The poller only queues snapshots (submit); a writer thread compresses and
+writes them, and drops them if it falls behind rather than slowing polling.
+"""
+import os
+import gzip
+import queue
+import struct
+import threading
+import time
+import logging
+import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Empty disables archiving
+ARCHIVE_DIR = os.environ.get("FEED_ARCHIVE_DIR", "")
+# Segments older than this are deleted by the retention job; 0 keeps them forever
+ARCHIVE_RETENTION_DAYS = float(os.environ.get("FEED_ARCHIVE_RETENTION_DAYS", "0"))
+SEGMENT_SECONDS = 60 * 60
+# Snapshots waiting for the writer thread; past this, new ones are dropped
+QUEUE_SIZE = 256
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+
+# fetched_at (epoch seconds), FeedHeader timestamp (0 if missing), offset, length
+INDEX_RECORD = struct.Struct("<dqQI")
+
+ARCHIVE_SNAPSHOTS = metrics.Counter(
+    "stringlines_archive_snapshots_total", "Snapshots by archive outcome: written, dropped (queue full), failed",
+    ("feed", "result"),
+)
+ARCHIVE_BYTES = metrics.Counter("stringlines_archive_bytes_total", "Archived bytes, raw and compressed", ("kind",))
+
+def _extension():
+    return ".zst" if zstandard is not None else ".gz"
+
+def segment_start(ts):
+    return int(ts // SEGMENT_SECONDS) * SEGMENT_SECONDS
+
+class ArchiveWriter:
+    """Background thread appending queued snapshots to the current segment of each feed."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._segments = {}  # feed -> (segment start, data file, index file)
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if zstandard is not None else None
+        self._thread = threading.Thread(target=self._run, name="feed-archive", daemon=True)
+        self._thread.start()
+
+    def submit(self, feed, header_ts, content, fetched_at):
+        """Queue one snapshot; never blocks. Returns False if it was dropped."""
+        try:
+            self._queue.put_nowait((feed, header_ts, content, fetched_at))
+            return True
+        except queue.Full:
+            ARCHIVE_SNAPSHOTS.inc(feed=feed, result="dropped")
+            return False
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def close(self):
+        """Write what is queued, then stop the thread and close the segments."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _compress(self, content):
+        if self._compressor is not None:
+            return self._compressor.compress(content)
+        return gzip.compress(content, compresslevel=GZIP_LEVEL, mtime=0)
+
+    def _segment(self, feed, fetched_at):
+        start = segment_start(fetched_at)
+        current = self._segments.get(feed)
+        if current and current[0] == start:
+            return current
+        if current:
+            current[1].close()
+            current[2].close()
+        path = os.path.join(self.directory, feed, f"{start}{_extension()}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        current = self._segments[feed] = (start, open(path, "ab"), open(path + ".idx", "ab"))
+        return current
+
+    def _write(self, feed, header_ts, content, fetched_at):
+        frame = self._compress(content)
+        _, data, index = self._segment(feed, fetched_at)
+        # Append mode: tell() is the end of the file, past any torn frame from a crash
+        offset = data.tell()
+        data.write(frame)
+        data.flush()
+        index.write(INDEX_RECORD.pack(fetched_at, header_ts or 0, offset, len(frame)))
+        index.flush()
+        ARCHIVE_BYTES.inc(len(content), kind="raw")
+        ARCHIVE_BYTES.inc(len(frame), kind="compressed")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+                ARCHIVE_SNAPSHOTS.inc(feed=item[0], result="written")
+            except Exception as e:
+                logger.error(f"Failed to archive snapshot of {item[0]}: {e}")
+                ARCHIVE_SNAPSHOTS.inc(feed=item[0], result="failed")
+        for _, data, index in self._segments.values():
+            data.close()
+            index.close()
+        self._segments = {}
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def _pending():
+    writer = _writer
+    return {(): writer.pending() if writer is not None else 0}
+
+ARCHIVE_QUEUE = metrics.Gauge("stringlines_archive_queue", "Snapshots waiting for the archive writer", callback=_pending)
+
+def submit(feed, header_ts, content, fetched_at):
+    """Archive a snapshot in the background if FEED_ARCHIVE_DIR is set."""
+    global _writer
+    if not ARCHIVE_DIR:
+        return
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ArchiveWriter(ARCHIVE_DIR)
+                logger.info(f"Archiving feed snapshots to {ARCHIVE_DIR}")
+    _writer.submit(feed, header_ts, content, fetched_at)
+
+def close():
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+# --- Reading ---
+
+def list_segments(directory, since=None, until=None, feeds=None):
+    """[(feed, segment start, path)] of segments overlapping [since, until), oldest first."""
+    segments = []
+    for feed in sorted(os.listdir(directory)):
+        if feeds and feed not in feeds:
+            continue
+        feed_dir = os.path.join(directory, feed)
+        if not os.path.isdir(feed_dir):
+            continue
+        for name in os.listdir(feed_dir):
+            stem, ext = os.path.splitext(name)
+            if ext not in (".zst", ".gz") or not stem.isdigit():
+                continue
+            start = int(stem)
+            if since is not None and start + SEGMENT_SECONDS <= since:
+                continue
+            if until is not None and start >= until:
+                continue
+            segments.append((feed, start, os.path.join(feed_dir, name)))
+    segments.sort(key=lambda s: (s[1], s[0]))
+    return segments
+
+def read_index(path):
+    """[(fetched_at, header_ts, offset, length)] for a segment; a torn trailing record is ignored."""
+    try:
+        with open(path + ".idx", "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return []
+    usable = len(raw) - len(raw) % INDEX_RECORD.size
+    return list(INDEX_RECORD.iter_unpack(raw[:usable]))
+
+def read_segment(path, since=None, until=None):
+    """Yield (fetched_at, header_ts, content) for each snapshot fetched in [since, until)."""
+    zstd = path.endswith(".zst")
+    if zstd and zstandard is None:
+        raise RuntimeError(f"{path} needs the zstandard package")
+    decompressor = zstandard.ZstdDecompressor() if zstd else None
+    with open(path, "rb") as f:
+        for fetched_at, header_ts, offset, length in read_index(path):
+            if (since is not None and fetched_at < since) or (until is not None and fetched_at >= until):
+                continue
+            f.seek(offset)
+            frame = f.read(length)
+            content = decompressor.decompress(frame) if zstd else gzip.decompress(frame)
+            yield fetched_at, header_ts or None, content
+
+def prune(directory, before):
+    """Delete segments that ended before `before`. Returns the number deleted."""
+    deleted = 0
+    for _, start, path in list_segments(directory, until=before):
+        if start + SEGMENT_SECONDS > before:
+            continue
+        for p in (path, path + ".idx"):
+            if os.path.exists(p):
+                os.remove(p)
+        deleted += 1
+    return deleted
+
+def run_retention(now=None):
+    """Apply FEED_ARCHIVE_RETENTION_DAYS, if archiving and retention are both on."""
+    if not ARCHIVE_DIR or not ARCHIVE_RETENTION_DAYS or not os.path.isdir(ARCHIVE_DIR):
+        return 0
+    now = time.time() if now is None else now
+    return prune(ARCHIVE_DIR, now - ARCHIVE_RETENTION_DAYS * 86400)
@@ -1,5 +1,6 @@
 import csv
 import os
+import pickle
 import logging
 from config import SUBWAY_DATA
 
@@ -9,27 +10,93 @@ GTFS_DIR = os.environ.get("GTFS_DIR", "gtfs_subway")
 STOPS_FILE = os.path.join(GTFS_DIR, 'stops.txt')
 TRIPS_FILE = os.path.join(GTFS_DIR, 'trips.txt')
 STOP_TIMES_FILE = os.path.join(GTFS_DIR, 'stop_times.txt')
+ROUTES_FILE = os.path.join(GTFS_DIR, 'routes.txt')
+
+# Compiled index shared by the web app and the ingestor; rebuilt when the GTFS files change
+INDEX_FILE = os.environ.get("GTFS_INDEX_FILE", os.path.join(GTFS_DIR, '.gtfs_index.pickle'))
+INDEX_VERSION = 2  # Bump when the index layout or the way it is computed changes
 
 # _STATION_MAP = {} # DEPRECATED: Global map causes collisions
 _ROUTE_STATION_MAP = {} # route_id -> {stop_id -> distance}
 _ROUTE_STATIONS = {} # route_id -> set(stop_ids)
 _STOPS_INFO = {} # stop_id -> stop_name
+_ROUTE_TERMINALS = {} # route_id -> set(stop_ids) of first/last stations
+_BASE_STOPS = {} # stop_id -> stop_id without direction suffix
 
 def load_data():
-    global _ROUTE_STATION_MAP, _STATIONS_LIST, _ROUTE_STATIONS, _STOPS_INFO
+    global _ROUTE_STATION_MAP, _STATIONS_LIST, _ROUTE_STATIONS, _STOPS_INFO, _ROUTE_TERMINALS, _BASE_STOPS
     
     if not os.path.exists(GTFS_DIR):
         logger.error(f"GTFS directory {GTFS_DIR} not found!")
         return
 
-    logger.info("Loading GTFS data...")
-    
+    index = _load_index()
+    if index is None:
+        logger.info("Loading GTFS data...")
+        index = _build_index()
+        _save_index(index)
+
+    _STOPS_INFO = index["stops_info"]
+    _ROUTE_STATION_MAP = index["route_station_map"]
+    _ROUTE_TERMINALS = index["route_terminals"]
+    _BASE_STOPS = index["base_stops"]
+
+    # Check loaded stats
+    total_stations = sum(len(m) for m in _ROUTE_STATION_MAP.values())
+    logger.info(f"Loaded {len(_ROUTE_STATION_MAP)} route maps with {total_stations} total entries.")
+
+def _source_fingerprint():
+    """Size and mtime of every GTFS file the index is built from."""
+    fingerprint = []
+    for path in (STOPS_FILE, ROUTES_FILE, TRIPS_FILE, STOP_TIMES_FILE):
+        try:
+            st = os.stat(path)
+            fingerprint.append((os.path.basename(path), st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            fingerprint.append((os.path.basename(path), None, None))
+    return fingerprint
+
+def _load_index():
+    """Return the compiled index if it exists and matches the current GTFS files."""
+    try:
+        with open(INDEX_FILE, 'rb') as f:
+            index = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable GTFS index {INDEX_FILE}: {e}")
+        return None
+
+    if index.get("version") != INDEX_VERSION or index.get("sources") != _source_fingerprint():
+        logger.info("GTFS files changed, rebuilding index.")
+        return None
+    logger.info(f"Using compiled GTFS index {INDEX_FILE}")
+    return index
+
+def _save_index(index):
+    # Write to a temp file and rename, so a process starting concurrently never reads half a file
+    tmp_path = f"{INDEX_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, INDEX_FILE)
+        logger.info(f"Saved compiled GTFS index to {INDEX_FILE}")
+    except OSError as e:
+        # e.g. read-only GTFS volume; we still have the data in memory
+        logger.warning(f"Could not save GTFS index: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _build_index():
+    """Parse the GTFS text files into the lookups used at runtime."""
+    sources = _source_fingerprint()
+
     # 1. Load Stops
-    _STOPS_INFO = {}
+    stops_info = {}
     with open(STOPS_FILE, 'r') as f:
         reader = csv.DictReader(f)
         for row in reader:
-            _STOPS_INFO[row['stop_id']] = row['stop_name']
+            stops_info[row['stop_id']] = row['stop_name']
 
     # 2. Identify enabled routes from config
     enabled_routes = set()
@@ -48,67 +115,32 @@ def load_data():
     # but the config is good for the frontend grouping.
     
     routes_in_gtfs = []
-    with open(os.path.join(GTFS_DIR, 'routes.txt'), 'r') as f:
+    with open(ROUTES_FILE, 'r') as f:
         reader = csv.DictReader(f)
         for row in reader:
             rid = row['route_id']
             if rid not in ['SI']: # Exclude SIR
                 routes_in_gtfs.append(rid)
 
-    # 3. Find candidate trips (Longest for each route)
-    # Store tuples of (trip_id, direction_id)
-    candidate_trips = {r: [] for r in routes_in_gtfs}
-    
-    with open(TRIPS_FILE, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            rid = row['route_id']
-            if rid in routes_in_gtfs:
-                # Store trip_id AND direction_id
-                candidate_trips[rid].append((row['trip_id'], row['direction_id']))
-                
-    # Limit candidates for performance
-    all_candidate_trip_ids = set()
-    for rid in routes_in_gtfs:
-        # Take first 100
-        for tid, _ in candidate_trips[rid][:100]:
-            all_candidate_trip_ids.add(tid)
-            
-    # 4. Scan stop_times to find sequences
-    trip_stops_map = {tid: [] for tid in all_candidate_trip_ids}
-    with open(STOP_TIMES_FILE, 'r') as f:
-        reader = csv.DictReader(f)
+    # 3. Map every trip of those routes to (route_id, direction_id)
+    route_set = set(routes_in_gtfs)
+    trip_info = {}
+    with open(TRIPS_FILE, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        route_col, trip_col, dir_col = header.index('route_id'), header.index('trip_id'), header.index('direction_id')
         for row in reader:
-            tid = row['trip_id']
-            if tid in all_candidate_trip_ids:
-                trip_stops_map[tid].append((int(row['stop_sequence']), row['stop_id']))
-                
-    route_sequences = {}
+            if row[route_col] in route_set:
+                trip_info[row[trip_col]] = (row[route_col], row[dir_col])
+
+    # 4. Stream stop_times once, keeping only the longest sequence per route
+    route_sequences = _longest_route_sequences(trip_info)
     for rid in routes_in_gtfs:
-        best_seq = []
-        candidates = candidate_trips[rid][:100]
-        
-        for tid, direction_id in candidates:
-            seq = trip_stops_map.get(tid, [])
-            seq.sort() # Sort by stop_sequence
-            stop_ids = [s[1] for s in seq]
-            
-            # Canonicalize direction:
-            # We want uniform North -> South ordering (0 -> 100 on Y-axis).
-            # Southbound trips (`direction_id=1`) normally go NorthStation -> SouthStation.
-            # Northbound trips (`direction_id=0`) normally go SouthStation -> NorthStation.
-            # If we find a Northbound trip is the longest, we must REVERSE it to match the North->South visual flow.
-            if direction_id == '0':
-                stop_ids.reverse()
-                
-            if len(stop_ids) > len(best_seq):
-                best_seq = stop_ids
-                
-        route_sequences[rid] = best_seq
-        logger.info(f"Route {rid}: Found sequence with {len(best_seq)} stops")
+        route_sequences.setdefault(rid, [])
+        logger.info(f"Route {rid}: Found sequence with {len(route_sequences[rid])} stops")
 
     # 5. Build per-route station maps
-    _ROUTE_STATION_MAP = {} # route_id -> {stop_id -> distance}
+    route_station_map = {} # route_id -> {stop_id -> distance}
     
     for rid in routes_in_gtfs:
         if rid not in route_sequences:
@@ -146,11 +178,17 @@ def load_data():
             for stop_id in station_dist:
                 station_dist[stop_id] = ((station_dist[stop_id] - min_dist) / dist_range) * 200
         
-        _ROUTE_STATION_MAP[rid] = station_dist
+        route_station_map[rid] = station_dist
 
-    # Check loaded stats
-    total_stations = sum(len(m) for m in _ROUTE_STATION_MAP.values())
-    logger.info(f"Loaded {len(_ROUTE_STATION_MAP)} route maps with {total_stations} total entries.")
+    # 6. Precompute lookups used on every history request
+    return {
+        "version": INDEX_VERSION,
+        "sources": sources,
+        "stops_info": stops_info,
+        "route_station_map": route_station_map,
+        "route_terminals": {rid: _terminals_from_map(m) for rid, m in route_station_map.items()},
+        "base_stops": {stop_id: _base_stop_id(stop_id) for stop_id in stops_info},
+    }
 
 def get_station_distance(stop_id, route_id):
     """
@@ -191,15 +229,90 @@ def get_stations_list(route_id=None):
         
     return []
 
+def _base_stop_id(stop_id):
+    return stop_id[:-1] if len(stop_id) > 3 else stop_id
+
+def get_base_stop_id(stop_id):
+    """Strip the N/S platform suffix, e.g. R30S -> R30."""
+    base = _BASE_STOPS.get(stop_id)
+    if base is None:
+        base = _base_stop_id(stop_id)
+    return base
+
+def is_known_route(route_id):
+    """True if route_id has a station map, i.e. the poller can store positions for it."""
+    return route_id in _ROUTE_STATION_MAP
+
 def get_terminal_stations(route_id):
     """Returns a set of stop_ids that are terminals (start/end) for the route."""
-    stations = get_stations_list(route_id)
-    if not stations:
+    return _ROUTE_TERMINALS.get(route_id, set())
+
+def _longest_route_sequences(trip_info):
+    """
+    Single pass over stop_times.txt: route_id -> longest stop sequence over all its trips.
+
+    Rows are read as plain lists with column positions looked up once. Only the trip
+    being read and each route's longest trip so far are held, so memory is bounded
+    by one trip plus one sequence per route, whatever the file size.
+    GTFS feeds list each trip's stop_times contiguously, and this relies on it. If a
+    route's longest trip shows up again later, its pieces are joined and a warning
+    is logged. Other split trips are judged piece by piece.
+    """
+    best = {}  # route_id -> (trip_id, direction_id, [(stop_sequence, stop_id)]) of its longest trip
+    warned = False
+
+    def finish_trip(tid, stops):
+        nonlocal warned
+        info = trip_info.get(tid)
+        if not info or not stops:
+            return
+        rid, direction_id = info
+        held = best.get(rid)
+        if held and held[0] == tid:
+            if not warned:
+                warned = True
+                logger.warning(f"stop_times.txt is not grouped by trip_id ({tid} appears twice); "
+                               "split trips other than each route's longest are compared piece by piece")
+            stops = held[2] + stops
+        if not held or len(stops) > len(held[2]):
+            best[rid] = (tid, direction_id, stops)
+
+    current_tid = None
+    current_stops = []
+    with open(STOP_TIMES_FILE, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        trip_col, stop_col, seq_col = header.index('trip_id'), header.index('stop_id'), header.index('stop_sequence')
+        for row in reader:
+            tid = row[trip_col]
+            if tid != current_tid:
+                finish_trip(current_tid, current_stops)
+                current_tid = tid
+                current_stops = []
+            if tid in trip_info:
+                current_stops.append((int(row[seq_col]), row[stop_col]))
+        finish_trip(current_tid, current_stops)
+
+    sequences = {}  # route_id -> stop_ids, canonicalized North -> South
+    for rid, (_, direction_id, stops) in best.items():
+        stops.sort() # Sort by stop_sequence
+        stop_ids = [s[1] for s in stops]
+
+        # Canonicalize direction:
+        # We want uniform North -> South ordering (0 -> 100 on Y-axis).
+        # Southbound trips (`direction_id=1`) normally go NorthStation -> SouthStation.
+        # Northbound trips (`direction_id=0`) normally go SouthStation -> NorthStation.
+        # If we find a Northbound trip is the longest, we must REVERSE it to match the North->South visual flow.
+        if direction_id == '0':
+            stop_ids.reverse()
+        sequences[rid] = stop_ids
+
+    return sequences
+
+def _terminals_from_map(route_map):
+    """First and last station by distance (same order as get_stations_list)."""
+    if not route_map:
         return set()
-    
-    terminals = set()
-    if stations:
-        terminals.add(stations[0]['id'])
-        terminals.add(stations[-1]['id'])
-        
-    return terminals
+
+    stations = sorted(route_map.items(), key=lambda x: round(x[1], 1))
+    return {stations[0][0], stations[-1][0]}
@@ -0,0 +1,227 @@
+import time
+import numpy as np
+import gtfs_loader
+import history_store
+
+HISTORY_MINUTES = 30
+MAX_HISTORY_MINUTES = 24 * 60  # What the DB keeps (db.RETENTION_SECONDS)
+# Requested windows round up and resolutions round down to these, so the payloads
+# cached per (line, window, resolution) stay few and are shared between viewers
+WINDOW_TIERS = (5, 15, 30, 60, 120, 180, 360, 720, MAX_HISTORY_MINUTES)  # minutes
+RESOLUTION_TIERS = (10, 30, 60, 120, 300, 600, 1800, 3600)  # seconds
+
+# Dwell rules: consecutive points closer than this are the same stop, and a dwell
+# longer than TERMINAL_DWELL_SECONDS at a terminal is collapsed to its last point
+SAME_DISTANCE = 0.01
+TERMINAL_DWELL_SECONDS = 180
+
+_terminal_flags = {}  # route_id -> bool array indexed by interned stop slot
+
+def terminal_flags(route_id):
+    """Which interned stop slots are terminals of route_id (extended as new stops appear)."""
+    stop_ids = history_store.get_stop_ids()
+    flags = _terminal_flags.get(route_id)
+    if flags is None or len(flags) < len(stop_ids):
+        terminals = gtfs_loader.get_terminal_stations(route_id)
+        flags = np.fromiter(
+            (gtfs_loader.get_base_stop_id(stop_id) in terminals for stop_id in list(stop_ids)),
+            dtype=bool,
+        )
+        _terminal_flags[route_id] = flags
+    return flags
+
+def trip_order(ts, trips):
+    """
+    Indices that group points by trip, with trips in order of their first point
+    and each trip's points in time order (same as sorting rows by timestamp, then grouping).
+    """
+    order = np.argsort(ts, kind="stable")
+    t = trips[order]
+    if len(t) == 0:
+        return order
+    uniq, first = np.unique(t, return_index=True)
+    rank = np.zeros(uniq[-1] + 1, dtype=np.int64)
+    rank[uniq[np.argsort(first)]] = np.arange(len(uniq))
+    return order[np.argsort(rank[t], kind="stable")]
+
+def filter_dwells(ts, dist, trips, terminal):
+    """
+    Filter out "stuck" trains (long dwells > 3 mins) ONLY AT TERMINALS.
+    This prevents flat lines at terminals from dominating the chart
+    while preserving legitimate delays at other stations.
+
+    Works on whole arrays grouped by trip (see trip_order). A dwell is a run of
+    points with the same distance. Returns (keep mask, index of each point's run start).
+    """
+    n = len(ts)
+    if n == 0:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=np.int64)
+    new_run = np.ones(n, dtype=bool)
+    new_run[1:] = (trips[1:] != trips[:-1]) | (np.abs(np.diff(dist)) >= SAME_DISTANCE)
+
+    starts = np.flatnonzero(new_run)
+    ends = np.append(starts[1:], n) - 1
+    # Long dwell AT TERMINAL: Keep only the last point (hide the flat line)
+    collapse = ((ts[ends] - ts[starts]) > TERMINAL_DWELL_SECONDS) & terminal[starts]
+
+    run_id = np.cumsum(new_run) - 1
+    keep = ~collapse[run_id]
+    keep[ends[collapse]] = True
+    return keep, starts[run_id]
+
+def _prepare(line, columns):
+    """Sort columns by trip and time and run the dwell filter."""
+    ts, dist, trips, stops, seqs, trip_ids, directions = columns
+    order = trip_order(ts, trips)
+    ts, dist, trips, stops, seqs = ts[order], dist[order], trips[order], stops[order], seqs[order]
+    keep, run_start = filter_dwells(ts, dist, trips, terminal_flags(line)[stops])
+    return ts, dist, trips, stops, seqs, keep, run_start
+
+def _trip_bounds(trips):
+    """(start, end) slices of each trip in an array grouped by trip."""
+    bounds = np.flatnonzero(trips[1:] != trips[:-1]) + 1
+    starts = [0] + bounds.tolist()
+    ends = bounds.tolist() + [len(trips)]
+    return zip(starts, ends)
+
+def downsample(ts, trips, resolution):
+    """
+    Mask keeping each trip's first point and its last point in every
+    resolution-second bucket (arrays grouped by trip, in time order).
+    """
+    n = len(ts)
+    keep = np.ones(n, dtype=bool)
+    if n < 2:
+        return keep
+    bucket = np.floor(ts / resolution)
+    same_trip = trips[1:] == trips[:-1]
+    keep[:-1] = ~(same_trip & (bucket[1:] == bucket[:-1]))
+    keep[1:] |= ~same_trip
+    return keep
+
+def _positions(ts, dist, stops, stop_ids):
+    return [
+        {"timestamp": t, "distance": d, "stop_id": stop_ids[s]}
+        for t, d, s in zip(ts.tolist(), dist.tolist(), stops.tolist())
+    ]
+
+def build_history(line, minutes=HISTORY_MINUTES, resolution=None):
+    """Trips of the last `minutes` (up to the in-memory window), optionally downsampled to `resolution` seconds."""
+    cutoff = time.time() - (minutes * 60)
+
+    # Served from memory; the store syncs itself from the DB when needed
+    columns = history_store.get_columns(line, cutoff)
+    if columns is None:
+        return []
+    return _build_trips(line, columns, resolution)
+
+def build_history_from_rollup(line, rollup, minutes, resolution=None):
+    """Same as build_history, for longer windows: cut from history_store.route_rollup."""
+    cutoff = time.time() - (minutes * 60)
+    return _build_trips(line, history_store.slice_columns(rollup, cutoff), resolution)
+
+def snap_window(minutes):
+    """The smallest tier covering minutes."""
+    return next((tier for tier in WINDOW_TIERS if tier >= minutes), MAX_HISTORY_MINUTES)
+
+def snap_resolution(resolution):
+    """The nearest tier at or below resolution; None (every point) below the finest."""
+    finer = [tier for tier in RESOLUTION_TIERS if tier <= (resolution or 0)]
+    return finer[-1] if finer else None
+
+def _build_trips(line, columns, resolution=None):
+    trip_ids, directions = columns[5], columns[6]
+    stop_ids = history_store.get_stop_ids()
+
+    ts, dist, trips, stops, _, keep, _ = _prepare(line, columns)
+    ts, dist, trips, stops = ts[keep], dist[keep], trips[keep], stops[keep]
+    if resolution:
+        keep = downsample(ts, trips, resolution)
+        ts, dist, trips, stops = ts[keep], dist[keep], trips[keep], stops[keep]
+
+    final_trips = []
+    if len(ts) == 0:
+        return final_trips
+    for start, end in _trip_bounds(trips):
+        # Only include trip if it has at least 2 points (needed to draw a line)
+        if end - start < 2:
+            continue
+        tid = trip_ids[trips[start]]
+        final_trips.append({
+            "trip_id": tid,
+            "route_id": line,
+            "direction_id": directions[tid],
+            "positions": _positions(ts[start:end], dist[start:end], stops[start:end], stop_ids),
+        })
+    return final_trips
+
+# Delta cursors are "<store epoch>:<seq>:<cutoff>:<newest timestamp>", opaque to clients
+def parse_cursor(cursor):
+    try:
+        epoch, seq, cutoff, *watermark = cursor.split(":")
+        # Cursors from before the watermark was added have none
+        return epoch, int(seq), float(cutoff), float(watermark[0]) if watermark else None
+    except (AttributeError, ValueError, IndexError):
+        return None, 0, 0.0, None
+
+def build_history_delta(line, cursor=None):
+    """
+    Changes since a cursor returned by a previous call (or everything, without one).
+
+    For each changed trip, "since" is the timestamp from which the client should
+    replace its positions with the ones sent (null means replace all). Clients also
+    drop points at or before "cutoff" and trips listed in "removed".
+    """
+    cutoff = time.time() - (HISTORY_MINUTES * 60)
+    epoch, seq, old_cutoff, watermark = parse_cursor(cursor)
+    new_epoch, new_seq, latest, columns, aged_out, after_ts = history_store.get_changes(
+        line, epoch, seq, old_cutoff, cutoff, watermark
+    )
+    if new_epoch != epoch:
+        seq = 0
+    # Another store's cursor with a watermark is resynced from it rather than reset
+    reset = new_epoch != epoch and after_ts is None
+
+    changed = []
+    removed = list(aged_out)
+
+    if columns is not None and len(columns[0]):
+        trip_ids, directions = columns[5], columns[6]
+        stop_ids = history_store.get_stop_ids()
+        ts, dist, trips, stops, seqs, keep, run_start = _prepare(line, columns)
+
+        for start, end in _trip_bounds(trips):
+            tid = trip_ids[trips[start]]
+            kept = np.flatnonzero(keep[start:end]) + start
+            if len(kept) < 2:
+                removed.append(tid)
+                continue
+
+            since = None
+            if not reset:
+                # Replace from the start of the dwell run holding the first changed point,
+                # since the terminal-dwell filter works on whole runs
+                newer = seqs[start:end] > seq if after_ts is None else ts[start:end] > after_ts
+                first_changed = start + int(np.argmax(newer))
+                since_ts = ts[run_start[first_changed]]
+                tail = kept[ts[kept] >= since_ts]
+                # Client may not have this trip yet (it had < 2 points), send it whole
+                if len(kept) - len(tail) >= 2:
+                    since = float(since_ts)
+                    kept = tail
+
+            changed.append({
+                "trip_id": tid,
+                "route_id": line,
+                "direction_id": directions[tid],
+                "positions": _positions(ts[kept], dist[kept], stops[kept], stop_ids),
+                "since": since,
+            })
+
+    return {
+        "cursor": f"{new_epoch}:{new_seq}:{cutoff}:{latest}",
+        "reset": reset,
+        "cutoff": cutoff,
+        "trips": changed,
+        "removed": removed,
+    }
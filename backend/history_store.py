@@ -0,0 +1,460 @@
+import os
+import time
+import logging
+import uuid
+import asyncio
+import threading
+from array import array
+import numpy as np
+from db import get_db, statement, fetch, fetch_all
+import dimensions
+import notifications
+
+logger = logging.getLogger(__name__)
+
+# How much history is kept in memory (matches the /api/history window)
+HISTORY_WINDOW = int(os.environ.get("HISTORY_WINDOW", 30 * 60))
+# When this process doesn't run the poller, re-read new rows from the DB this often
+SYNC_INTERVAL = float(os.environ.get("HISTORY_SYNC_INTERVAL", "5"))
+# Re-read this far back on each sync to pick up moved dwell markers and late rows
+SYNC_LOOKBACK = 120
+# With update events from the ingestor (notifications.py), changed routes are synced
+# when announced, and everything only this often in case an event was lost
+SYNC_FALLBACK_INTERVAL = float(os.environ.get("HISTORY_SYNC_FALLBACK_INTERVAL", "60"))
+# After an event, wait this long for the rest of the poll cycle's commits (seconds)
+EVENT_COALESCE = 0.25
+
+class RouteHistory:
+    """
+    Recent positions for one route, held in parallel arrays.
+
+    Entries follow the same change-only rules as the poller: a new entry when a
+    trip reaches a new stop, then one dwell-end marker that is moved forward while
+    the train stays put. Applying the same row twice is a no-op, so DB syncs can overlap.
+    """
+
+    def __init__(self, route_id):
+        self.route_id = route_id
+        self.timestamps = array('d')
+        self.distances = array('d')
+        self.trip_slots = array('q')  # index into self.trip_ids
+        self.stop_slots = array('q')  # index into _stop_ids
+        self.seqs = array('q')  # change sequence number of each entry, for deltas
+        self.head = 0  # first entry still inside the window
+        self.offset = 0  # absolute index of timestamps[0], survives compaction
+        self.trip_ids = []
+        self.trip_index = {}  # trip_id -> slot
+        self.directions = {}  # trip_id -> direction_id
+        self.last_entry = {}  # trip_id -> (absolute index, is_dwell_marker)
+        self.generation = 0  # bumped whenever the data changes
+        self.seq = 0  # bumped for every appended or moved entry
+        self.epoch = uuid.uuid4().hex[:8]  # identifies this store in delta cursors
+        self.latest = 0.0  # newest timestamp stored; cursors carry it for other stores (see get_changes)
+        self.lock = threading.Lock()
+
+    def _trip_slot(self, trip_id):
+        slot = self.trip_index.get(trip_id)
+        if slot is None:
+            slot = len(self.trip_ids)
+            self.trip_ids.append(trip_id)
+            self.trip_index[trip_id] = slot
+        return slot
+
+    def append(self, trip_id, direction_id, ts, stop_id, dist):
+        """Apply one position. Returns True if the store changed."""
+        stop = _stop_slot(stop_id)
+        self.directions[trip_id] = direction_id
+
+        last = self.last_entry.get(trip_id)
+        if last is not None and last[0] >= self.offset + self.head:
+            i = last[0] - self.offset
+            if ts <= self.timestamps[i]:
+                return False
+            if self.stop_slots[i] == stop and last[1]:
+                # Train still dwelling: move the marker forward
+                self.timestamps[i] = ts
+                self.latest = max(self.latest, ts)
+                self.seq += 1
+                self.seqs[i] = self.seq
+                return True
+            is_marker = self.stop_slots[i] == stop
+        else:
+            is_marker = False
+
+        self.last_entry[trip_id] = (self.offset + len(self.timestamps), is_marker)
+        self.timestamps.append(ts)
+        self.latest = max(self.latest, ts)
+        self.distances.append(dist)
+        self.trip_slots.append(self._trip_slot(trip_id))
+        self.stop_slots.append(stop)
+        self.seq += 1
+        self.seqs.append(self.seq)
+        return True
+
+    def evict(self, cutoff):
+        n = len(self.timestamps)
+        while self.head < n and self.timestamps[self.head] <= cutoff:
+            self.head += 1
+        if self.head > 1024 and self.head * 2 > n:
+            self._compact()
+
+    def _compact(self):
+        """Drop evicted entries and forget trips that no longer have any."""
+        head = self.head
+        old_trip_ids = self.trip_ids
+        self.trip_ids = []
+        self.trip_index = {}
+        trip_slots = array('q', (self._trip_slot(old_trip_ids[s]) for s in self.trip_slots[head:]))
+
+        self.timestamps = self.timestamps[head:]
+        self.distances = self.distances[head:]
+        self.stop_slots = self.stop_slots[head:]
+        self.seqs = self.seqs[head:]
+        self.trip_slots = trip_slots
+        self.offset += head
+        self.head = 0
+
+        live = self.trip_index
+        self.directions = {tid: d for tid, d in self.directions.items() if tid in live}
+        self.last_entry = {tid: e for tid, e in self.last_entry.items() if tid in live}
+
+    def columns(self, cutoff, seq=0, after_ts=None):
+        """
+        NumPy copies of the entries after cutoff, in store order:
+        (timestamps, distances, trip_slots, stop_slots, seqs, trip_ids, directions).
+        With seq, only trips that have an entry changed after seq are included;
+        with after_ts, only trips that have an entry timestamped after it.
+        """
+        h = self.head
+        ts = np.frombuffer(self.timestamps[h:], dtype=np.float64)
+        dist = np.frombuffer(self.distances[h:], dtype=np.float64)
+        trips = np.frombuffer(self.trip_slots[h:], dtype=np.int64)
+        stops = np.frombuffer(self.stop_slots[h:], dtype=np.int64)
+        seqs = np.frombuffer(self.seqs[h:], dtype=np.int64)
+
+        mask = ts > cutoff
+        if seq or after_ts is not None:
+            newer = seqs > seq if after_ts is None else ts > after_ts
+            touched = np.zeros(len(self.trip_ids), dtype=bool)
+            touched[trips[mask & newer]] = True
+            mask &= touched[trips]
+
+        return (ts[mask], dist[mask], trips[mask], stops[mask], seqs[mask],
+                list(self.trip_ids), dict(self.directions))
+
+    def aged_out(self, old_cutoff, cutoff):
+        """Trips whose last entry fell out of the window between the two cutoffs."""
+        first = self.offset
+        return [
+            tid for tid, (index, _) in self.last_entry.items()
+            if index >= first and old_cutoff < self.timestamps[index - first] <= cutoff
+        ]
+
+# Stop ids are shared by all routes
+_stop_ids = []
+_stop_index = {}
+_stop_lock = threading.Lock()
+
+def _stop_slot(stop_id):
+    slot = _stop_index.get(stop_id)
+    if slot is None:
+        with _stop_lock:
+            slot = _stop_index.get(stop_id)
+            if slot is None:
+                slot = len(_stop_ids)
+                _stop_ids.append(stop_id)
+                _stop_index[stop_id] = slot
+    return slot
+
+_routes = {}  # route_id -> RouteHistory
+_routes_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_live = False  # True when the poller runs in this process and feeds us directly
+_last_sync = 0.0
+_route_synced = {}  # route_id -> time of its last event-driven sync
+_listeners = []  # called with the set of changed route_ids after each update
+
+def get_route(route_id):
+    route = _routes.get(route_id)
+    if route is None:
+        with _routes_lock:
+            route = _routes.setdefault(route_id, RouteHistory(route_id))
+    return route
+
+def get_generation(route_id):
+    route = _routes.get(route_id)
+    return route.generation if route else 0
+
+def get_version(route_id):
+    """(epoch, seq) of route_id's store: changes whenever an entry is added or moved."""
+    route = _routes.get(route_id)
+    return (route.epoch, route.seq) if route else None
+
+def add_listener(listener):
+    _listeners.append(listener)
+
+def set_live(live=True):
+    global _live
+    _live = live
+
+def record(rows):
+    """
+    Apply committed positions: (route_id, trip_id, direction_id, ts, stop_id, dist).
+    Returns the set of route_ids whose data changed.
+    """
+    by_route = {}
+    for row in rows:
+        by_route.setdefault(row[0], []).append(row)
+
+    cutoff = time.time() - HISTORY_WINDOW
+    changed = set()
+    for route_id, route_rows in by_route.items():
+        route = get_route(route_id)
+        with route.lock:
+            updated = False
+            for _, trip_id, direction_id, ts, stop_id, dist in route_rows:
+                if ts > cutoff and route.append(trip_id, direction_id, ts, stop_id, dist):
+                    updated = True
+            route.evict(cutoff)
+            if updated:
+                route.generation += 1
+                changed.add(route_id)
+
+    if changed:
+        for listener in _listeners:
+            listener(changed)
+    return changed
+
+def record_committed(rows):
+    """Called by the poller after each commit; only used when it runs in this process."""
+    if not _live:
+        return set()
+    return record(rows)
+
+# Rows come back in record()'s column order, with trip/stop keys (see dimensions.decode)
+LOAD_QUERY = statement("positions_since", """
+    SELECT route_id, trip_key, direction_id, timestamp, stop_key, distance
+    FROM positions
+    WHERE timestamp > ?
+    ORDER BY timestamp ASC
+""")
+
+def load_from_db(since):
+    with get_db(readonly=True) as conn:
+        rows = dimensions.decode(conn, fetch(conn, LOAD_QUERY, (since,)), 1, 4)
+    return record(rows)
+
+async def load_from_db_async(since):
+    return record(await dimensions.decode_async(await fetch_all(LOAD_QUERY, (since,)), 1, 4))
+
+# One route's window straight from the DB; served by the covering (route_id, timestamp) index
+ROUTE_WINDOW_QUERY = statement("route_window", """
+    SELECT trip_key, direction_id, timestamp, stop_key, distance
+    FROM positions
+    WHERE route_id = ? AND timestamp > ? AND timestamp <= ?
+    ORDER BY timestamp ASC
+""")
+
+async def fetch_route_window(route_id, since, until):
+    return await dimensions.decode_async(await fetch_all(ROUTE_WINDOW_QUERY, (route_id, since, until)), 0, 3)
+
+# Windows longer than the store are cut from one read of the route's last `span`
+# seconds, shared by every window and resolution until the generation moves on
+_rollups = {}  # route_id -> (generation, columns)
+_rollup_locks = {}  # route_id -> asyncio.Lock, so concurrent misses wait for one read
+
+async def route_rollup(route_id, generation, span):
+    """Columns (as columns_from_rows, in time order) of route_id's stored rows over the last span seconds."""
+    cached = _rollups.get(route_id)
+    if cached and cached[0] == generation:
+        return cached[1]
+    async with _rollup_locks.setdefault(route_id, asyncio.Lock()):
+        cached = _rollups.get(route_id)
+        if cached and cached[0] == generation:
+            return cached[1]
+        now = time.time()
+        rows = await fetch_route_window(route_id, now - span, now)
+        columns = await asyncio.to_thread(columns_from_rows, rows)
+        _rollups[route_id] = (generation, columns)
+        return columns
+
+def slice_columns(columns, cutoff):
+    """The entries of time-ordered columns after cutoff (trip_ids/directions are shared)."""
+    start = int(np.searchsorted(columns[0], cutoff, side="right"))
+    return tuple(column[start:] for column in columns[:5]) + tuple(columns[5:])
+
+def columns_from_rows(rows):
+    """ROUTE_WINDOW_QUERY rows as columns in the same layout as RouteHistory.columns."""
+    n = len(rows)
+    ts = np.empty(n, dtype=np.float64)
+    dist = np.empty(n, dtype=np.float64)
+    trips = np.empty(n, dtype=np.int64)
+    stops = np.empty(n, dtype=np.int64)
+    trip_index, trip_ids, directions = {}, [], {}
+    for i, (trip_id, direction_id, timestamp, stop_id, distance) in enumerate(rows):
+        slot = trip_index.get(trip_id)
+        if slot is None:
+            slot = trip_index[trip_id] = len(trip_ids)
+            trip_ids.append(trip_id)
+            directions[trip_id] = direction_id
+        ts[i] = timestamp
+        dist[i] = distance
+        trips[i] = slot
+        stops[i] = _stop_slot(stop_id)
+    return ts, dist, trips, stops, np.zeros(n, dtype=np.int64), trip_ids, directions
+
+def warm_load():
+    """Fill the store from the DB on startup."""
+    global _last_sync
+    started = time.time()
+    load_from_db(started - HISTORY_WINDOW)
+    _last_sync = started
+    total = sum(len(r.timestamps) - r.head for r in _routes.values())
+    logger.info(f"History store warm-loaded {total} positions for {len(_routes)} routes.")
+
+def _sync_interval():
+    return SYNC_FALLBACK_INTERVAL if notifications.is_listening() else SYNC_INTERVAL
+
+def _sync_since(started, route_id=None):
+    last = max(_last_sync, _route_synced.get(route_id, 0.0))
+    return max(last - SYNC_LOOKBACK, started - HISTORY_WINDOW)
+
+def sync():
+    """Pull rows written by another process (the ingestor) since the last sync."""
+    global _last_sync
+    started = time.time()
+    changed = load_from_db(_sync_since(started))
+    _last_sync = started
+    return changed
+
+async def sync_async():
+    """sync() on the async DB path."""
+    global _last_sync
+    started = time.time()
+    changed = await load_from_db_async(_sync_since(started))
+    _last_sync = started
+    return changed
+
+# One route's recent rows for event-driven syncs; served by the covering route index
+ROUTE_SYNC_QUERY = statement("route_positions_since", """
+    SELECT route_id, trip_key, direction_id, timestamp, stop_key, distance
+    FROM positions
+    WHERE route_id = ? AND timestamp > ?
+    ORDER BY timestamp ASC
+""")
+
+async def sync_routes_async(route_ids):
+    """Pull new rows for the routes an update event named."""
+    started = time.time()
+    results = await asyncio.gather(*(
+        fetch_all(ROUTE_SYNC_QUERY, (route_id, _sync_since(started, route_id))) for route_id in route_ids
+    ))
+    rows = [row for route_rows in results for row in route_rows]
+    changed = record(await dimensions.decode_async(rows, 1, 4)) if rows else set()
+    for route_id in route_ids:
+        _route_synced[route_id] = started
+    return changed
+
+async def sync_loop():
+    """
+    Keep the store current when the ingestor runs in another process: sync the
+    routes named by its update events, and everything every _sync_interval().
+    """
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    pending = set()
+
+    def queue_routes(route_ids):
+        pending.update(route_ids)
+        wakeup.set()
+
+    # Events arrive on the listener thread
+    notifications.subscribe(lambda event: loop.call_soon_threadsafe(queue_routes, event["routes"]))
+    while True:
+        # Short ticks even while events arrive, so losing the listener switches to
+        # SYNC_INTERVAL syncs at once (and they cover events missed meanwhile)
+        try:
+            await asyncio.wait_for(wakeup.wait(), SYNC_INTERVAL)
+            await asyncio.sleep(EVENT_COALESCE)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+        route_ids = set(pending)
+        pending.clear()
+        if not route_ids and time.time() - _last_sync < _sync_interval():
+            continue
+        if not _sync_lock.acquire(blocking=False):
+            # A full sync is running and covers these routes
+            continue
+        try:
+            if route_ids:
+                await sync_routes_async(route_ids)
+            else:
+                await sync_async()
+        except Exception as e:
+            logger.error(f"History sync failed: {e}")
+        finally:
+            _sync_lock.release()
+
+def sync_if_stale():
+    if _live or time.time() - _last_sync < _sync_interval():
+        return
+    # Only one request pays for the sync; the others serve what's already in memory
+    if _sync_lock.acquire(blocking=False):
+        try:
+            sync()
+        except Exception as e:
+            logger.error(f"History sync failed: {e}")
+        finally:
+            _sync_lock.release()
+
+async def refresh_if_stale():
+    """sync_if_stale() for async endpoints: no worker thread is held while the DB answers."""
+    if _live or time.time() - _last_sync < _sync_interval():
+        return
+    if _sync_lock.acquire(blocking=False):
+        try:
+            await sync_async()
+        except Exception as e:
+            logger.error(f"History sync failed: {e}")
+        finally:
+            _sync_lock.release()
+
+def get_changes(route_id, epoch, seq, old_cutoff, cutoff, watermark=None):
+    """
+    Columns for trips changed after seq (see RouteHistory.columns), plus trips that
+    aged out since old_cutoff. Returns (epoch, seq, latest, columns, aged_out, after_ts).
+
+    seq only means something to the store that handed it out. A cursor from another
+    store (another web worker, or before a restart) carries that store's newest
+    timestamp instead, and all stores hold the same DB rows: trips with entries after
+    watermark - SYNC_LOOKBACK are returned (after_ts), the same margin syncs re-read
+    for late rows and moved dwell markers. Without a watermark, everything in the
+    window is returned as if seq were 0.
+    """
+    sync_if_stale()
+    route = _routes.get(route_id)
+    if route is None:
+        return None, 0, 0.0, None, [], None
+    after_ts = None
+    with route.lock:
+        if epoch != route.epoch:
+            seq = 0
+            if watermark is not None:
+                after_ts = watermark - SYNC_LOOKBACK
+            else:
+                old_cutoff = cutoff
+        return (route.epoch, route.seq, route.latest, route.columns(cutoff, seq, after_ts),
+                route.aged_out(old_cutoff, cutoff), after_ts)
+
+def get_columns(route_id, cutoff):
+    sync_if_stale()
+    route = _routes.get(route_id)
+    if route is None:
+        return None
+    with route.lock:
+        return route.columns(cutoff)
+
+def get_stop_ids():
+    """Interned stop ids; stop_slots in columns() index into this list (append-only)."""
+    return _stop_ids
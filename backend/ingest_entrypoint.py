@@ -7,8 +7,9 @@ import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from db import init_db
-from poller import poll_loop
+from poller import poll_loop, retention_loop
 import gtfs_loader
+import metrics
 
 # Configure logging
 logging.basicConfig(
@@ -17,6 +18,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# The ingestor has no web app, so /metrics gets its own small HTTP server (0 disables it)
+METRICS_PORT = int(os.environ.get("INGEST_METRICS_PORT", "9100"))
+
 async def main():
     logger.info("Starting Ingestor Service...")
     
@@ -25,9 +29,12 @@ async def main():
     
     # Load GTFS data (needed for distance calculations in poller)
     gtfs_loader.load_data()
+
+    if METRICS_PORT:
+        metrics.serve_http(METRICS_PORT)
     
-    # Start polling loop
-    await poll_loop()
+    # Start polling loop, with retention on its own schedule
+    await asyncio.gather(poll_loop(), retention_loop())
 
 if __name__ == "__main__":
     try:
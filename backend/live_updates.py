@@ -0,0 +1,119 @@
+import os
+import asyncio
+import logging
+import history
+import history_store
+import metrics
+import wire_format
+
+logger = logging.getLogger(__name__)
+
+# Hard cap on open streams per process; extra clients get a 503 and fall back to polling
+MAX_SUBSCRIBERS = int(os.environ.get("MAX_STREAM_SUBSCRIBERS", "1000"))
+# Send a comment line this often so proxies don't close idle streams
+KEEPALIVE_SECONDS = 15
+
+_loop = None
+_subscribers = {}  # route_id -> set of asyncio.Queue
+_subscriber_count = 0
+_last_delta = {}  # route_id -> (cursor, store version, payload, next_cursor), shared by clients at the same cursor
+
+STREAM_SUBSCRIBERS = metrics.Gauge(
+    "stringlines_stream_subscribers", "Open /api/stream connections per line", ("line",),
+    callback=lambda: {(route_id,): len(queues) for route_id, queues in list(_subscribers.items())},
+)
+
+class TooManySubscribers(Exception):
+    pass
+
+def start():
+    """Remember the event loop so publish() can be called from poller/sync threads."""
+    global _loop
+    _loop = asyncio.get_running_loop()
+
+def check_capacity():
+    """Raise TooManySubscribers if no stream can be opened right now."""
+    if _subscriber_count >= MAX_SUBSCRIBERS:
+        raise TooManySubscribers()
+
+def subscribe(route_id):
+    global _subscriber_count
+    check_capacity()
+    # A queue of one wake-up token: updates for a slow client are coalesced, never buffered
+    queue = asyncio.Queue(maxsize=1)
+    _subscribers.setdefault(route_id, set()).add(queue)
+    _subscriber_count += 1
+    return queue
+
+def unsubscribe(route_id, queue):
+    global _subscriber_count
+    queues = _subscribers.get(route_id)
+    if queues and queue in queues:
+        queues.discard(queue)
+        _subscriber_count -= 1
+        if not queues:
+            del _subscribers[route_id]
+
+def _notify(route_ids):
+    for route_id in route_ids:
+        for queue in _subscribers.get(route_id, ()):
+            if not queue.full():
+                queue.put_nowait(None)
+
+def publish(route_ids):
+    """Wake the streams for these routes. Safe to call from any thread."""
+    if not route_ids or _loop is None or _loop.is_closed():
+        return
+    try:
+        if asyncio.get_running_loop() is _loop:
+            _notify(route_ids)
+            return
+    except RuntimeError:
+        pass
+    _loop.call_soon_threadsafe(_notify, set(route_ids))
+
+def _build_event(route_id, cursor):
+    """(SSE event for the changes since cursor or None if nothing changed, next cursor)"""
+    # Read before building: a commit landing meanwhile leaves an entry keyed older
+    # than its contents, which only costs a rebuild
+    version = history_store.get_version(route_id)
+    cached = _last_delta.get(route_id)
+    if cached and cached[0] == cursor and cached[1] == version:
+        return cached[2], cached[3]
+
+    delta = history.build_history_delta(route_id, cursor)
+    if cursor and not (delta["reset"] or delta["trips"] or delta["removed"]):
+        payload = None
+    else:
+        # The cursor is the event id, so EventSource resumes from it on reconnect
+        payload = f"id: {delta['cursor']}\ndata: {wire_format.dumps(delta).decode()}\n\n"
+    _last_delta[route_id] = (cursor, version, payload, delta["cursor"])
+    return payload, delta["cursor"]
+
+async def stream(request, route_id, cursor):
+    """
+    Yield SSE events for route_id until the client disconnects. Subscribes here, not
+    in the endpoint: a client gone before the response starts never runs this
+    generator, and a slot taken outside it would never be released.
+    """
+    queue = None
+    try:
+        try:
+            queue = subscribe(route_id)
+        except TooManySubscribers:
+            # Filled up since the endpoint's check; EventSource reconnects and gets the 503
+            return
+        while True:
+            payload, cursor = await asyncio.to_thread(_build_event, route_id, cursor)
+            if payload:
+                yield payload
+
+            try:
+                await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield ": keepalive\n\n"
+    finally:
+        if queue is not None:
+            unsubscribe(route_id, queue)
@@ -1,33 +1,56 @@
-from fastapi import FastAPI, Query
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Query, Request, HTTPException
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 import asyncio
 from contextlib import asynccontextmanager
 import os
 import json
-from db import init_db, get_db, close_pool
-from poller import poll_loop
+import time
+from db import init_db, get_db, close_pool, init_async_pool, close_async_pool
+from poller import poll_loop, retention_loop
 from mock_data import generate_mock_data
 import gtfs_loader
+import history
+import history_store
+import live_updates
+import metrics
+import response_cache
+from static_files import PrecompressedStaticFiles
+import wire_format
 
 # Environment variable to control mock mode and poller
 USE_MOCK_DATA = os.environ.get("USE_MOCK_DATA", "false").lower() == "true"
 DISABLE_POLLER = os.environ.get("DISABLE_POLLER", "false").lower() == "true"
+# Windows longer than the in-memory store are rebuilt from the DB at most this often
+LONG_WINDOW_REFRESH = 30
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     init_db()
+    await init_async_pool()
     gtfs_loader.load_data()
+    live_updates.start()
+    history_store.add_listener(live_updates.publish)
+    if not USE_MOCK_DATA:
+        history_store.warm_load()
     
-    task = None
+    tasks = []
     if not USE_MOCK_DATA and not DISABLE_POLLER:
-        task = asyncio.create_task(poll_loop())
+        # The poller feeds the history store directly; no need to re-read the DB
+        history_store.set_live()
+        tasks.append(asyncio.create_task(poll_loop()))
+        tasks.append(asyncio.create_task(retention_loop()))
+    elif not USE_MOCK_DATA:
+        # Ingestor runs elsewhere: pick up its writes so streams get pushed promptly
+        tasks.append(asyncio.create_task(history_store.sync_loop()))
         
     yield
     
-    if task:
+    for task in tasks:
         task.cancel()
     
+    await close_async_pool()
     close_pool()
 
 app = FastAPI(lifespan=lifespan)
@@ -39,117 +62,106 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compresses uncached responses (deltas, stations). Cached history payloads and
+# precompressed static files already carry Content-Encoding and pass through untouched.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 @app.get("/api/stations")
 def get_stations(line: str = Query(None)):
     return gtfs_loader.get_stations_list(route_id=line)
 
 @app.get("/api/history")
-def get_history(line: str = Query("Q")):
+async def get_history(
+    request: Request,
+    line: str = Query("Q"),
+    minutes: int = Query(history.HISTORY_MINUTES, ge=1, le=history.MAX_HISTORY_MINUTES,
+                         description="Rounded up to one of history.WINDOW_TIERS"),
+    resolution: int = Query(None, ge=1, le=3600, description="Keep at most ~one point per train per this many "
+                            "seconds; rounded down to one of history.RESOLUTION_TIERS"),
+    fmt: str = Query(None, alias="format", pattern="^(json|columns)$", description="columns: binary columnar payload (see wire_format)"),
+):
+    fmt = wire_format.negotiate(fmt, request.headers.get("accept"))
     if USE_MOCK_DATA:
-        return generate_mock_data()
-    
-    # Fetch from DB
-    # Group by trip_id
-    # Limit to last 60 mins
-    import time
-    now = time.time()
-    cutoff = now - (30 * 60)
-    
-    from db import get_db, execute_query
-    
-    with get_db() as conn:
-        cursor = execute_query(conn, """
-            SELECT p.trip_id, p.timestamp, p.distance, p.stop_id, t.direction_id
-            FROM positions p
-            JOIN trips t ON p.trip_id = t.trip_id
-            WHERE t.route_id = ? AND p.timestamp > ?
-            ORDER BY p.timestamp ASC
-        """, (line, cutoff))
-        rows = cursor.fetchall()
-        
-    trips = {}
-    for r in rows:
-        tid = r["trip_id"]
-        if tid not in trips:
-            trips[tid] = {
-                "trip_id": tid,
-                "route_id": line,
-                "direction_id": r["direction_id"],
-                "positions": []
-            }
-        trips[tid]["positions"].append({
-            "timestamp": r["timestamp"],
-            "distance": r["distance"],
-            "stop_id": r["stop_id"]
-        })
-        
-    # Filter out "stuck" trains (long dwells > 3 mins) ONLY AT TERMINALS
-    # This prevents flat lines at terminals from dominating the chart
-    # while preserving legitimate delays at other stations.
-    
-    terminals = gtfs_loader.get_terminal_stations(line)
-    
-    final_trips = []
-    for trip in trips.values():
-        positions = trip["positions"]
-        if not positions:
-            continue
-            
-        filtered_positions = []
-        
-        # Group by distance to identify dwells
-        current_dwell = [positions[0]]
-        
-        for i in range(1, len(positions)):
-            pos = positions[i]
-            prev = positions[i-1]
-            
-            # Check if distance is effectively the same (handle float precision)
-            if abs(pos["distance"] - prev["distance"]) < 0.01:
-                current_dwell.append(pos)
-            else:
-                # Dwell ended. Process it.
-                duration = current_dwell[-1]["timestamp"] - current_dwell[0]["timestamp"]
-                
-                # Check if this dwell is at a terminal
-                stop_id = current_dwell[0]["stop_id"]
-                base_stop_id = stop_id[:-1] if len(stop_id) > 3 else stop_id
-                is_terminal = base_stop_id in terminals
-                
-                if duration > 180 and is_terminal: 
-                    # Long dwell AT TERMINAL: Keep only the last point (hide the flat line)
-                    filtered_positions.append(current_dwell[-1])
-                else:
-                    # Short dwell OR non-terminal: Keep all points
-                    filtered_positions.extend(current_dwell)
-                
-                # Start new dwell
-                current_dwell = [pos]
-                
-        # Process the final dwell
-        if current_dwell:
-            duration = current_dwell[-1]["timestamp"] - current_dwell[0]["timestamp"]
-            
-            stop_id = current_dwell[0]["stop_id"]
-            base_stop_id = stop_id[:-1] if len(stop_id) > 3 else stop_id
-            is_terminal = base_stop_id in terminals
-            
-            if duration > 180 and is_terminal:
-                filtered_positions.append(current_dwell[-1])
-            else:
-                filtered_positions.extend(current_dwell)
-        
-        # Only include trip if it has at least 2 points (needed to draw a line)
-        if len(filtered_positions) > 1:
-            trip["positions"] = filtered_positions
-            final_trips.append(trip)
-        
-    return final_trips
+        return Response(wire_format.encode(generate_mock_data(), fmt), media_type=wire_format.MEDIA_TYPES[fmt])
+
+    if not gtfs_loader.is_known_route(line):
+        # Nothing is stored for lines without a station map; don't cache per unknown name
+        return Response(wire_format.encode([], fmt), media_type=wire_format.MEDIA_TYPES[fmt])
+
+    minutes, resolution = history.snap_window(minutes), history.snap_resolution(resolution)
+    key = ("history", line, minutes, resolution, fmt)
+    if minutes * 60 > history_store.HISTORY_WINDOW:
+        # Longer than the in-memory window: cut from one read of the line's stored
+        # arrival/dwell-end events over the whole retained range (a covering-index scan),
+        # shared by every window and resolution and refreshed on a timer
+        generation = int(time.time() // LONG_WINDOW_REFRESH)
+
+        async def load():
+            return await history_store.route_rollup(line, generation, history.MAX_HISTORY_MINUTES * 60)
+
+        entry = await response_cache.get_async(
+            key, generation, load,
+            lambda rollup: history.build_history_from_rollup(line, rollup, minutes, resolution), fmt
+        )
+        return entry.response(request)
+
+    # Every viewer of a line shares one pre-serialized payload per ingest generation
+    await history_store.refresh_if_stale()
+    generation = history_store.get_generation(line)
+    entry = response_cache.peek(key, generation)
+    if entry is None:
+        # Building is CPU work; keep it off the event loop
+        entry = await asyncio.to_thread(
+            response_cache.get, key, generation, lambda: history.build_history(line, minutes, resolution), fmt
+        )
+    return entry.response(request)
+
+@app.get("/api/history/delta")
+async def get_history_delta(line: str = Query("Q"), cursor: str = Query(None)):
+    """Only what changed since `cursor`; call without one to get the full window."""
+    if USE_MOCK_DATA:
+        trips = generate_mock_data()
+        for trip in trips:
+            trip["since"] = None
+        return {"cursor": None, "reset": True, "cutoff": 0, "trips": trips, "removed": []}
+    if not gtfs_loader.is_known_route(line):
+        return {"cursor": None, "reset": True, "cutoff": 0, "trips": [], "removed": []}
+
+    await history_store.refresh_if_stale()
+    delta = await asyncio.to_thread(history.build_history_delta, line, cursor)
+    return Response(wire_format.dumps(delta), media_type="application/json")
+
+@app.get("/api/stream")
+async def stream_history(request: Request, line: str = Query("Q"), cursor: str = Query(None)):
+    """
+    Server-Sent Events: one delta event (same shape as /api/history/delta) per
+    update to the line. EventSource resends the last event id on reconnect.
+    """
+    if USE_MOCK_DATA:
+        raise HTTPException(status_code=404, detail="Streaming is not available with mock data")
+    if not gtfs_loader.is_known_route(line):
+        raise HTTPException(status_code=404, detail=f"Unknown line {line}")
+
+    cursor = cursor or request.headers.get("last-event-id")
+    try:
+        live_updates.check_capacity()
+    except live_updates.TooManySubscribers:
+        raise HTTPException(status_code=503, detail="Too many live viewers, use /api/history/delta")
+
+    return StreamingResponse(
+        live_updates.stream(request, line, cursor),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Prometheus text format: DB pools and streams, plus ingest stages when the poller runs in this process."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 # Serve static files (React app)
 # Check if static directory exists (it will in Docker)
 if os.path.exists("../static"):
-    app.mount("/", StaticFiles(directory="../static", html=True), name="static")
+    app.mount("/", PrecompressedStaticFiles(directory="../static", html=True), name="static")
 elif os.path.exists("static"):
-    app.mount("/", StaticFiles(directory="static", html=True), name="static")
+    app.mount("/", PrecompressedStaticFiles(directory="static", html=True), name="static")
@@ -0,0 +1,182 @@
+"""
+"Routes updated" events from the ingestor to web workers, so workers re-read
+the DB when new data has landed instead of on a timer.
+
+An event is {"routes": {route_id: generation}, "at": epoch seconds}, where a
+route's generation counts the ingestor's commits that changed it.
+
+    Postgres  NOTIFY on CHANNEL with the routes of one commit; each web worker
+              LISTENs on its own connection.
+    SQLite    the generations of every route are written to the event file
+              (NOTIFY_FILE, by default next to the database) with an atomic
+              rename. Workers watch its mtime and deliver the routes whose
+              generation changed, so commits landing between two checks are
+              merged into one event rather than lost.
+
+publish() runs in the ingesting process after each commit; subscribe() starts
+a listener thread in each web worker.
+"""
+import os
+import json
+import time
+import select
+import threading
+import logging
+import db
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "stringlines_updates"
+# SQLite event file; defaults to <DB_PATH>.notify
+NOTIFY_FILE = os.environ.get("NOTIFY_FILE")
+# SQLite: how often workers stat the event file (seconds)
+NOTIFY_POLL_INTERVAL = 0.25
+# Postgres: wait between reconnects of a lost LISTEN connection (seconds)
+RECONNECT_DELAY = 5
+# Postgres: a LISTEN connection idle this long is pinged with SELECT 1, and given
+# up on (and reconnected) if the ping or the connect takes longer than the timeout
+LISTEN_PING_INTERVAL = 30
+LISTEN_TIMEOUT = 10
+# TCP keepalives, so the OS also notices a peer that vanished without closing
+LISTEN_KEEPALIVES = {"keepalives": 1, "keepalives_idle": 30, "keepalives_interval": 10, "keepalives_count": 3}
+
+_generations = {}  # route_id -> commits published for it by this process
+_publish_lock = threading.Lock()
+
+_listener = None
+_listening = threading.Event()  # set while the listener can receive events
+
+def notify_file():
+    return NOTIFY_FILE or db.DB_PATH + ".notify"
+
+def publish(conn, route_ids):
+    """Announce committed changes to route_ids. Call after the commit, with the connection that made it."""
+    if not route_ids:
+        return
+    with _publish_lock:
+        for route_id in route_ids:
+            _generations[route_id] = _generations.get(route_id, 0) + 1
+        # The SQLite event file replaces the previous event, so it carries every route
+        routes = {r: _generations[r] for r in route_ids} if db.get_db_type() == "postgres" else _generations
+        payload = json.dumps({"routes": routes, "at": time.time()}, separators=(",", ":"))
+
+    try:
+        if db.get_db_type() == "postgres":
+            # Its own short transaction; NOTIFY is delivered when it commits
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL, payload))
+            conn.commit()
+        else:
+            path = notify_file()
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(payload)
+            os.replace(tmp, path)
+    except Exception as e:
+        # Workers still catch up through their fallback sync
+        logger.warning(f"Failed to publish update event: {e}")
+
+def is_listening():
+    """True while this process receives events (its history sync can then wait for them)."""
+    return _listening.is_set()
+
+def subscribe(callback):
+    """Call callback(event) from a background thread for every event received. Idempotent."""
+    global _listener
+    if _listener is not None:
+        return
+    target = _listen_postgres if db.get_db_type() == "postgres" else _watch_file
+    _listener = threading.Thread(target=target, args=(callback,), name="update-events", daemon=True)
+    _listener.start()
+
+def _deliver(callback, event):
+    try:
+        callback(event)
+    except Exception as e:
+        logger.error(f"Update event handler failed: {e}")
+
+def _wait(conn, timeout):
+    """Drive an asynchronous connection until its pending operation is done; raises on timeout."""
+    extensions = db.psycopg2.extensions
+    deadline = time.monotonic() + timeout
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"no answer from the database in {timeout} s")
+        if state == extensions.POLL_READ:
+            select.select([conn], [], [], remaining)
+        else:
+            select.select([], [conn], [], remaining)
+
+def _listen_postgres(callback):
+    while True:
+        conn = None
+        try:
+            # Asynchronous (and so autocommit): nothing here can block past LISTEN_TIMEOUT
+            conn = db.psycopg2.connect(db.get_db_url(), async_=1, **LISTEN_KEEPALIVES)
+            _wait(conn, LISTEN_TIMEOUT)
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {CHANNEL}")
+            _wait(conn, LISTEN_TIMEOUT)
+            _listening.set()
+            logger.info(f"Listening for update events on {CHANNEL}")
+            while True:
+                if select.select([conn], [], [], LISTEN_PING_INTERVAL) == ([], [], []):
+                    # Quiet for a while: check the connection still answers (a half-open one
+                    # would otherwise keep us "listening" forever)
+                    cur.execute("SELECT 1")
+                    _wait(conn, LISTEN_TIMEOUT)
+                else:
+                    conn.poll()
+                while conn.notifies:
+                    _deliver(callback, json.loads(conn.notifies.pop(0).payload))
+        except Exception as e:
+            logger.error(f"Update event listener lost its connection: {e}")
+        finally:
+            _listening.clear()
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(RECONNECT_DELAY)
+
+def _watch_file(callback):
+    path = notify_file()
+
+    def signature():
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def read():
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # Events from before this worker started are covered by its warm load
+    seen = signature()
+    generations = (read() or {}).get("routes", {})
+    _listening.set()
+    logger.info(f"Watching {path} for update events")
+    while True:
+        time.sleep(NOTIFY_POLL_INTERVAL)
+        current = signature()
+        if current is None or current == seen:
+            continue
+        seen = current
+        event = read()
+        if event is None:
+            continue
+        # != rather than >: generations start over when the ingestor restarts
+        changed = {r: g for r, g in event["routes"].items() if generations.get(r) != g}
+        generations = event["routes"]
+        if changed:
+            _deliver(callback, {"routes": changed, "at": event["at"]})
@@ -3,10 +3,23 @@ import time
 import requests
 import json
 import os
+import random
 import logging
+import multiprocessing
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from requests.adapters import HTTPAdapter
 from google.transit import gtfs_realtime_pb2
-from db import get_db, execute_query
+from google.protobuf.message import DecodeError
+from db import (get_db, statement, fetch, ensure_partitions, prune_positions, PARTITION_SECONDS,
+                RETENTION_SECONDS, TIMESTAMP_INDEX)
+import dimensions
+import feed_archive
 import gtfs_loader
+import history_store
+import metrics
+import notifications
 from config import SUBWAY_DATA
 
 # Configure logging
@@ -19,145 +32,555 @@ for division in SUBWAY_DATA.values():
     for url in division["feeds"]:
         FEED_URLS.add(url)
 
-def fetch_feed(url):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
-    }
+# Point the poller at another host serving the same feed paths (e.g. bench/stub_feed_server.py)
+FEED_BASE_URL = os.environ.get("FEED_BASE_URL")
+if FEED_BASE_URL:
+    FEED_URLS = {FEED_BASE_URL.rstrip("/") + "/" + url.rsplit("/", 1)[-1] for url in FEED_URLS}
+
+# Per-feed timeout (seconds) and max number of feeds downloaded at once
+FETCH_TIMEOUT = float(os.environ.get("FEED_FETCH_TIMEOUT", "10"))
+FETCH_CONCURRENCY = int(os.environ.get("FEED_FETCH_CONCURRENCY", "8"))
+# Per-feed polling: each feed is polled around its own observed update cadence (seconds)
+MIN_POLL_INTERVAL = float(os.environ.get("FEED_MIN_POLL_INTERVAL", "5"))
+MAX_POLL_INTERVAL = float(os.environ.get("FEED_MAX_POLL_INTERVAL", "60"))
+DEFAULT_POLL_INTERVAL = 10
+POLL_JITTER = 1.0
+MAX_BACKOFF = 300
+# Processes decoding protobufs and extracting rows; 0 parses in the fetch threads instead
+PARSE_WORKERS = int(os.environ.get("FEED_PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+
+# --- Metrics (see metrics.py); feed labels are the last path segment of the feed URL ---
+STAGE_SECONDS = metrics.Histogram(
+    "stringlines_ingest_stage_seconds",
+    "Time per ingest stage and feed: fetch (HTTP), parse (ParseFromString), extract (entity loop), "
+    "write (filter + DB write), commit",
+    ("stage", "feed"),
+)
+CYCLE_SECONDS = metrics.Histogram("stringlines_poll_cycle_seconds", "Duration of a poll cycle over the due feeds")
+RETENTION_RUN_SECONDS = metrics.Histogram("stringlines_retention_seconds", "Duration of a retention run (partition drops)")
+FEED_POLLS = metrics.Counter(
+    "stringlines_feed_polls_total", "Feed polls by outcome: changed, not_modified (304), unchanged (same header timestamp), failed",
+    ("feed", "result"),
+)
+INGEST_ERRORS = metrics.Counter("stringlines_ingest_errors_total", "Failed feeds by stage", ("feed", "stage"))
+FEED_ENTITIES = metrics.Gauge("stringlines_feed_entities", "Entities in the latest snapshot of each feed", ("feed",))
+INGEST_ROWS = metrics.Counter(
+    "stringlines_ingest_rows_total",
+    "Rows per feed: trips upserted, positions inserted, dwell markers moved, unchanged positions skipped, "
+    "positions dropped as older than retention",
+    ("feed", "kind"),
+)
+
+def feed_name(url):
+    return unquote(url).rsplit("/", 1)[-1] if url else "unknown"
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
+}
+
+# Shared keep-alive session so every cycle reuses the same TLS connections
+_session = None
+
+def get_session():
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=FETCH_CONCURRENCY, pool_maxsize=FETCH_CONCURRENCY)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(HEADERS)
+        _session = session
+    return _session
+
+class FeedSchedule:
+    """
+    Polling state for one feed: validators for conditional requests, the last
+    FeedHeader.timestamp seen, and an EWMA of the gap between updates, used to
+    poll shortly after the next update is expected.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.etag = None
+        self.last_modified = None
+        self.header_ts = None
+        self.cadence = DEFAULT_POLL_INTERVAL
+        self.failures = 0
+        self.next_due = 0.0
+
+    def changed(self, header_ts, now):
+        if header_ts and self.header_ts and header_ts > self.header_ts:
+            gap = header_ts - self.header_ts
+            self.cadence = min(max(0.7 * self.cadence + 0.3 * gap, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+        self.header_ts = header_ts
+        self.failures = 0
+        self._schedule(now, self._until_expected(now))
+
+    def unchanged(self, now):
+        self.failures = 0
+        self._schedule(now, self._until_expected(now))
+
+    def failed(self, now):
+        self.failures += 1
+        self._schedule(now, min(MIN_POLL_INTERVAL * 2 ** self.failures, MAX_BACKOFF))
+
+    def _until_expected(self, now):
+        # Next update is expected one cadence after the last one was published;
+        # if it is already late, check again after the minimum interval
+        if self.header_ts is None:
+            return self.cadence
+        return max(self.header_ts + self.cadence - now, MIN_POLL_INTERVAL)
+
+    def _schedule(self, now, delay):
+        # Jitter keeps feeds from lining up on the same tick
+        self.next_due = now + delay + random.uniform(0, POLL_JITTER)
+
+_schedules = {}  # url -> FeedSchedule
+
+def _feed_staleness():
+    now = time.time()
+    return {(feed_name(url),): now - s.header_ts for url, s in list(_schedules.items()) if s.header_ts}
+
+FEED_STALENESS = metrics.Gauge(
+    "stringlines_feed_staleness_seconds", "Now minus the FeedHeader timestamp of the latest snapshot of each feed",
+    ("feed",), callback=_feed_staleness,
+)
+
+def get_schedule(url):
+    schedule = _schedules.get(url)
+    if schedule is None:
+        schedule = _schedules[url] = FeedSchedule(url)
+    return schedule
+
+def due_feeds(urls, now):
+    return [url for url in urls if get_schedule(url).next_due <= now]
+
+def next_due_time(urls):
+    return min(get_schedule(url).next_due for url in urls)
+
+# Returned by download_feed when the server answers 304 Not Modified
+NOT_MODIFIED = object()
+
+def download_feed(url):
+    """Download the raw protobuf bytes for a feed, NOT_MODIFIED, or None on failure."""
+    schedule = get_schedule(url)
+    headers = {}
+    if schedule.etag:
+        headers["If-None-Match"] = schedule.etag
+    if schedule.last_modified:
+        headers["If-Modified-Since"] = schedule.last_modified
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        with STAGE_SECONDS.time(stage="fetch", feed=feed_name(url)):
+            response = get_session().get(url, timeout=FETCH_TIMEOUT, headers=headers)
+        if response.status_code == 304:
+            return NOT_MODIFIED
         if response.status_code == 403:
             logger.error(f"MTA API returned 403 Forbidden for {url}. Please check your MTA_API_KEY.")
+            INGEST_ERRORS.inc(feed=feed_name(url), stage="fetch")
             return None
         response.raise_for_status()
-        feed = gtfs_realtime_pb2.FeedMessage()
-        feed.ParseFromString(response.content)
-        return feed
+        schedule.etag = response.headers.get("ETag")
+        schedule.last_modified = response.headers.get("Last-Modified")
+        return response.content
     except Exception as e:
         logger.error(f"Error fetching feed {url}: {e}")
+        INGEST_ERRORS.inc(feed=feed_name(url), stage="fetch")
         return None
 
-def process_feed(feed):
-    if not feed:
-        return
+def feed_header_timestamp(content):
+    """FeedHeader.timestamp read from the leading header field, without parsing the entities."""
+    try:
+        # Field 1 (header), length-delimited: tag byte 0x0A, then a varint length
+        if not content or content[0] != 0x0A:
+            return None
+        length, shift, i = 0, 0, 1
+        while True:
+            b = content[i]
+            i += 1
+            length |= (b & 0x7F) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        header = gtfs_realtime_pb2.FeedHeader()
+        header.ParseFromString(content[i:i + length])
+        return header.timestamp if header.HasField("timestamp") else None
+    except (IndexError, DecodeError):
+        return None
 
-    count_updates = 0
-    with get_db() as conn:
-        now = time.time()
-        
-        # Use a list of entity processing functions or just two passes
-        
-        # First pass: Trip Updates
-        for i, entity in enumerate(feed.entity):
-            try:
-                if entity.trip_update:
-                    tu = entity.trip_update
-                    trip_id = tu.trip.trip_id
-                    route_id = tu.trip.route_id
-                    
-                    # Insert trip info
-                    direction_id = 0
-                    if tu.trip.HasField('direction_id'):
-                        direction_id = tu.trip.direction_id
-                    else:
-                        if '..S' in trip_id:
-                            direction_id = 1
-                        elif '..N' in trip_id:
-                            direction_id = 0
-                    
-                    execute_query(conn, """
-                        INSERT INTO trips (trip_id, route_id, start_time, direction_id)
-                        VALUES (?, ?, ?, ?)
-                        ON CONFLICT(trip_id) DO NOTHING
-                    """, (trip_id, route_id, tu.trip.start_time, direction_id))
-            except Exception as e:
-                # Log occasional errors but don't spam for every single one if it's common
-                if i < 5: 
-                    logger.warning(f"Error processing TU {i}: {e}")
-                pass
-            
-            # Commit periodically
-            if (i + 1) % 100 == 0:
-                conn.commit()
+def parse_feed(content):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    return feed
+
+def fetch_feed(url):
+    content = download_feed(url)
+    if content is None:
+        return None
+    try:
+        return parse_feed(content)
+    except Exception as e:
+        logger.error(f"Error parsing feed {url}: {e}")
+        return None
+
+# --- Ingest pipeline: fetch (threads) -> parse/extract (processes) -> write (caller) ---
+_parse_pool = None
+
+def _init_parse_worker():
+    # Workers need the station maps for distances; the compiled GTFS index makes this quick
+    gtfs_loader.load_data()
+
+def get_parse_pool():
+    global _parse_pool
+    if _parse_pool is None and PARSE_WORKERS > 0:
+        # spawn, not fork: the parent runs threads and an event loop
+        _parse_pool = ProcessPoolExecutor(
+            max_workers=PARSE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_parse_worker,
+        )
+    return _parse_pool
+
+def shutdown_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(cancel_futures=True)
+        _parse_pool = None
+
+def _discard_parse_pool(pool):
+    """Drop a pool whose worker died; the next cycle starts a fresh one."""
+    global _parse_pool
+    if _parse_pool is pool:
+        _parse_pool = None
+    # Releases its queues and semaphores; its remaining futures already failed
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def extract_content(content):
+    """Parse stage: protobuf bytes -> (trip_rows, position_rows) of plain tuples, cheap to send back."""
+    return extract_timed(content)[0]
+
+def extract_timed(content, now=None):
+    """
+    extract_content plus (parse seconds, extract seconds, entity count), measured
+    where it runs: metrics recorded in a parse worker would stay in that process.
+    `now` (default: the current time) caps vehicle timestamps; reprocessing passes the fetch time.
+    """
+    start = time.perf_counter()
+    feed = parse_feed(content)
+    parsed = time.perf_counter()
+    rows = extract_feed(feed, time.time() if now is None else now)
+    return rows, (parsed - start, time.perf_counter() - parsed, len(feed.entity))
 
-        # Second pass: Vehicle Positions
-        for i, entity in enumerate(feed.entity):
-            try:
-                if entity.vehicle:
-                    v = entity.vehicle
-                    trip_id = v.trip.trip_id
-                    route_id = v.trip.route_id
-                    
-                    # Ensure trip exists in DB (redundant but safe)
-                    direction_id = 0
-                    if v.trip.HasField('direction_id'):
-                        direction_id = v.trip.direction_id
-                    else:
-                        if '..S' in trip_id:
-                            direction_id = 1
-                        elif '..N' in trip_id:
-                            direction_id = 0
-                            
-                    execute_query(conn, """
-                        INSERT INTO trips (trip_id, route_id, start_time, direction_id)
-                        VALUES (?, ?, ?, ?)
-                        ON CONFLICT(trip_id) DO NOTHING
-                    """, (trip_id, route_id, v.trip.start_time, direction_id))
-                    
-                    stop_id = v.stop_id
-                    if not stop_id:
+def _record_extract(url, timings):
+    parse_seconds, extract_seconds, entities = timings
+    feed = feed_name(url)
+    STAGE_SECONDS.observe(parse_seconds, stage="parse", feed=feed)
+    STAGE_SECONDS.observe(extract_seconds, stage="extract", feed=feed)
+    FEED_ENTITIES.set(entities, feed=feed)
+
+def fetch_and_extract(urls, max_workers=FETCH_CONCURRENCY):
+    """
+    Yield (url, (trip_rows, position_rows)) as each feed is extracted, or (url, None) if it failed.
+    Feeds that haven't changed since the last poll (304, or same header timestamp) are
+    skipped without parsing. Downloads and parses keep running while the caller writes
+    what was yielded, and a slow endpoint only delays its own result.
+    """
+    parse_pool = get_parse_pool()
+    with ThreadPoolExecutor(max_workers=max_workers) as fetchers:
+        pending = {fetchers.submit(download_feed, url): ("fetch", url) for url in urls}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, url = pending.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died: parse in the fetch threads for the rest of this cycle
+                    logger.error(f"Parse worker pool broke while parsing {url}: {e}")
+                    if parse_pool is not None:
+                        _discard_parse_pool(parse_pool)
+                        parse_pool = None
+                    get_schedule(url).failed(time.time())
+                    INGEST_ERRORS.inc(feed=feed_name(url), stage="parse")
+                    yield url, None
+                    continue
+                except Exception as e:
+                    logger.error(f"Error parsing feed {url}: {e}")
+                    get_schedule(url).failed(time.time())
+                    INGEST_ERRORS.inc(feed=feed_name(url), stage="parse")
+                    yield url, None
+                    continue
+
+                schedule = get_schedule(url)
+                if stage == "parse":
+                    rows, timings = result
+                    _record_extract(url, timings)
+                    yield url, rows
+                elif result is None:
+                    schedule.failed(time.time())
+                    FEED_POLLS.inc(feed=feed_name(url), result="failed")
+                    yield url, None
+                elif result is NOT_MODIFIED:
+                    schedule.unchanged(time.time())
+                    FEED_POLLS.inc(feed=feed_name(url), result="not_modified")
+                else:
+                    header_ts = feed_header_timestamp(result)
+                    if header_ts is not None and header_ts == schedule.header_ts:
+                        schedule.unchanged(time.time())
+                        FEED_POLLS.inc(feed=feed_name(url), result="unchanged")
                         continue
-                        
-                    ts = v.timestamp
-                    if ts > now:
-                        ts = now
-                    
-                    # CRITICAL: Pass route_id to get correct relative distance
-                    dist = gtfs_loader.get_station_distance(stop_id, route_id)
-                    
-                    if dist is not None:
-                        execute_query(conn, """
-                            INSERT INTO positions (trip_id, timestamp, stop_id, distance)
-                            VALUES (?, ?, ?, ?)
-                        """, (trip_id, ts, stop_id, dist))
-                        count_updates += 1
-            except Exception as e:
-                if i < 5:
-                    logger.warning(f"Error processing VP {i}: {e}")
-                pass
-
-            if (i + 1) % 100 == 0:
-                conn.commit()
+                    # Counted as seen once downloaded; a failed write is not retried with the same snapshot
+                    fetched_at = time.time()
+                    schedule.changed(header_ts, fetched_at)
+                    FEED_POLLS.inc(feed=feed_name(url), result="changed")
+                    # Queued for the archive's writer thread; never waits on disk
+                    feed_archive.submit(feed_name(url), header_ts, result, fetched_at)
+                    future = None
+                    if parse_pool is not None:
+                        try:
+                            future = parse_pool.submit(extract_timed, result)
+                        except BrokenProcessPool as e:
+                            logger.error(f"Parse worker pool broke before parsing {url}: {e}")
+                            _discard_parse_pool(parse_pool)
+                            parse_pool = None
+                    if future is None:
+                        future = fetchers.submit(extract_timed, result)
+                    pending[future] = ("parse", url)
+
+# Last known state per trip, so unchanged snapshots are not written again.
+# trip_id -> (stop_id, arrival_ts, marker_ts)
+#   arrival_ts: timestamp of the row written when the train reached stop_id
+#   marker_ts:  timestamp of the dwell-end marker row for that stop (None until seen twice)
+# While a train dwells, its marker row is moved forward instead of adding rows, so
+# the stored data keeps the first and last sighting at every stop and the chart is unchanged.
+_trip_state = {}
+TRIP_STATE_WINDOW = 2 * 60 * 60  # Forget trips not seen for this long
+
+TRIP_STATE_QUERY = statement("recent_trip_positions", """
+    SELECT t.trip_id, p.timestamp, s.stop_id
+    FROM positions p
+    JOIN trips t ON t.trip_key = p.trip_key
+    JOIN stops s ON s.stop_key = p.stop_key
+    WHERE p.timestamp > ?
+    ORDER BY p.trip_key, p.timestamp
+""")
+
+def load_trip_state():
+    """Rebuild the last-known-state cache from recent rows (cold start)."""
+    global _trip_state
+    cutoff = time.time() - TRIP_STATE_WINDOW
+    state = {}
+    with get_db(readonly=True) as conn:
+        rows = fetch(conn, TRIP_STATE_QUERY, (cutoff,))
+        prev = None
+        for tid, ts, stop_id in rows:
+            if prev and prev[0] == tid and prev[2] == stop_id:
+                # Second row at the same stop is the dwell-end marker
+                state[tid] = (stop_id, prev[1], ts)
+            else:
+                state[tid] = (stop_id, ts, None)
+            prev = (tid, ts, stop_id)
+    _trip_state = state
+    logger.info(f"Loaded last known state for {len(state)} trips.")
+
+def filter_changes(position_rows, trip_state):
+    """
+    Compare snapshots against trip_state (trip_id -> last known state, as _trip_state).
+    Returns (insert_rows, marker_moves, changed_rows, new_state) where marker_moves
+    are (new_ts, trip_id, old_ts) updates and changed_rows are the positions behind
+    both. new_state is applied only after commit.
+    """
+    inserts = []
+    moves = []
+    changed = []
+    new_state = {}
+    for row in position_rows:
+        trip_id, ts, stop_id = row[:3]
+        state = new_state.get(trip_id) or trip_state.get(trip_id)
+
+        if state is None or state[0] != stop_id:
+            # Arrived at a new stop
+            inserts.append(row)
+            changed.append(row)
+            new_state[trip_id] = (stop_id, ts, None)
+            continue
+
+        _, arrival_ts, marker_ts = state
+        if ts <= (marker_ts or arrival_ts):
+            # Same snapshot as last poll
+            continue
 
-        conn.commit()
-        
-        # Prune old data
+        if marker_ts is None:
+            inserts.append(row)
+        else:
+            moves.append((ts, trip_id, marker_ts))
+        changed.append(row)
+        new_state[trip_id] = (stop_id, arrival_ts, ts)
+
+    return inserts, moves, changed, new_state
+
+def expire_trip_state(now):
+    cutoff = now - TRIP_STATE_WINDOW
+    for trip_id in [tid for tid, (_, a, m) in _trip_state.items() if (m or a) < cutoff]:
+        del _trip_state[trip_id]
+
+def get_direction_id(trip):
+    if trip.HasField('direction_id'):
+        return trip.direction_id
+    if '..S' in trip.trip_id:
+        return 1
+    return 0
+
+def extract_feed(feed, now):
+    """
+    Single pass over the feed entities.
+    Returns (trip_rows, position_rows) ready for bulk insert.
+    """
+    trips = {}  # trip_id -> (trip_id, route_id, start_time, direction_id)
+    positions = []  # (trip_id, timestamp, stop_id, distance)
+
+    for i, entity in enumerate(feed.entity):
         try:
-            cutoff = now - (24 * 60 * 60)
-            execute_query(conn, "DELETE FROM positions WHERE timestamp < ?", (cutoff,))
-            conn.commit()
+            if entity.HasField('trip_update'):
+                trip = entity.trip_update.trip
+                # Trip updates carry the authoritative trip info, so they win over vehicles
+                trips[trip.trip_id] = (trip.trip_id, trip.route_id, trip.start_time, get_direction_id(trip))
+
+            if entity.HasField('vehicle'):
+                v = entity.vehicle
+                trip_id = v.trip.trip_id
+                route_id = v.trip.route_id
+
+                # Ensure trip exists in DB (redundant but safe)
+                if trip_id not in trips:
+                    trips[trip_id] = (trip_id, route_id, v.trip.start_time, get_direction_id(v.trip))
+
+                stop_id = v.stop_id
+                if not stop_id:
+                    continue
+
+                ts = v.timestamp
+                if ts > now:
+                    ts = now
+
+                # CRITICAL: Pass route_id to get correct relative distance
+                dist = gtfs_loader.get_station_distance(stop_id, route_id)
+
+                if dist is not None:
+                    positions.append((trip_id, ts, stop_id, dist))
         except Exception as e:
-            logger.error(f"Error pruning data: {e}")
-        
-    logger.info(f"Processed feed. Added {count_updates} positions.")
+            # Log occasional errors but don't spam for every single one if it's common
+            if i < 5:
+                logger.warning(f"Error processing entity {i}: {e}")
+
+    # Positions carry their trip's route/direction (db.POSITION_COLUMNS), taken once all entities are seen
+    positions = [p + (trips[p[0]][1], trips[p[0]][3]) for p in positions]
+    return list(trips.values()), positions
+
+def write_feed(trip_rows, position_rows, url=None):
+    """Write stage: store one extracted feed's changes and hand them to the history store."""
+    feed = feed_name(url)
+    start = time.perf_counter()
+    # Vehicles reporting an unset (0) or stale timestamp would only be pruned again
+    cutoff = time.time() - RETENTION_SECONDS
+    current_rows = [row for row in position_rows if row[TIMESTAMP_INDEX] >= cutoff]
+    expired = len(position_rows) - len(current_rows)
+    insert_rows, marker_moves, changed_rows, new_state = filter_changes(current_rows, _trip_state)
 
-def run_poll_cycle():
-    logger.info("Starting poll cycle...")
-    for url in FEED_URLS:
+    with get_db() as conn:
+        # Partitions are created (and committed) before the feed's own transaction
+        ensure_partitions(conn, [row[TIMESTAMP_INDEX] for row in insert_rows] + [move[0] for move in marker_moves])
+
+        # One transaction per feed: trips and stops are interned first, positions stored by key
         try:
-            logger.info(f"Fetching {url}...")
-            feed = fetch_feed(url)
-            if feed:
+            interned = dimensions.write(conn, trip_rows, insert_rows, marker_moves, time.time())
+            with STAGE_SECONDS.time(stage="commit", feed=feed):
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        interned.remember()
+        _trip_state.update(new_state)
+        # Web workers in other processes sync these routes (see history_store.sync_loop)
+        notifications.publish(conn, {row[4] for row in changed_rows})
+
+        history_store.record_committed(
+            (route_id, tid, direction_id, ts, stop_id, dist)
+            for tid, ts, stop_id, dist, route_id, direction_id in changed_rows
+        )
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage="write", feed=feed)
+
+    skipped = len(current_rows) - len(insert_rows) - len(marker_moves)
+    INGEST_ROWS.inc(len(trip_rows), feed=feed, kind="trips")
+    INGEST_ROWS.inc(len(insert_rows), feed=feed, kind="inserted")
+    INGEST_ROWS.inc(len(marker_moves), feed=feed, kind="moved")
+    INGEST_ROWS.inc(skipped, feed=feed, kind="unchanged")
+    if expired:
+        INGEST_ROWS.inc(expired, feed=feed, kind="expired")
+        logger.warning(f"Dropped {expired} positions older than the retention window from {feed}.")
+    logger.info(f"Processed feed. Added {len(insert_rows)} positions, moved {len(marker_moves)} dwell markers, "
+                f"skipped {skipped} unchanged.")
+
+def run_poll_cycle(urls=None):
+    """Poll the given feeds (all by default) once."""
+    urls = FEED_URLS if urls is None else urls
+    logger.info(f"Starting poll cycle for {len(urls)} feeds...")
+    start = time.time()
+    # Feeds are written one at a time as they arrive, while the rest are still downloading/parsing
+    for url, extracted in fetch_and_extract(urls):
+        try:
+            if extracted:
                 logger.info(f"Processing {url}...")
-                process_feed(feed)
+                write_feed(*extracted, url=url)
             else:
                 logger.warning(f"No content for {url}")
         except Exception as e:
             logger.error(f"Failed to process feed {url}: {e}")
+            INGEST_ERRORS.inc(feed=feed_name(url), stage="write")
 
-    logger.info("Poll cycle complete.")
+    expire_trip_state(time.time())
+    CYCLE_SECONDS.observe(time.time() - start)
+    logger.info(f"Poll cycle complete in {time.time() - start:.1f}s.")
 
 async def poll_loop():
+    await asyncio.to_thread(load_trip_state)
+    try:
+        while True:
+            # Each feed comes due on its own schedule (see FeedSchedule)
+            due = due_feeds(FEED_URLS, time.time())
+            if due:
+                try:
+                    await asyncio.to_thread(run_poll_cycle, due)
+                except Exception as e:
+                    # Feeds not written in this cycle are still due and are retried next time
+                    logger.error(f"Poll cycle failed: {e}")
+            await asyncio.sleep(min(max(next_due_time(FEED_URLS) - time.time(), 0.5), MIN_POLL_INTERVAL))
+    finally:
+        shutdown_parse_pool()
+        feed_archive.close()
+
+# Retention runs on its own schedule instead of after every feed
+RETENTION_INTERVAL = 10 * 60
+
+def run_retention():
+    now = time.time()
+    with RETENTION_RUN_SECONDS.time(), get_db() as conn:
+        dropped = prune_positions(conn, now - RETENTION_SECONDS)
+        # Create the next period's partition ahead of time, off the ingest path
+        ensure_partitions(conn, (now, now + PARTITION_SECONDS))
+        # After the partitions, so trips whose positions just went can go too
+        trips = dimensions.prune_trips(conn, now)
+    if dropped:
+        logger.info(f"Retention: dropped {dropped} expired position partitions.")
+    if trips:
+        logger.info(f"Retention: deleted {trips} old trips.")
+    segments = feed_archive.run_retention(now)
+    if segments:
+        logger.info(f"Retention: deleted {segments} archived feed segments.")
+
+async def retention_loop():
     while True:
-        await asyncio.to_thread(run_poll_cycle)
-        await asyncio.sleep(10) 
+        try:
+            await asyncio.to_thread(run_retention)
+        except Exception as e:
+            logger.error(f"Error pruning data: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
 
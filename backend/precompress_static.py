@@ -0,0 +1,55 @@
+"""
+Write .br and .gz siblings next to the built frontend files so
+static_files.PrecompressedStaticFiles can serve them without compressing
+per request. Run once after `npm run build` (the Dockerfile does).
+
+Usage:
+    python backend/precompress_static.py [static_dir]
+"""
+import os
+import sys
+import gzip
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE = {".html", ".js", ".mjs", ".css", ".svg", ".json", ".txt", ".map", ".webmanifest"}
+# Below this, headers outweigh the savings
+MIN_SIZE = 1024
+
+def precompress(directory):
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if os.path.splitext(name)[1] not in COMPRESSIBLE:
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            if len(data) < MIN_SIZE:
+                continue
+
+            # Build time, so use the slowest/best settings
+            variants = [(".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                variants.append((".br", brotli.compress(data, quality=11)))
+            for suffix, compressed in variants:
+                if len(compressed) < len(data):
+                    with open(path + suffix, "wb") as f:
+                        f.write(compressed)
+                    written += 1
+            logger.info(f"{os.path.relpath(path, directory)}: {len(data)} bytes -> "
+                        + ", ".join(f"{suffix} {len(c)}" for suffix, c in variants))
+    if brotli is None:
+        logger.warning("brotli not installed, wrote .gz files only")
+    return written
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    directory = sys.argv[1] if len(sys.argv) > 1 else "static"
+    logger.info(f"Wrote {precompress(directory)} precompressed files in {directory}")
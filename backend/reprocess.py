@@ -0,0 +1,159 @@
+"""
+Rebuild positions for a time range from the raw feed archive (feed_archive.py),
+e.g. after a change to distance mapping in gtfs_loader or to the dwell logic.
+
+Archived segments are parsed and extracted in parallel worker processes, with
+each snapshot's fetch time standing in for the poll time. The parent then runs
+the rows through poller.filter_changes feed by feed, in fetch order. Snapshots
+from CONTEXT_SECONDS on either side of the range are read too, so trains
+already dwelling at `since` keep their state and dwell markers still moving at
+`until` end up past it (and are left alone) rather than being cut short.
+Memory holds the rebuilt rows, not every extracted snapshot.
+Finally, in one transaction, it deletes the stored rows of the routes seen in
+the archive for [since, until) and writes the rebuilt ones.
+
+Run it for ranges the live ingestor has finished with (older than
+poller.TRIP_STATE_WINDOW), or with the ingestor stopped: the ingestor keeps
+moving dwell markers it remembers, and those rows are replaced here.
+
+Usage:
+    python backend/reprocess.py --since 2025-01-06T00:00 --until 2025-01-07T00:00 [--workers 4]
+    python backend/reprocess.py --since 1736121600 --until 1736208000 --archive /data/archive --dry-run
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import multiprocessing
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from db import get_db, init_db, ensure_partitions, delete_positions, TIMESTAMP_INDEX
+import dimensions
+import feed_archive
+import poller
+
+logger = logging.getLogger(__name__)
+
+# Snapshots read on either side of the range only for dwell state
+CONTEXT_SECONDS = 30 * 60
+
+def parse_time(value):
+    """Epoch seconds, or an ISO 8601 date/time (local time unless it has an offset)."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+def extract_segment(path, since, until):
+    """Worker: [(fetched_at, trip_rows, position_rows)] for one segment's snapshots in [since, until)."""
+    snapshots = []
+    for fetched_at, _, content in feed_archive.read_segment(path, since, until):
+        try:
+            trip_rows, position_rows = poller.extract_timed(content, now=fetched_at)[0]
+        except Exception as e:
+            logger.warning(f"Skipping unreadable snapshot in {path} at {fetched_at}: {e}")
+            continue
+        snapshots.append((fetched_at, trip_rows, position_rows))
+    return snapshots
+
+class FeedRebuild:
+    """One feed's snapshots replayed through the live change filter, in fetch order."""
+
+    def __init__(self):
+        self.trip_state = {}
+        self.trips = {}  # trip_id -> trip row
+        self.stored = {}  # (trip_id, timestamp) -> position row, so dwell-marker moves can be applied
+        self.snapshots = 0
+
+    def apply(self, snapshots):
+        for _, trip_rows, position_rows in snapshots:
+            for row in trip_rows:
+                # The first snapshot's trip details win, as with ON CONFLICT on the trips table
+                self.trips.setdefault(row[0], row)
+            inserts, moves, _, new_state = poller.filter_changes(position_rows, self.trip_state)
+            for row in inserts:
+                self.stored[(row[0], row[TIMESTAMP_INDEX])] = row
+            for new_ts, trip_id, old_ts in moves:
+                row = self.stored.pop((trip_id, old_ts))
+                self.stored[(trip_id, new_ts)] = row[:TIMESTAMP_INDEX] + (new_ts,) + row[TIMESTAMP_INDEX + 1:]
+            self.trip_state.update(new_state)
+        self.snapshots += len(snapshots)
+
+def reprocess(archive, since, until, workers, feeds=None, dry_run=False):
+    read_since, read_until = since - CONTEXT_SECONDS, until + CONTEXT_SECONDS
+    segments = feed_archive.list_segments(archive, read_since, read_until, feeds)
+    if not segments:
+        logger.warning(f"No archived segments for that range in {archive}")
+        return
+
+    start = time.perf_counter()
+    rebuilds = {}  # feed -> FeedRebuild
+    # spawn, like the poller's parse pool; workers load the station maps once
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=poller._init_parse_worker) as pool:
+        # Results are applied in segment order (oldest first, so each feed's snapshots stay in
+        # fetch order) with a bounded number in flight, so extracted rows never pile up in memory
+        in_flight = deque()
+        for feed, _, path in segments:
+            in_flight.append((feed, pool.submit(extract_segment, path, read_since, read_until)))
+            if len(in_flight) > 2 * workers:
+                feed_done, future = in_flight.popleft()
+                rebuilds.setdefault(feed_done, FeedRebuild()).apply(future.result())
+        for feed_done, future in in_flight:
+            rebuilds.setdefault(feed_done, FeedRebuild()).apply(future.result())
+    filtered = time.perf_counter()
+
+    trips, rows = {}, []
+    for rebuild in rebuilds.values():
+        for trip_id, row in rebuild.trips.items():
+            trips.setdefault(trip_id, row)
+        # Rows outside the range only carried dwell state
+        rows.extend(r for r in rebuild.stored.values() if since <= r[TIMESTAMP_INDEX] < until)
+    routes = {row[1] for row in trips.values() if row[1]}
+    snapshots = sum(r.snapshots for r in rebuilds.values())
+    logger.info(f"{len(segments)} segments, {snapshots} snapshots from {len(rebuilds)} feeds: "
+                f"{len(rows)} positions for {len(routes)} routes ({filtered - start:.1f} s with {workers} workers)")
+    if dry_run:
+        return
+
+    written = time.perf_counter()
+    with get_db() as conn:
+        ensure_partitions(conn, [r[TIMESTAMP_INDEX] for r in rows])
+        try:
+            deleted = delete_positions(conn, since, until, sorted(routes))
+            used = {r[0] for r in rows}
+            interned = dimensions.write(conn, [row for trip_id, row in trips.items() if trip_id in used],
+                                        rows, [], time.time())
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        interned.remember()
+    logger.info(f"Replaced {deleted} stored positions with {len(rows)} in {time.perf_counter() - written:.1f} s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild positions from the feed archive")
+    parser.add_argument("--since", type=parse_time, required=True)
+    parser.add_argument("--until", type=parse_time, required=True)
+    parser.add_argument("--archive", default=feed_archive.ARCHIVE_DIR, help="defaults to FEED_ARCHIVE_DIR")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--feed", action="append", dest="feeds", help="only this feed (repeatable), e.g. gtfs-ace")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be written")
+    args = parser.parse_args()
+    if not args.archive:
+        parser.error("no archive directory: pass --archive or set FEED_ARCHIVE_DIR")
+    if args.until <= args.since:
+        parser.error("--until must be after --since")
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    poller.logger.setLevel(logging.WARNING)
+    init_db()
+    reprocess(args.archive, args.since, args.until, args.workers, args.feeds, args.dry_run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import gzip
+import time
+import asyncio
+import hashlib
+import threading
+from fastapi import Response
+import wire_format
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Rebuild at least this often even without new data, so old trips age out of the window
+CACHE_MAX_AGE = 30
+# Keys include request parameters (window, resolution), so cap how many payloads are kept
+MAX_ENTRIES = 256
+# Payloads are compressed once per build, so favour ratio over speed; brotli 5 is
+# about gzip 6's speed at half the size on history JSON (11 is ~250x slower)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def accepted_encodings(accept_encoding):
+    """Content codings an Accept-Encoding header allows (q=0 excluded)."""
+    codings = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        codings.add(coding.strip().lower())
+    return codings
+
+class CachedResponse:
+    """A serialized payload (see wire_format), its gzip/brotli forms and an ETag, built once per generation."""
+
+    def __init__(self, data, generation, fmt=wire_format.JSON):
+        self.generation = generation
+        self.built_at = time.time()
+        self.media_type = wire_format.MEDIA_TYPES[fmt]
+        self.body = wire_format.encode(data, fmt)
+        self.gzip_body = gzip.compress(self.body, compresslevel=GZIP_LEVEL)
+        self.br_body = brotli.compress(self.body, quality=BROTLI_QUALITY) if brotli else None
+        # Content hash, so a rebuild with identical data still matches the client's copy
+        self.etag = '"' + hashlib.blake2b(self.body, digest_size=8).hexdigest() + '"'
+
+    def is_fresh(self, generation):
+        return self.generation == generation and time.time() - self.built_at < CACHE_MAX_AGE
+
+    def response(self, request):
+        headers = {"ETag": self.etag, "Cache-Control": "no-cache", "Vary": "Accept, Accept-Encoding"}
+
+        if_none_match = request.headers.get("if-none-match", "")
+        if self.etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        if self.br_body is not None and "br" in accepted:
+            headers["Content-Encoding"] = "br"
+            return Response(self.br_body, media_type=self.media_type, headers=headers)
+        if "gzip" in accepted:
+            headers["Content-Encoding"] = "gzip"
+            return Response(self.gzip_body, media_type=self.media_type, headers=headers)
+        return Response(self.body, media_type=self.media_type, headers=headers)
+
+_cache = {}  # key -> CachedResponse
+_locks = {}  # key -> Lock, so only one request rebuilds a given entry
+_locks_lock = threading.Lock()
+_async_locks = {}  # key -> asyncio.Lock for get_async
+
+def peek(key, generation):
+    """The cached response for key if it is still fresh, else None."""
+    entry = _cache.get(key)
+    if entry and entry.is_fresh(generation):
+        return entry
+    return None
+
+def get(key, generation, build, fmt=wire_format.JSON):
+    """
+    Return the cached response for key, calling build() only if the generation moved on.
+    Keys must include fmt when one payload is served in several formats.
+    """
+    entry = peek(key, generation)
+    if entry:
+        return entry
+
+    with _locks_lock:
+        lock = _locks.setdefault(key, threading.Lock())
+    with lock:
+        entry = _cache.get(key)
+        if entry and entry.is_fresh(generation):
+            return entry
+        entry = CachedResponse(build(), generation, fmt)
+        _cache[key] = entry
+        if len(_cache) > MAX_ENTRIES:
+            oldest = min(_cache, key=lambda k: _cache[k].built_at)
+            _cache.pop(oldest, None)
+            # Locks go with their entries; a holder keeps its own reference
+            with _locks_lock:
+                _locks.pop(oldest, None)
+            _async_locks.pop(oldest, None)
+        return entry
+
+async def get_async(key, generation, load, build, fmt=wire_format.JSON):
+    """
+    get() for payloads whose input comes from an async source: awaits load(), then
+    runs build(loaded) in a thread. Concurrent misses on a key wait for one load.
+    """
+    entry = peek(key, generation)
+    if entry:
+        return entry
+
+    lock = _async_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        entry = peek(key, generation)
+        if entry:
+            return entry
+        loaded = await load()
+        return await asyncio.to_thread(get, key, generation, lambda: build(loaded), fmt)
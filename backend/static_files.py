@@ -0,0 +1,50 @@
+import os
+import mimetypes
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from response_cache import accepted_encodings
+
+# Vite fingerprints everything under assets/, so those files never change in place
+IMMUTABLE_PREFIX = "assets" + os.sep
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# index.html and unhashed files: revalidate (ETag / Last-Modified) on every load
+REVALIDATE_CACHE = "no-cache"
+
+# Sibling suffix per content coding, in order of preference
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles that serves file.br / file.gz (written at build time by
+    precompress_static.py) to clients that accept them, with cache headers
+    suited to the fingerprinted build.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        full_path = os.fspath(full_path)
+        media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+
+        response = None
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+        for coding, suffix in PRECOMPRESSED:
+            if coding not in accepted:
+                continue
+            try:
+                sibling_stat = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            response = FileResponse(full_path + suffix, status_code=status_code,
+                                    stat_result=sibling_stat, media_type=media_type)
+            response.headers["Content-Encoding"] = coding
+            break
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+
+        relative = os.path.relpath(full_path, self.directory)
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE if relative.startswith(IMMUTABLE_PREFIX) else REVALIDATE_CACHE
+        response.headers["Vary"] = "Accept-Encoding"
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,101 @@
+"""
+Encodings for history payloads.
+
+JSON (the default) goes through dumps(), which uses orjson when it is installed.
+
+The columnar format is an opt-in binary form of the same trips list, for
+clients that ask for it (?format=columns or Accept: application/vnd.stringlines.columns).
+Instead of a {"timestamp", "distance", "stop_id"} object per point it sends
+one typed array per field. All numbers are little-endian:
+
+    b"SLC1"                 magic and version
+    uint32                  header length H
+    H bytes                 JSON header: {"base", "time_scale", "distance_scale",
+                            "stops": [stop_id, ...],
+                            "trips": [[trip_id, route_id, direction_id, n_points], ...]}
+    0-3 zero bytes          padding to a multiple of 4
+    int32[N]                timestamps in 1/time_scale s; each trip's first point
+                            relative to base, the rest relative to the point before
+    int32[N]                distances in 1/distance_scale units
+    uint16[N]               index into "stops"
+
+Points are grouped by trip in header order (N = sum of n_points).
+bench/bench_wire_format.py decodes it back to check the round trip.
+"""
+import json
+import struct
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON = "json"
+COLUMNS = "columns"
+MEDIA_TYPES = {
+    JSON: "application/json",
+    COLUMNS: "application/vnd.stringlines.columns",
+}
+
+MAGIC = b"SLC1"
+TIME_SCALE = 1000      # milliseconds
+DISTANCE_SCALE = 1000  # finer than history.SAME_DISTANCE
+
+def dumps(data):
+    """Compact JSON as bytes."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+def negotiate(fmt, accept):
+    """Format for a request: the ?format= parameter if given, else the Accept header."""
+    if fmt in MEDIA_TYPES:
+        return fmt
+    if MEDIA_TYPES[COLUMNS] in (accept or ""):
+        return COLUMNS
+    return JSON
+
+def encode(data, fmt=JSON):
+    if fmt == COLUMNS:
+        return encode_columns(data)
+    return dumps(data)
+
+def encode_columns(trips):
+    """Columnar bytes for a list of trips shaped like /api/history's JSON."""
+    stop_index = {}
+    header_trips = []
+    ts, dist, stops = [], [], []
+    for trip in trips:
+        positions = trip["positions"]
+        header_trips.append([trip["trip_id"], trip["route_id"], trip["direction_id"], len(positions)])
+        for p in positions:
+            ts.append(p["timestamp"])
+            dist.append(p["distance"])
+            stops.append(stop_index.setdefault(p["stop_id"], len(stop_index)))
+
+    ts = np.round(np.asarray(ts, dtype=np.float64) * TIME_SCALE).astype(np.int64)
+    base = int(ts.min()) if len(ts) else 0
+    deltas = np.diff(ts, prepend=base)
+    # Each trip restarts from base, so a trip's points never depend on another trip's
+    first = np.cumsum([0] + [t[3] for t in header_trips[:-1]])
+    first = first[first < len(ts)]
+    deltas[first] = ts[first] - base
+
+    header = dumps({
+        "base": base / TIME_SCALE,
+        "time_scale": TIME_SCALE,
+        "distance_scale": DISTANCE_SCALE,
+        "stops": list(stop_index),
+        "trips": header_trips,
+    })
+    padding = b"\0" * (-(len(MAGIC) + 4 + len(header)) % 4)
+    return b"".join((
+        MAGIC,
+        struct.pack("<I", len(header)),
+        header,
+        padding,
+        deltas.astype("<i4").tobytes(),
+        np.round(np.asarray(dist, dtype=np.float64) * DISTANCE_SCALE).astype("<i4").tobytes(),
+        np.asarray(stops, dtype="<u2").tobytes(),
+    ))
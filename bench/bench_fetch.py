@@ -0,0 +1,50 @@
+"""
+Compare sequential vs pipelined feed fetching + extraction against the local stub server.
+
+Usage:
+    python bench/bench_fetch.py --delay 1.0 --slow gtfs-ace=4 --rounds 3
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import poller
+from stub_feed_server import start_server, parse_slow
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=1.0)
+    parser.add_argument("--slow", action="append", help="Per-feed delay override, e.g. gtfs-ace=4")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    server, base_url = start_server(delay=args.delay, slow=parse_slow(args.slow))
+    urls = sorted(base_url + "/" + url.rsplit("/", 1)[-1] for url in poller.FEED_URLS)
+    print(f"{len(urls)} feeds, base delay {args.delay}s, overrides {args.slow or 'none'}")
+
+    for i in range(args.rounds):
+        poller._schedules.clear()  # Forget ETags/header timestamps so every feed is processed
+        start = time.perf_counter()
+        feeds = [poller.extract_content(poller.download_feed(url)) for url in urls]
+        sequential = time.perf_counter() - start
+
+        poller._schedules.clear()
+        start = time.perf_counter()
+        concurrent = [extracted for _, extracted in poller.fetch_and_extract(urls)]
+        concurrent_time = time.perf_counter() - start
+
+        ok = sum(1 for f in feeds if f) == sum(1 for f in concurrent if f) == len(urls)
+        print(f"round {i + 1}: sequential {sequential:.2f}s  concurrent {concurrent_time:.2f}s  "
+              f"speedup {sequential / concurrent_time:.1f}x  {'ok' if ok else 'MISSING FEEDS'}")
+
+    server.shutdown()
+    poller.shutdown_parse_pool()
+
+
+if __name__ == "__main__":
+    main()
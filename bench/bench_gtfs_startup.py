@@ -0,0 +1,52 @@
+"""
+Cold-start benchmark for gtfs_loader.load_data: full CSV parse vs the compiled index.
+
+Each run is a fresh interpreter, like a web worker or ingestor starting up.
+The repo doesn't ship stop_times.txt; point GTFS_DIR at a full MTA static feed.
+
+Usage:
+    GTFS_DIR=/path/to/gtfs_subway python bench/bench_gtfs_startup.py [--runs 3]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, "backend")
+
+CHILD = """
+import logging, time
+start = time.perf_counter()
+import gtfs_loader
+gtfs_loader.load_data()
+print(time.perf_counter() - start, len(gtfs_loader._ROUTE_STATION_MAP))
+"""
+
+
+def run_child():
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", CHILD], cwd=ROOT, env=dict(os.environ, PYTHONPATH=BACKEND),
+                         capture_output=True, text=True, check=True).stdout.split()
+    return time.perf_counter() - start, float(out[0]), int(out[1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    sys.path.append(BACKEND)
+    import gtfs_loader
+
+    for label, keep_index in (("csv parse (no index)", False), ("compiled index", True)):
+        for i in range(args.runs):
+            if not keep_index and os.path.exists(gtfs_loader.INDEX_FILE):
+                os.remove(gtfs_loader.INDEX_FILE)
+            total, load, routes = run_child()
+            print(f"{label:22} run {i + 1}: load_data {load * 1000:8.1f} ms, process {total * 1000:8.1f} ms, {routes} routes")
+
+
+if __name__ == "__main__":
+    main()
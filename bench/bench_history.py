@@ -0,0 +1,168 @@
+"""
+Benchmark the columnar dwell filter / trip grouping in history.py against the
+original per-point Python loop from get_history.
+
+Inputs are built from q_line_data.json: the 30-minute dump as-is, and a
+24-hour version made by repeating it every 30 minutes with fresh trip ids.
+Both implementations get the same raw rows and must produce the same output.
+
+Usage:
+    python bench/bench_history.py [--repeat 20]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "backend"))
+
+import gtfs_loader
+import history
+import history_store
+
+LINE = "Q"
+
+
+def legacy_terminal_stations(line):
+    """The original get_terminal_stations: builds and sorts the station list on every call."""
+    stations = gtfs_loader.get_stations_list(line)
+    if not stations:
+        return set()
+    return {stations[0]["id"], stations[-1]["id"]}
+
+
+def legacy_get_history(rows, line):
+    """The original get_history body after the SQL query (rows are dicts ordered by timestamp)."""
+    trips = {}
+    for r in rows:
+        tid = r["trip_id"]
+        if tid not in trips:
+            trips[tid] = {"trip_id": tid, "route_id": line, "direction_id": r["direction_id"], "positions": []}
+        trips[tid]["positions"].append({"timestamp": r["timestamp"], "distance": r["distance"], "stop_id": r["stop_id"]})
+
+    terminals = legacy_terminal_stations(line)
+
+    final_trips = []
+    for trip in trips.values():
+        positions = trip["positions"]
+        if not positions:
+            continue
+        filtered_positions = []
+        current_dwell = [positions[0]]
+        for i in range(1, len(positions)):
+            pos = positions[i]
+            prev = positions[i - 1]
+            if abs(pos["distance"] - prev["distance"]) < 0.01:
+                current_dwell.append(pos)
+            else:
+                duration = current_dwell[-1]["timestamp"] - current_dwell[0]["timestamp"]
+                stop_id = current_dwell[0]["stop_id"]
+                base_stop_id = stop_id[:-1] if len(stop_id) > 3 else stop_id
+                if duration > 180 and base_stop_id in terminals:
+                    filtered_positions.append(current_dwell[-1])
+                else:
+                    filtered_positions.extend(current_dwell)
+                current_dwell = [pos]
+        if current_dwell:
+            duration = current_dwell[-1]["timestamp"] - current_dwell[0]["timestamp"]
+            stop_id = current_dwell[0]["stop_id"]
+            base_stop_id = stop_id[:-1] if len(stop_id) > 3 else stop_id
+            if duration > 180 and base_stop_id in terminals:
+                filtered_positions.append(current_dwell[-1])
+            else:
+                filtered_positions.extend(current_dwell)
+        if len(filtered_positions) > 1:
+            trip["positions"] = filtered_positions
+            final_trips.append(trip)
+    return final_trips
+
+
+def columnar_get_history(columns, line):
+    """history.build_history minus the store lookup, on pre-built columns."""
+    return history._build_trips(line, columns)
+
+
+def load_rows(copies):
+    with open(os.path.join(ROOT, "q_line_data.json")) as f:
+        data = json.load(f)
+    span = 30 * 60
+    rows = []
+    for k in range(copies):
+        for trip in data:
+            for p in trip["positions"]:
+                rows.append({
+                    "trip_id": f"{trip['trip_id']}#{k}", "timestamp": p["timestamp"] + k * span,
+                    "distance": p["distance"], "stop_id": p["stop_id"], "direction_id": trip["direction_id"],
+                })
+    rows.sort(key=lambda r: r["timestamp"])
+    return data, rows
+
+
+def to_columns(rows):
+    trip_index, trip_ids, directions = {}, [], {}
+    for r in rows:
+        if r["trip_id"] not in trip_index:
+            trip_index[r["trip_id"]] = len(trip_ids)
+            trip_ids.append(r["trip_id"])
+        directions[r["trip_id"]] = r["direction_id"]
+    n = len(rows)
+    return (
+        np.fromiter((r["timestamp"] for r in rows), dtype=np.float64, count=n),
+        np.fromiter((r["distance"] for r in rows), dtype=np.float64, count=n),
+        np.fromiter((trip_index[r["trip_id"]] for r in rows), dtype=np.int64, count=n),
+        np.fromiter((history_store._stop_slot(r["stop_id"]) for r in rows), dtype=np.int64, count=n),
+        np.ones(n, dtype=np.int64),
+        trip_ids, directions,
+    )
+
+
+def use_sample_station_map(data):
+    """The repo doesn't ship stop_times.txt, so derive the Q station order from the sample itself."""
+    if gtfs_loader.get_stations_list(LINE):
+        return
+    stations = {}
+    for trip in data:
+        for p in trip["positions"]:
+            stations[gtfs_loader._base_stop_id(p["stop_id"])] = p["distance"]
+    gtfs_loader._ROUTE_STATION_MAP[LINE] = stations
+    gtfs_loader._ROUTE_TERMINALS[LINE] = gtfs_loader._terminals_from_map(stations)
+
+
+def timeit(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for label, copies in (("30 min (q_line_data.json)", 1), ("24 h", 48)):
+        data, rows = load_rows(copies)
+        use_sample_station_map(data)
+        columns = to_columns(rows)
+
+        legacy = legacy_get_history(rows, LINE)
+        columnar = columnar_get_history(columns, LINE)
+        assert legacy == columnar, "columnar output differs from the original implementation"
+
+        t_legacy = timeit(lambda: legacy_get_history(rows, LINE), args.repeat)
+        t_columnar = timeit(lambda: columnar_get_history(columns, LINE), args.repeat)
+        t_filter = timeit(lambda: history._prepare(LINE, columns), args.repeat)
+        print(f"{label}: {len(rows)} points, {len(legacy)} trips")
+        print(f"  original loop      {t_legacy * 1000:8.2f} ms")
+        print(f"  columnar total     {t_columnar * 1000:8.2f} ms  ({t_legacy / t_columnar:.1f}x)")
+        print(f"    sort + filter    {t_filter * 1000:8.2f} ms  (rest is building the JSON-ready dicts)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Time /api/history for long windows against the default 30-minute one.
+
+Fills a scratch SQLite database with 24 hours of the Q line: q_line_data.json
+replayed every 30 minutes with fresh trip ids, polled every 10 s and stored
+the way the poller stores it (arrival + dwell-end rows only). Then times the
+endpoint with the FastAPI test client: cold (read from the DB and built), from
+the line's shared rollup (another window or resolution was read already) and
+cached.
+
+Usage:
+    GTFS_DIR=gtfs_subway python bench/bench_history_window.py [--repeat 20]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "backend"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+os.environ["DISABLE_POLLER"] = "true"
+
+from fastapi.testclient import TestClient
+
+import db
+import dimensions
+import history_store
+import poller
+import response_cache
+from bench_history import LINE, use_sample_station_map
+
+SPAN = 30 * 60
+
+
+def fill(copies):
+    with open(os.path.join(ROOT, "q_line_data.json")) as f:
+        data = json.load(f)
+    use_sample_station_map(data)
+    base = max(p["timestamp"] for t in data for p in t["positions"])
+    shift = time.time() - base - 60 - (copies - 1) * SPAN
+
+    polls = {}
+    for k in range(copies):
+        for trip in data:
+            tid = f"{trip['trip_id']}#{k}"
+            for p in trip["positions"]:
+                ts = p["timestamp"] + shift + k * SPAN
+                polls.setdefault(round(ts), []).append(
+                    (tid, ts, p["stop_id"], p["distance"], LINE, trip["direction_id"])
+                )
+
+    samples = 0
+    trips = {f"{t['trip_id']}#{k}": (f"{t['trip_id']}#{k}", LINE, "", t["direction_id"])
+             for k in range(copies) for t in data}
+    with db.get_db() as conn:
+        for ts in sorted(polls):
+            rows = polls[ts]
+            samples += len(rows)
+            inserts, moves, _, state = poller.filter_changes(rows, poller._trip_state)
+            db.ensure_partitions(conn, [r[1] for r in rows])
+            interned = dimensions.write(conn, [trips[tid] for tid in {r[0] for r in rows}], inserts, moves, ts)
+            conn.commit()
+            interned.remember()
+            poller._trip_state.update(state)
+    return samples
+
+
+def timeit(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    import main as app_main
+    db.init_db()
+    samples = fill(48)
+    with db.get_db() as conn:
+        stored = conn.execute("SELECT COUNT(*) FROM positions").fetchone()[0]
+    print(f"24 h of 10 s samples: {samples} rows polled, {stored} stored")
+
+    with TestClient(app_main.app) as client:
+        use_sample_station_map(json.load(open(os.path.join(ROOT, "q_line_data.json"))))
+        for params in ("minutes=30", "minutes=45", "minutes=1440", "minutes=1440&resolution=60",
+                       "minutes=1440&resolution=300"):
+            url = f"/api/history?line={LINE}&{params}"
+
+            def from_rollup():
+                response_cache._cache.clear()
+                return client.get(url, headers={"Accept-Encoding": "identity"})
+
+            def cold():
+                history_store._rollups.clear()
+                return from_rollup()
+
+            response = cold()
+            points = sum(len(t["positions"]) for t in response.json())
+            t_cold = timeit(cold, args.repeat)
+            t_rollup = timeit(from_rollup, args.repeat)
+            t_cached = timeit(lambda: client.get(url, headers={"Accept-Encoding": "identity"}), args.repeat)
+            gz = int(client.get(url, headers={"Accept-Encoding": "gzip"}).headers["content-length"])
+            print(f"{params:<28} {len(response.json()):4} trips {points:6} points  "
+                  f"{len(response.content) / 1024:7.1f} KB ({gz / 1024:6.1f} KB gzip)  "
+                  f"cold {t_cold * 1000:6.1f} ms  rollup {t_rollup * 1000:6.1f} ms  cached {t_cached * 1000:5.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
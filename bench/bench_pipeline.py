@@ -0,0 +1,83 @@
+"""
+Time full poll cycles (fetch -> parse/extract -> write) against the local stub
+server, with the parse stage in the fetch threads vs in a process pool.
+
+Every endpoint serves the captured ACE feed, so each cycle parses one full
+feed per URL (feed schedules are reset between cycles). Writes go to a scratch
+SQLite database. Use --delay 0 to see the CPU-bound case and a realistic delay
+to see parsing overlap the network. The last lines time a poll where nothing
+changed, answered by 304 or skipped on the feed header timestamp.
+
+Usage:
+    GTFS_DIR=gtfs_subway python bench/bench_pipeline.py [--delay 0.3] [--cycles 5] [--workers 4]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "backend"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import db
+import gtfs_loader
+import poller
+from stub_feed_server import start_server
+
+
+def run_cycles(urls, cycles):
+    poller._trip_state = {}
+    times = []
+    for _ in range(cycles):
+        poller._schedules.clear()
+        start = time.perf_counter()
+        poller.FEED_URLS = urls
+        poller.run_poll_cycle()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=0.3)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=poller.PARSE_WORKERS or 4)
+    args = parser.parse_args()
+
+    poller.logger.setLevel("WARNING")
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db.init_db()
+    gtfs_loader.load_data()
+
+    server, base_url = start_server(delay=args.delay)
+    urls = {base_url + "/" + url.rsplit("/", 1)[-1] for url in poller.FEED_URLS}
+    print(f"{len(urls)} feeds, delay {args.delay}s, {args.cycles} cycles, {os.cpu_count()} CPUs")
+
+    results = {}
+    for label, workers in (("parse in fetch threads", 0), (f"parse in {args.workers} processes", args.workers)):
+        poller.shutdown_parse_pool()
+        poller.PARSE_WORKERS = workers
+        if workers:
+            poller.get_parse_pool().submit(int).result()  # Start the workers outside the timing
+        results[label] = run_cycles(urls, args.cycles)
+        best, mean = results[label]
+        print(f"  {label:<26} best {best * 1000:7.0f} ms  mean {mean * 1000:7.0f} ms")
+    server.shutdown()
+
+    for label, etag in (("unchanged, 304", True), ("unchanged, same header", False)):
+        server, base_url = start_server(delay=args.delay, etag=etag)
+        urls = {base_url + "/" + url.rsplit("/", 1)[-1] for url in poller.FEED_URLS}
+        poller._schedules.clear()
+        poller.run_poll_cycle(urls)
+        start = time.perf_counter()
+        poller.run_poll_cycle(urls)
+        print(f"  {label:<26} {(time.perf_counter() - start) * 1000:12.0f} ms")
+        server.shutdown()
+
+    poller.shutdown_parse_pool()
+
+
+if __name__ == "__main__":
+    main()
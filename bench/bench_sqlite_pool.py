@@ -0,0 +1,128 @@
+"""
+Benchmark SQLite reads through db.get_db's connection pool against the original
+connect-per-request get_db.
+
+Each "request" is what a DB-backed history read does: take a connection, run
+history_store.ROUTE_WINDOW_QUERY for one route's last 30 minutes, fetch all rows,
+give the connection back. Worker threads issue requests back to back for a fixed
+time, optionally while an ingest thread commits a feed-sized batch every 100 ms.
+
+Usage:
+    python bench/bench_sqlite_pool.py [--threads 8] [--seconds 5] [--hours 6]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "backend"))
+
+import db
+import dimensions
+import history_store
+
+ROUTES = [f"R{i}" for i in range(25)]
+TRIPS_PER_ROUTE = 40
+
+
+@contextmanager
+def legacy_get_db():
+    """The original SQLite branch of get_db: a new connection per unit of work."""
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def fill(hours):
+    now = time.time()
+    trips = [(f"{r}_{k}", r, "", k % 2) for r in ROUTES for k in range(TRIPS_PER_ROUTE)]
+    with db.get_db() as conn:
+        # One arrival row per trip per minute, like the change-only ingest writes
+        for minute in range(hours * 60, 0, -1):
+            ts = now - minute * 60
+            db.ensure_partitions(conn, [ts])
+            interned = dimensions.write(conn, trips, [
+                (tid, ts, "A01N", float(minute % 100), route, direction) for tid, route, _, direction in trips
+            ], [], now)
+            conn.commit()
+            interned.remember()
+    return len(trips) * hours * 60
+
+
+def ingest(get_conn, stop):
+    """Commit a feed-sized batch of new rows every 100 ms until stopped (partitions exist from init_db)."""
+    trips = [(f"{r}_{k}", r, "", k % 2) for r in ROUTES for k in range(TRIPS_PER_ROUTE)][:200]
+    while not stop.is_set():
+        ts = time.time()
+        with get_conn() as conn:
+            interned = dimensions.write(conn, trips, [(tid, ts, "A02N", 1.0, route, d) for tid, route, _, d in trips], [], ts)
+            conn.commit()
+            interned.remember()
+        time.sleep(0.1)
+
+
+def run(get_read_conn, get_write_conn, threads, seconds, with_ingest):
+    stop = threading.Event()
+    counts = [0] * threads
+    latencies = [[] for _ in range(threads)]
+
+    def worker(i):
+        rng = random.Random(i)
+        while not stop.is_set():
+            start = time.perf_counter()
+            now = time.time()
+            with get_read_conn() as conn:
+                conn.execute(history_store.ROUTE_WINDOW_QUERY.sql, (rng.choice(ROUTES), now - 1800, now)).fetchall()
+            latencies[i].append(time.perf_counter() - start)
+            counts[i] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    if with_ingest:
+        workers.append(threading.Thread(target=ingest, args=(get_write_conn, stop)))
+    for t in workers:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in workers:
+        t.join()
+
+    all_latencies = sorted(x for lat in latencies for x in lat)
+    p99 = all_latencies[int(len(all_latencies) * 0.99)] if all_latencies else 0.0
+    return sum(counts) / seconds, p99
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--hours", type=int, default=6)
+    args = parser.parse_args()
+
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db.init_db()
+    rows = fill(args.hours)
+    print(f"{rows} rows over {args.hours} h, {len(ROUTES)} routes, {args.threads} reader threads")
+
+    pooled_read = lambda: db.get_db(readonly=True)
+    for with_ingest in (False, True):
+        label = "with ingest writes" if with_ingest else "reads only"
+        legacy = run(legacy_get_db, legacy_get_db, args.threads, args.seconds, with_ingest)
+        pooled = run(pooled_read, db.get_db, args.threads, args.seconds, with_ingest)
+        print(f"{label}:")
+        print(f"  connect per request {legacy[0]:8.0f} req/s  p99 {legacy[1] * 1000:6.2f} ms")
+        print(f"  pooled              {pooled[0]:8.0f} req/s  p99 {pooled[1] * 1000:6.2f} ms"
+              f"  ({pooled[0] / legacy[0]:.1f}x)")
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark registered statements (db.fetch: placeholders rewritten once, PREPAREd
+on Postgres, plain tuple rows) against ad-hoc db.execute_query (rewrite per call,
+sqlite3.Row / RealDictCursor rows).
+
+Runs the history store's sync query over the last 2 minutes (a typical sync) and
+over the whole 30-minute window (a warm load). SQLite uses a scratch database
+filled like a busy line; with DATABASE_URL set it reads that database instead.
+
+Usage:
+    python bench/bench_statements.py [--repeat 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "backend"))
+
+import db
+import dimensions
+import history_store
+
+
+def fill():
+    now = time.time()
+    trips = [(f"T{k}", f"R{k % 25}", "", k % 2) for k in range(1000)]
+    with db.get_db() as conn:
+        rows = [(tid, now - minute * 60, "A01N", 1.0, route, d) for minute in range(30, 0, -1) for tid, route, _, d in trips]
+        db.ensure_partitions(conn, [r[1] for r in rows])
+        dimensions.write(conn, trips, rows, [], now)
+        conn.commit()
+
+
+def execute_and_read(conn, sql, since):
+    # What the old load_from_db did: rows by name, then rebuilt as tuples
+    return [
+        (r["route_id"], r["trip_key"], r["direction_id"], r["timestamp"], r["stop_key"], r["distance"])
+        for r in db.execute_query(conn, sql, (since,)).fetchall()
+    ]
+
+
+def timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    if db.get_db_type() == "sqlite":
+        db.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+        db.init_db()
+        fill()
+    stmt = history_store.LOAD_QUERY
+
+    with db.get_db(readonly=True) as conn:
+        for label, window in (("sync (2 min)", 120), ("warm load (30 min)", 1800)):
+            since = time.time() - window
+            n = len(db.fetch(conn, stmt, (since,)))
+            adhoc = timeit(lambda: execute_and_read(conn, stmt.sql, since), args.repeat)
+            registered = timeit(lambda: db.fetch(conn, stmt, (since,)), args.repeat)
+            print(f"{db.get_db_type()} {label}: {n} rows")
+            print(f"  execute_query  {adhoc * 1000:8.3f} ms")
+            print(f"  fetch          {registered * 1000:8.3f} ms  ({adhoc / registered:.1f}x)")
+        if db.get_db_type() == "postgres":
+            conn.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Compare /api/history encodings: the original json.dumps, orjson (the default
+when installed) and the opt-in columnar format from wire_format.py.
+
+Payloads are built with history._build_trips from q_line_data.json, for the
+30-minute window and a 24-hour one (the dump repeated every 30 minutes with
+fresh trip ids). Reports raw and gzip size plus encode time; the columnar
+payload must decode back to the JSON one within its rounding.
+
+Usage:
+    python bench/bench_wire_format.py [--repeat 50]
+"""
+import argparse
+import gzip
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "backend"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import history
+import wire_format
+from bench_history import LINE, load_rows, timeit, to_columns, use_sample_station_map
+
+
+def stdlib_json(trips):
+    """What response_cache did before: json.dumps with compact separators."""
+    return json.dumps(trips, separators=(",", ":")).encode()
+
+
+def decode_columns(body):
+    """Inverse of wire_format.encode_columns (timestamps and distances rounded to their scale)."""
+    if body[:4] != wire_format.MAGIC:
+        raise ValueError("not a columnar history payload")
+    (header_length,) = struct.unpack_from("<I", body, 4)
+    header = json.loads(body[8:8 + header_length])
+    offset = 8 + header_length
+    offset += -offset % 4
+    n = sum(t[3] for t in header["trips"])
+
+    deltas = np.frombuffer(body, dtype="<i4", count=n, offset=offset).astype(np.int64)
+    dist = np.frombuffer(body, dtype="<i4", count=n, offset=offset + 4 * n) / header["distance_scale"]
+    stops = np.frombuffer(body, dtype="<u2", count=n, offset=offset + 8 * n)
+    base = round(header["base"] * header["time_scale"])
+
+    trips = []
+    start = 0
+    for trip_id, route_id, direction_id, count in header["trips"]:
+        ts = (base + np.cumsum(deltas[start:start + count])) / header["time_scale"]
+        trips.append({
+            "trip_id": trip_id,
+            "route_id": route_id,
+            "direction_id": direction_id,
+            "positions": [
+                {"timestamp": t, "distance": d, "stop_id": header["stops"][s]}
+                for t, d, s in zip(ts.tolist(), dist[start:start + count].tolist(), stops[start:start + count].tolist())
+            ],
+        })
+        start += count
+    return trips
+
+
+def check_round_trip(trips, body):
+    decoded = decode_columns(body)
+    assert [t["trip_id"] for t in decoded] == [t["trip_id"] for t in trips]
+    for a, b in zip(trips, decoded):
+        assert a["direction_id"] == b["direction_id"] and len(a["positions"]) == len(b["positions"])
+        for p, q in zip(a["positions"], b["positions"]):
+            assert p["stop_id"] == q["stop_id"]
+            assert abs(p["timestamp"] - q["timestamp"]) <= 0.5 / wire_format.TIME_SCALE
+            assert abs(p["distance"] - q["distance"]) <= 0.5 / wire_format.DISTANCE_SCALE
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    encoders = [("json.dumps", stdlib_json)]
+    if wire_format.orjson is not None:
+        encoders.append(("orjson", wire_format.orjson.dumps))
+    else:
+        print("orjson not installed, skipping it")
+    encoders.append(("columns", wire_format.encode_columns))
+
+    for label, copies in (("30 min (q_line_data.json)", 1), ("24 h", 48)):
+        data, rows = load_rows(copies)
+        use_sample_station_map(data)
+        trips = history._build_trips(LINE, to_columns(rows))
+        points = sum(len(t["positions"]) for t in trips)
+        check_round_trip(trips, wire_format.encode_columns(trips))
+        print(f"{label}: {len(trips)} trips, {points} points")
+
+        baseline = None
+        for name, encode in encoders:
+            body = encode(trips)
+            gz = gzip.compress(body, compresslevel=6)
+            t = timeit(lambda: encode(trips), args.repeat)
+            t_gz = timeit(lambda: gzip.compress(encode(trips), compresslevel=6), args.repeat)
+            baseline = baseline or t
+            print(f"  {name:<11} {len(body) / 1024:8.1f} KB  gzip {len(gz) / 1024:7.1f} KB  "
+                  f"encode {t * 1000:7.2f} ms ({baseline / t:4.1f}x)  encode+gzip {t_gz * 1000:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Check that the history reads on positions are join-free and answered from the
+covering (route_id, timestamp) index alone.
+
+SQLite: builds a scratch database with db.init_db, fills a few partitions and
+checks EXPLAIN QUERY PLAN for every partition behind the positions view.
+
+Postgres (when DATABASE_URL is set): runs EXPLAIN (FORMAT JSON) against that
+database, read-only. Sequential and bitmap scans are disabled for the check so
+the result doesn't depend on how many rows the tables hold: a non-covering
+index shows up as "Index Scan" instead of "Index Only Scan". Index-only scans
+also need a reasonably fresh visibility map, so run VACUUM first on a busy DB.
+
+Usage:
+    python bench/check_history_plan.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "backend"))
+
+import db
+import dimensions
+import history_store
+
+JOIN_NODES = {"Nested Loop", "Hash Join", "Merge Join"}
+
+
+def check_sqlite():
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), "plan.db")
+    db.init_db()
+    now = time.time()
+    with db.get_db() as conn:
+        db.ensure_partitions(conn, [now - k * db.PARTITION_SECONDS for k in range(4)])
+        dimensions.write(conn, [(f"t{i}", route, "", i % 2) for i, route in enumerate("ABCDQ" * 20)], [
+            (f"t{i % 100}", now - k * 7, "R30S", float(k % 50), "ABCDQ"[i % 5], i % 2)
+            for i in range(100) for k in range(60)
+        ], [], now)
+        conn.commit()
+        conn.execute("ANALYZE")
+
+        plan = conn.execute("EXPLAIN QUERY PLAN " + history_store.ROUTE_WINDOW_QUERY.sql,
+                            ("Q", now - 1800, now)).fetchall()
+    details = [row[3] for row in plan]
+    print("SQLite plan:")
+    for detail in details:
+        print(f"  {detail}")
+
+    scans = [d for d in details if d.startswith(("SCAN", "SEARCH"))]
+    partitions = len(db._known_partitions)
+    assert not any("trips" in d for d in details), "plan reads trips"
+    assert len(scans) == partitions, f"expected one search per partition ({partitions}), got {len(scans)}"
+    assert all(d.startswith("SEARCH") and "COVERING INDEX" in d and "_route_ts" in d for d in scans), \
+        "a partition is not read through the covering route index"
+    print(f"  OK: {partitions} partitions, each a covering-index search, no join")
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get("Plans", ()):
+        yield from _plan_nodes(child)
+
+
+def check_postgres():
+    now = time.time()
+    with db.get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL enable_seqscan = off")
+            cur.execute("SET LOCAL enable_bitmapscan = off")
+            cur.execute("EXPLAIN (FORMAT JSON) " + history_store.ROUTE_WINDOW_QUERY.pg_sql, ("Q", now - 1800, now))
+            plan = cur.fetchone()[0][0]["Plan"]
+            # Partitions name their copy of a parent index after its columns; map them back
+            cur.execute("""
+                SELECT c.relname, p.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+                WHERE p.relkind = 'I'
+            """)
+            parent_index = dict(cur.fetchall())
+        conn.rollback()
+
+    nodes = list(_plan_nodes(plan))
+    print("Postgres plan:")
+    for node in nodes:
+        print(f"  {node['Node Type']} {node.get('Relation Name', '')} {node.get('Index Name', '')}".rstrip())
+
+    scans = [n for n in nodes if "Relation Name" in n]
+    assert not any(n["Node Type"] in JOIN_NODES for n in nodes), "plan contains a join"
+    assert not any(n["Relation Name"] == "trips" for n in scans), "plan reads trips"
+    assert scans and all(n["Node Type"] == "Index Only Scan"
+                         and parent_index.get(n["Index Name"], n["Index Name"]) == "idx_positions_route_ts"
+                         for n in scans), \
+        "a partition is not read with an index-only scan of the route index"
+    print(f"  OK: {len(scans)} partitions, each an index-only scan, no join")
+
+
+def main():
+    if db.get_db_type() == "postgres":
+        db.init_db()
+        check_postgres()
+    else:
+        check_sqlite()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Check that db.init_db upgrades databases written by earlier schemas in place:
+
+    baseline   one positions table, trips keyed by trip_id
+    user-011   positions split into time partitions (trip_id/stop_id strings)
+    user-012   partitions with route_id/direction_id copied from trips
+
+Each schema is created with a few trips and positions, then init_db runs twice
+(the second run must be a no-op). The rows inside the retention window must
+come back through the trips/stops keys unchanged, and new writes through
+dimensions.write must reuse the migrated trip keys and number new trips after them.
+
+SQLite: scratch files in a temporary directory.
+
+Postgres (when DATABASE_URL is set): every scenario starts with
+DROP SCHEMA public CASCADE, so it refuses to run without --scratch. Point it at
+a throwaway database only.
+
+Usage:
+    python bench/check_schema_upgrade.py
+    DATABASE_URL=postgresql://localhost/scratch python bench/check_schema_upgrade.py --scratch
+"""
+import os
+import sys
+import tempfile
+import time
+import sqlite3
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "backend"))
+
+import db
+import dimensions
+
+NOW = time.time()
+TRIPS = [("t1", "Q", "08:00:00", 0), ("t2", "F", "08:05:00", 1), ("t3", "Q", "08:10:00", 1)]
+ROUTES = {trip_id: (route_id, direction_id) for trip_id, route_id, _, direction_id in TRIPS}
+# (trip_id, timestamp, stop_id, distance); the last one is past the retention window
+POSITIONS = [
+    ("t1", NOW - 3 * 3600, "R30S", 1.5),
+    ("t1", NOW - 90, "R31S", 2.5),
+    ("t2", NOW - 60, "F20N", 0.5),
+    ("t3", NOW - 30, "R30N", 7.0),
+    ("t1", NOW - 2 * db.RETENTION_SECONDS, "R29S", 0.0),
+]
+
+SQLITE_TRIPS = """
+    CREATE TABLE trips (trip_id TEXT PRIMARY KEY, route_id TEXT, start_time TEXT, direction_id INTEGER)
+"""
+PG_TRIPS = """
+    CREATE TABLE trips (trip_id TEXT PRIMARY KEY, route_id TEXT, start_time TEXT, direction_id INTEGER);
+    CREATE INDEX idx_trips_route_id ON trips(route_id)
+"""
+
+
+def old_starts():
+    return sorted({db.partition_start(ts) for _, ts, _, _ in POSITIONS})
+
+
+def old_rows(with_route):
+    if with_route:
+        return [p + ROUTES[p[0]] for p in POSITIONS]
+    return POSITIONS
+
+
+# --- Old positions schemas, as the earlier db.py created them (trips is created first) ---
+
+def sqlite_baseline(conn):
+    conn.execute("""
+        CREATE TABLE positions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, trip_id TEXT, timestamp REAL, stop_id TEXT, distance REAL,
+            FOREIGN KEY(trip_id) REFERENCES trips(trip_id)
+        )
+    """)
+    conn.execute("CREATE INDEX idx_positions_timestamp ON positions(timestamp)")
+    conn.execute("CREATE INDEX idx_positions_trip_id ON positions(trip_id)")
+    conn.executemany("INSERT INTO positions (trip_id, timestamp, stop_id, distance) VALUES (?, ?, ?, ?)", POSITIONS)
+
+
+def sqlite_partitioned(with_route):
+    def create(conn):
+        route_columns = ", route_id TEXT, direction_id INTEGER" if with_route else ""
+        cols = "trip_id, timestamp, stop_id, distance" + (", route_id, direction_id" if with_route else "")
+        for start in old_starts():
+            name = db.partition_name(start)
+            conn.execute(f"""
+                CREATE TABLE {name} (
+                    id INTEGER PRIMARY KEY, trip_id TEXT, timestamp REAL, stop_id TEXT, distance REAL{route_columns},
+                    FOREIGN KEY(trip_id) REFERENCES trips(trip_id)
+                )
+            """)
+            conn.execute(f"CREATE INDEX idx_{name}_timestamp ON {name}(timestamp)")
+            conn.execute(f"CREATE INDEX idx_{name}_trip_id ON {name}(trip_id)")
+            if with_route:
+                conn.execute(f"""
+                    CREATE INDEX idx_{name}_route_ts
+                    ON {name}(route_id, timestamp, trip_id, direction_id, stop_id, distance)
+                """)
+            placeholders = ", ".join("?" for _ in cols.split(", "))
+            conn.executemany(f"INSERT INTO {name} ({cols}) VALUES ({placeholders})",
+                             [r for r in old_rows(with_route) if db.partition_start(r[1]) == start])
+        conn.execute("CREATE VIEW positions AS " + " UNION ALL ".join(
+            f"SELECT id, {cols} FROM {db.partition_name(start)}" for start in old_starts()
+        ))
+    return create
+
+
+def pg_baseline(cur):
+    cur.execute("""
+        CREATE TABLE positions (
+            id SERIAL PRIMARY KEY, trip_id TEXT, timestamp DOUBLE PRECISION, stop_id TEXT,
+            distance DOUBLE PRECISION,
+            FOREIGN KEY(trip_id) REFERENCES trips(trip_id)
+        );
+        CREATE INDEX idx_positions_timestamp ON positions(timestamp);
+        CREATE INDEX idx_positions_trip_id ON positions(trip_id)
+    """)
+    cur.executemany("INSERT INTO positions (trip_id, timestamp, stop_id, distance) VALUES (%s, %s, %s, %s)",
+                    POSITIONS)
+
+
+def pg_partitioned(with_route):
+    def create(cur):
+        route_columns = ", route_id TEXT, direction_id INTEGER" if with_route else ""
+        cur.execute(f"""
+            CREATE TABLE positions (
+                id BIGSERIAL, trip_id TEXT, timestamp DOUBLE PRECISION, stop_id TEXT,
+                distance DOUBLE PRECISION{route_columns},
+                FOREIGN KEY(trip_id) REFERENCES trips(trip_id)
+            ) PARTITION BY RANGE (timestamp);
+            CREATE INDEX idx_positions_timestamp ON positions(timestamp);
+            CREATE INDEX idx_positions_trip_id ON positions(trip_id)
+        """)
+        if with_route:
+            cur.execute("""
+                CREATE INDEX idx_positions_route_ts ON positions(route_id, timestamp)
+                INCLUDE (trip_id, direction_id, stop_id, distance)
+            """)
+        for start in old_starts():
+            cur.execute(f"""
+                CREATE TABLE {db.partition_name(start)} PARTITION OF positions
+                FOR VALUES FROM ({start}) TO ({start + db.PARTITION_SECONDS})
+            """)
+        cols = "trip_id, timestamp, stop_id, distance" + (", route_id, direction_id" if with_route else "")
+        placeholders = ", ".join("%s" for _ in cols.split(", "))
+        cur.executemany(f"INSERT INTO positions ({cols}) VALUES ({placeholders})", old_rows(with_route))
+    return create
+
+
+SCENARIOS = [
+    ("baseline", sqlite_baseline, pg_baseline),
+    ("user-011", sqlite_partitioned(False), pg_partitioned(False)),
+    ("user-012", sqlite_partitioned(True), pg_partitioned(True)),
+]
+
+
+# --- Running a scenario ---
+
+def reset_process_state():
+    db.close_pool()
+    db._known_partitions.clear()
+    for cache in (dimensions._trip_keys, dimensions._stop_keys, dimensions._trip_ids, dimensions._stop_ids):
+        cache.clear()
+
+
+def create_sqlite(create):
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), "upgrade.db")
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.execute(SQLITE_TRIPS)
+    conn.executemany("INSERT INTO trips VALUES (?, ?, ?, ?)", TRIPS)
+    create(conn)
+    conn.commit()
+    conn.close()
+
+
+def create_pg(create):
+    conn = db.psycopg2.connect(db.get_db_url())
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+        cur.execute(PG_TRIPS)
+        cur.executemany("INSERT INTO trips VALUES (%s, %s, %s, %s)", TRIPS)
+        create(cur)
+    conn.close()
+
+
+def stored(conn):
+    """Every stored position, with its keys resolved back to ids."""
+    return db.fetch(conn, db.statement("check_upgrade_positions", """
+        SELECT t.trip_id, p.timestamp, s.stop_id, p.distance, p.route_id, p.direction_id
+        FROM positions p
+        JOIN trips t ON t.trip_key = p.trip_key
+        JOIN stops s ON s.stop_key = p.stop_key
+    """))
+
+
+def check(name, create):
+    reset_process_state()
+    if db.get_db_type() == "sqlite":
+        create_sqlite(create)
+    else:
+        create_pg(create)
+
+    started = time.perf_counter()
+    db.init_db()
+    took = time.perf_counter() - started
+    with db.get_db() as conn:
+        first = sorted(tuple(r) for r in stored(conn))
+    # A second start must find nothing to migrate
+    reset_process_state()
+    db.init_db()
+    with db.get_db() as conn:
+        second = sorted(tuple(r) for r in stored(conn))
+
+    cutoff = NOW - db.RETENTION_SECONDS
+    expected = {p + ROUTES[p[0]] for p in POSITIONS if p[1] >= cutoff}
+    everything = {p + ROUTES[p[0]] for p in POSITIONS}
+    assert expected <= set(first), f"{name}: rows lost in the upgrade: {sorted(expected - set(first))}"
+    assert set(first) <= everything, f"{name}: unexpected rows after the upgrade: {sorted(set(first) - everything)}"
+    assert first == second, f"{name}: second init_db changed positions"
+
+    # New writes reuse the migrated keys
+    with db.get_db() as conn:
+        trip_key = db.fetch(conn, db.statement("check_upgrade_trip_key",
+                                               "SELECT trip_key FROM trips WHERE trip_id = ?"), ("t1",))[0][0]
+        db.ensure_partitions(conn, [NOW])
+        new_rows = [("t1", NOW, "R32S", 3.5, "Q", 0), ("t4", NOW, "R33S", 4.5, "Q", 0)]
+        interned = dimensions.write(conn, [TRIPS[0], ("t4", "Q", "08:15:00", 0)], new_rows, [], NOW)
+        conn.commit()
+        interned.remember()
+        assert interned.trip_keys["t1"][0] == trip_key, f"{name}: t1 got a new trip key"
+        # Fresh keys come after the migrated ones (Postgres identity columns added to filled tables)
+        assert interned.trip_keys["t4"][0] > trip_key, f"{name}: new trip reused an old key"
+        assert set(new_rows) <= {tuple(r) for r in stored(conn)}, f"{name}: new rows not readable"
+    print(f"  {name}: OK ({len(first)} positions kept, init_db {took * 1000:.0f} ms)")
+
+
+def main():
+    db_type = db.get_db_type()
+    if db_type == "postgres" and "--scratch" not in sys.argv:
+        sys.exit("DATABASE_URL is set: this drops its public schema. Pass --scratch to confirm it is a throwaway database.")
+    print(f"Upgrading old {db_type} schemas:")
+    for name, sqlite_create, pg_create in SCENARIOS:
+        check(name, sqlite_create if db_type == "sqlite" else pg_create)
+    reset_process_state()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Record GTFS-realtime snapshots to disk and replay them through the ingest path
+(poller.extract_timed + poller.write_feed) for a repeatable offline benchmark.
+
+A recording is a directory of raw protobufs, <feed>/<header timestamp>.pb,
+a feed archive directory (FEED_ARCHIVE_DIR, see feed_archive.py) or a single
+captured feed file:
+
+    record       poll the configured feeds (FEED_BASE_URL works too) on their
+                 own schedules and save every new snapshot
+    synthesize   build a recording of the Q line from q_line_data.json: one
+                 snapshot every --interval seconds, each train reported at its
+                 latest stop, so replays exercise both arrivals and dwells
+    replay       write a recording into a fresh database, in header-timestamp
+                 order across feeds, as fast as possible (--speed 0) or at
+                 N x real time. Timestamps are shifted so the recording ends now
+                 (--no-shift keeps them). Reports rows/s, per-feed latency
+                 (parse + extract + write of one snapshot), stage times and DB growth.
+
+Replays use a scratch SQLite database; with DATABASE_URL set they write to that
+Postgres database instead (use a local, disposable one).
+
+Usage:
+    python bench/replay_feeds.py record recordings/live [--minutes 30]
+    python bench/replay_feeds.py synthesize recordings/q [--interval 10]
+    GTFS_DIR=gtfs_subway python bench/replay_feeds.py replay recordings/q [--speed 0]
+    GTFS_DIR=gtfs_subway python bench/replay_feeds.py replay nyct%2Fgtfs-ace
+    GTFS_DIR=gtfs_subway python bench/replay_feeds.py replay /data/archive
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "backend"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from google.transit import gtfs_realtime_pb2
+
+import db
+import feed_archive
+import gtfs_loader
+import poller
+from bench_history import LINE, use_sample_station_map
+
+
+def save_snapshot(out, feed, header_ts, content):
+    os.makedirs(os.path.join(out, feed), exist_ok=True)
+    path = os.path.join(out, feed, f"{header_ts}.pb")
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def load_recording(directory):
+    """[(header_ts, feed, content)] sorted by header timestamp. A single file (e.g. nyct%2Fgtfs-ace) is one snapshot."""
+    if os.path.isfile(directory):
+        with open(directory, "rb") as f:
+            content = f.read()
+        return [(poller.feed_header_timestamp(content) or 0, poller.feed_name(directory), content)]
+    # Archived snapshots are keyed by header timestamp too, falling back to the fetch time
+    snapshots = [(header_ts or fetched_at, feed, content)
+                 for feed, _, path in feed_archive.list_segments(directory)
+                 for fetched_at, header_ts, content in feed_archive.read_segment(path)]
+    for feed in sorted(os.listdir(directory)):
+        feed_dir = os.path.join(directory, feed)
+        if not os.path.isdir(feed_dir):
+            continue
+        for name in os.listdir(feed_dir):
+            if name.endswith(".pb"):
+                with open(os.path.join(feed_dir, name), "rb") as f:
+                    snapshots.append((float(name[:-3]), feed, f.read()))
+    snapshots.sort(key=lambda s: (s[0], s[1]))
+    return snapshots
+
+
+def record(args):
+    """Poll on the poller's schedules (conditional requests, header-timestamp skip) and save new snapshots."""
+    end = time.time() + args.minutes * 60
+    saved = 0
+    while time.time() < end:
+        for url in poller.due_feeds(poller.FEED_URLS, time.time()):
+            schedule = poller.get_schedule(url)
+            content = poller.download_feed(url)
+            if content is None:
+                schedule.failed(time.time())
+                continue
+            header_ts = None if content is poller.NOT_MODIFIED else poller.feed_header_timestamp(content)
+            if header_ts is None or header_ts == schedule.header_ts:
+                schedule.unchanged(time.time())
+                continue
+            schedule.changed(header_ts, time.time())
+            save_snapshot(args.directory, poller.feed_name(url), header_ts, content)
+            saved += 1
+        print(f"\r{saved} snapshots saved", end="", flush=True)
+        time.sleep(max(min(poller.next_due_time(poller.FEED_URLS) - time.time(), poller.MIN_POLL_INTERVAL), 0.5))
+    print()
+
+
+def synthesize(args):
+    with open(os.path.join(ROOT, "q_line_data.json")) as f:
+        data = json.load(f)
+    trips = [(t, sorted(t["positions"], key=lambda p: p["timestamp"])) for t in data]
+    first = min(p[0]["timestamp"] for _, p in trips)
+    last = max(p[-1]["timestamp"] for _, p in trips)
+
+    count = 0
+    t = first
+    while t <= last:
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = "1.0"
+        feed.header.timestamp = int(t)
+        for trip, positions in trips:
+            if not positions[0]["timestamp"] <= t <= positions[-1]["timestamp"]:
+                continue
+            current = [p for p in positions if p["timestamp"] <= t][-1]
+            update = feed.entity.add(id=f"{trip['trip_id']}-tu").trip_update
+            update.trip.trip_id = trip["trip_id"]
+            update.trip.route_id = trip["route_id"]
+            update.trip.direction_id = trip["direction_id"]
+            vehicle = feed.entity.add(id=f"{trip['trip_id']}-v").vehicle
+            vehicle.trip.CopyFrom(update.trip)
+            vehicle.stop_id = current["stop_id"]
+            vehicle.timestamp = int(t)
+        save_snapshot(args.directory, "gtfs-nqrw", int(t), feed.SerializeToString())
+        count += 1
+        t += args.interval
+    print(f"{count} snapshots of {len(trips)} trips over {(last - first) / 60:.0f} min in {args.directory}")
+
+
+def shift_snapshot(content, offset):
+    """Move the header and vehicle timestamps by offset seconds (done before timing)."""
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    feed.header.timestamp += offset
+    for entity in feed.entity:
+        if entity.HasField("vehicle") and entity.vehicle.timestamp:
+            entity.vehicle.timestamp += offset
+        if entity.HasField("trip_update") and entity.trip_update.timestamp:
+            entity.trip_update.timestamp += offset
+    return feed.SerializeToString()
+
+
+def db_size():
+    """Bytes on disk for the current database."""
+    with db.get_db() as conn:
+        if db.get_db_type() == "postgres":
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_database_size(current_database())")
+                size = cur.fetchone()[0]
+            conn.rollback()
+            return size
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return sum(os.path.getsize(p) for p in (db.DB_PATH, db.DB_PATH + "-wal") if os.path.exists(p))
+
+
+COUNT_QUERY = db.statement("replay_count_positions", "SELECT COUNT(*) FROM positions")
+
+
+def stored_rows():
+    with db.get_db(readonly=True) as conn:
+        return db.fetch(conn, COUNT_QUERY)[0][0]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)] if values else 0.0
+
+
+def replay(args):
+    snapshots = load_recording(args.directory)
+    if not snapshots:
+        sys.exit(f"No snapshots in {args.directory}")
+
+    poller.logger.setLevel("WARNING")
+    try:
+        gtfs_loader.load_data()
+    except FileNotFoundError as e:
+        # gtfs_subway ships without stop_times.txt; set GTFS_DIR to a full feed for live recordings
+        print(f"GTFS incomplete ({e.filename}), only the Q line gets distances")
+    if not gtfs_loader.get_stations_list(LINE):
+        # Enough for synthesized Q recordings
+        with open(os.path.join(ROOT, "q_line_data.json")) as f:
+            use_sample_station_map(json.load(f))
+
+    if not args.no_shift:
+        offset = int(time.time() - snapshots[-1][0])
+        snapshots = [(ts + offset, feed, shift_snapshot(content, offset)) for ts, feed, content in snapshots]
+
+    if db.get_db_type() == "sqlite":
+        db.DB_PATH = os.path.join(tempfile.mkdtemp(), "replay.db")
+    db.init_db()
+    poller._trip_state = {}
+    size_before, rows_before = db_size(), stored_rows()
+
+    latencies = {}  # feed -> [seconds]
+    stages = {"parse": 0.0, "extract": 0.0, "write": 0.0}
+    input_rows = 0
+    first_ts = snapshots[0][0]
+    start = time.perf_counter()
+    for header_ts, feed, content in snapshots:
+        if args.speed:
+            wait = start + (header_ts - first_ts) / args.speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        t0 = time.perf_counter()
+        (trip_rows, position_rows), (parse_s, extract_s, _) = poller.extract_timed(content)
+        t1 = time.perf_counter()
+        poller.write_feed(trip_rows, position_rows, url=feed)
+        t2 = time.perf_counter()
+        latencies.setdefault(feed, []).append(t2 - t0)
+        stages["parse"] += parse_s
+        stages["extract"] += extract_s
+        stages["write"] += t2 - t1
+        input_rows += len(position_rows)
+    elapsed = time.perf_counter() - start
+    busy = sum(sum(v) for v in latencies.values())
+
+    size_after, rows_after = db_size(), stored_rows()
+    stored = rows_after - rows_before
+    growth = size_after - size_before
+    span = snapshots[-1][0] - first_ts
+
+    print(f"{db.get_db_type()}: {len(snapshots)} snapshots from {len(latencies)} feeds, "
+          f"{span / 60:.1f} min of data replayed in {elapsed:.2f} s (speed {args.speed or 'max'})")
+    print(f"  positions       {input_rows} in, {stored} stored  "
+          f"({input_rows / busy:,.0f} rows/s in, {stored / busy:,.0f} stored rows/s of ingest time)")
+    print(f"  stage totals    parse {stages['parse']:.3f} s  extract {stages['extract']:.3f} s  "
+          f"write {stages['write']:.3f} s")
+    print("  per-snapshot latency (parse + extract + write):")
+    for feed, values in sorted(latencies.items()):
+        print(f"    {feed:<14} n={len(values):<5} p50 {percentile(values, 0.5) * 1000:7.2f} ms  "
+              f"p95 {percentile(values, 0.95) * 1000:7.2f} ms  max {max(values) * 1000:7.2f} ms")
+    per_hour = f", {growth / span * 3600 / 1024 / 1024:.1f} MB per hour of data" if span >= 60 else ""
+    print(f"  DB size         {size_before / 1024:,.0f} KB -> {size_after / 1024:,.0f} KB "
+          f"(+{growth / 1024:,.0f} KB, {growth / max(stored, 1):.0f} B per stored row{per_hour})")
+    db.close_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("record", help="save live snapshots")
+    p.add_argument("directory")
+    p.add_argument("--minutes", type=float, default=30)
+
+    p = commands.add_parser("synthesize", help="build a Q recording from q_line_data.json")
+    p.add_argument("directory")
+    p.add_argument("--interval", type=int, default=10)
+
+    p = commands.add_parser("replay", help="ingest a recording into a fresh database")
+    p.add_argument("directory")
+    p.add_argument("--speed", type=float, default=0, help="N x real time; 0 = as fast as possible")
+    p.add_argument("--no-shift", action="store_true", help="keep the recorded timestamps")
+
+    args = parser.parse_args()
+    {"record": record, "synthesize": synthesize, "replay": replay}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Local stand-in for the MTA GTFS-realtime endpoints.
+
+Serves the captured `nyct%2Fgtfs-ace` protobuf on every path, with an
+artificial per-request delay so fetch latency can be measured offline.
+Responses carry an ETag and If-None-Match is answered with 304, unless
+started with --no-etag (then only the feed header timestamp tells the
+poller nothing changed).
+
+Usage:
+    python bench/stub_feed_server.py --port 8900 --delay 1.0 --slow gtfs-ace=5
+    FEED_BASE_URL=http://localhost:8900 python backend/ingest_entrypoint.py
+"""
+import argparse
+import hashlib
+import os
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FEED = os.path.join(ROOT, "nyct%2Fgtfs-ace")
+
+
+def make_handler(payload, delay, slow, etag):
+    class FeedHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def do_GET(self):
+            # Per-path override, e.g. "gtfs-ace=5" matches ".../nyct%2Fgtfs-ace"
+            wait = delay
+            for suffix, seconds in slow.items():
+                if self.path.endswith(suffix):
+                    wait = seconds
+            time.sleep(wait)
+            if etag and self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            if etag:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FeedHandler
+
+
+def start_server(port=0, delay=0.0, slow=None, feed_path=DEFAULT_FEED, etag=True):
+    """Start the stub server on a background thread. Returns (server, base_url)."""
+    with open(feed_path, "rb") as f:
+        payload = f.read()
+    tag = '"' + hashlib.md5(payload).hexdigest() + '"' if etag else None
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(payload, delay, slow or {}, tag))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def parse_slow(values):
+    slow = {}
+    for value in values or []:
+        suffix, seconds = value.split("=", 1)
+        slow[suffix] = float(seconds)
+    return slow
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--delay", type=float, default=0.5, help="Delay in seconds for every response")
+    parser.add_argument("--slow", action="append", help="Per-feed delay override, e.g. gtfs-ace=5")
+    parser.add_argument("--feed", default=DEFAULT_FEED, help="Protobuf file to serve")
+    parser.add_argument("--no-etag", action="store_true", help="Don't send ETags or answer 304")
+    args = parser.parse_args()
+
+    server, base_url = start_server(args.port, args.delay, parse_slow(args.slow), args.feed, not args.no_etag)
+    print(f"Serving {args.feed} at {base_url}/<feed> (Ctrl-C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
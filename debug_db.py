@@ -3,13 +3,13 @@ import sys
 import time
 sys.path.append(os.path.join(os.getcwd(), 'backend'))
 
-from db import get_db, execute_query
+from db import get_db, execute_query, prune_positions
 
 def main():
     print("Checking database content...")
     with get_db() as conn:
-        cursor = execute_query(conn, "DELETE FROM positions")
-        conn.commit()
+        # positions is partitioned by time; dropping every partition clears it
+        prune_positions(conn, float("inf"))
         print("Cleared positions table.")
         
         # Check trips count by route
@@ -26,7 +26,7 @@ def main():
         cursor = execute_query(conn, """
             SELECT t.route_id, COUNT(*) as count 
             FROM positions p 
-            JOIN trips t ON p.trip_id = t.trip_id 
+            JOIN trips t ON p.trip_key = t.trip_key 
             GROUP BY t.route_id
         """)
         rows = cursor.fetchall()
@@ -43,7 +43,7 @@ def main():
         cursor = execute_query(conn, """
             SELECT t.route_id, COUNT(*) as count, MAX(p.timestamp) as last_ts
             FROM positions p 
-            JOIN trips t ON p.trip_id = t.trip_id 
+            JOIN trips t ON p.trip_key = t.trip_key 
             WHERE p.timestamp > ?
             GROUP BY t.route_id
         """, (cutoff,))
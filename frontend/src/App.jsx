@@ -1,6 +1,7 @@
 import React, { useEffect, useState } from 'react';
 import Stringline from './Stringline';
 import LineSelector from './LineSelector';
+import { applyHistoryDelta, tripsToList } from './historyDelta';
 import './App.css';
 
 const DIRECTIONS = [
@@ -36,23 +37,59 @@ function App() {
     fetchStations();
   }, [selectedLine]);
 
-  // 2. Poll History (Every 5 seconds)
+  // 2. Live History: server push, falling back to polling deltas every 5 seconds
   useEffect(() => {
+    let trips = new Map();
+    let cursor = null;
+    let cancelled = false;
+    let interval = null;
+    let source = null;
+
+    const applyDelta = (delta) => {
+      trips = applyHistoryDelta(trips, delta);
+      cursor = delta.cursor;
+      setData(tripsToList(trips));
+    };
+
     const fetchHistory = async () => {
       try {
-        const res = await fetch(`/api/history?line=${selectedLine}`);
+        const params = new URLSearchParams({ line: selectedLine });
+        if (cursor) params.set('cursor', cursor);
+        const res = await fetch(`/api/history/delta?${params}`);
         if (res.ok) {
-          const json = await res.json();
-          setData(json);
+          const delta = await res.json();
+          if (cancelled) return;
+          applyDelta(delta);
         }
       } catch (e) {
         console.error("Failed to fetch history", e);
       }
     };
 
-    fetchHistory(); // Initial fetch
-    const interval = setInterval(fetchHistory, 5000);
-    return () => clearInterval(interval);
+    const startPolling = () => {
+      if (interval || cancelled) return;
+      fetchHistory(); // Initial fetch (full window, or catch up from the stream's cursor)
+      interval = setInterval(fetchHistory, 5000);
+    };
+
+    if (window.EventSource) {
+      source = new EventSource(`/api/stream?line=${selectedLine}`);
+      source.onmessage = (e) => {
+        if (!cancelled) applyDelta(JSON.parse(e.data));
+      };
+      source.onerror = () => {
+        // EventSource retries by itself; it only gives up (CLOSED) on e.g. a 503
+        if (source.readyState === EventSource.CLOSED) startPolling();
+      };
+    } else {
+      startPolling();
+    }
+
+    return () => {
+      cancelled = true;
+      if (source) source.close();
+      if (interval) clearInterval(interval);
+    };
   }, [selectedLine]);
 
   // Filter data by direction
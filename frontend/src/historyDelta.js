@@ -0,0 +1,42 @@
+// Merge a response from /api/history/delta into the trips we already have.
+// `trips` is a Map of trip_id -> trip; returns a new Map.
+export function applyHistoryDelta(trips, delta) {
+  const next = delta.reset ? new Map() : new Map(trips);
+
+  for (const trip of delta.trips) {
+    const old = next.get(trip.trip_id);
+    // Keep our points before `since`, take the server's from there on (null = replace all)
+    const kept = old && trip.since !== null
+      ? old.positions.filter(p => p.timestamp < trip.since)
+      : [];
+    next.set(trip.trip_id, {
+      trip_id: trip.trip_id,
+      route_id: trip.route_id,
+      direction_id: trip.direction_id,
+      positions: kept.concat(trip.positions)
+    });
+  }
+
+  for (const tripId of delta.removed) {
+    next.delete(tripId);
+  }
+
+  // Age out points that left the window
+  for (const [tripId, trip] of next) {
+    if (trip.positions.length && trip.positions[0].timestamp <= delta.cutoff) {
+      const positions = trip.positions.filter(p => p.timestamp > delta.cutoff);
+      if (positions.length) {
+        next.set(tripId, { ...trip, positions });
+      } else {
+        next.delete(tripId);
+      }
+    }
+  }
+
+  return next;
+}
+
+// Trips with fewer than 2 points can't be drawn
+export function tripsToList(trips) {
+  return Array.from(trips.values()).filter(trip => trip.positions.length > 1);
+}
@@ -3,12 +3,33 @@
 # Ensure data directory exists
 mkdir -p /data
 
+# Postgres connection budget. Every process has its own pools:
+#   ingestor      DB_POOL_MAX (psycopg2)
+#   web worker    DB_POOL_MAX (psycopg2) + DB_ASYNC_POOL_MAX (asyncpg) + 1 (LISTEN for update events)
+# DB_CONNECTION_BUDGET (default 80, under Postgres's default max_connections=100)
+# is split across them; set DB_POOL_MAX/DB_ASYNC_POOL_MAX to size the web pools by hand.
+WEB_WORKERS="${WEB_WORKERS:-2}"
+DB_CONNECTION_BUDGET="${DB_CONNECTION_BUDGET:-80}"
+INGEST_DB_POOL_MAX="${INGEST_DB_POOL_MAX:-4}"
+PER_WORKER=$(( (DB_CONNECTION_BUDGET - INGEST_DB_POOL_MAX) / WEB_WORKERS ))
+if [ -n "$DATABASE_URL$DATABASE_PUBLIC_URL" ] && [ "$PER_WORKER" -lt 3 ]; then
+    echo "DB_CONNECTION_BUDGET=$DB_CONNECTION_BUDGET is too small for $WEB_WORKERS web workers" >&2
+    exit 1
+fi
+WEB_POOL_MAX=$(( (PER_WORKER - 1) / 2 ))
+
 # Start ingestor in background
 echo "Starting Ingestor..."
-python backend/ingest_entrypoint.py &
+DB_POOL_MAX="$INGEST_DB_POOL_MAX" python backend/ingest_entrypoint.py &
 
 # Start web app in foreground
 # Railway provides PORT env var
 PORT="${PORT:-8080}"
-echo "Starting Web App on port $PORT..."
-uvicorn backend.main:app --host 0.0.0.0 --port $PORT
+# The ingestor above is the only poller; each web worker keeps its own history
+# store, refreshed when the ingestor announces a commit (backend/notifications.py)
+export DB_POOL_MAX="${DB_POOL_MAX:-$WEB_POOL_MAX}"
+export DB_ASYNC_POOL_MAX="${DB_ASYNC_POOL_MAX:-$WEB_POOL_MAX}"
+export DB_ASYNC_POOL_MIN="${DB_ASYNC_POOL_MIN:-1}"
+echo "Starting Web App on port $PORT with $WEB_WORKERS workers" \
+     "(up to $(( WEB_WORKERS * (DB_POOL_MAX + DB_ASYNC_POOL_MAX + 1) + INGEST_DB_POOL_MAX )) Postgres connections)..."
+DISABLE_POLLER=true exec uvicorn backend.main:app --host 0.0.0.0 --port $PORT --workers "$WEB_WORKERS"